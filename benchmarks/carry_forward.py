@@ -0,0 +1,137 @@
+"""
+Compare two ways of carrying the courses and salary savings of one cfr
+revision forward to the next one:
+
+    per row:    SELECT the ids linked to the previous revision, then
+                INSERT one link for each of them (how it used to be done)
+    set-based:  one INSERT ... SELECT (request.CARRY_FORWARD_COURSES
+                and request.CARRY_FORWARD_SAVINGS)
+
+This needs a database with the current schema. The CFR environment is
+read from the OS environment, so from a checkout of the repository run:
+
+    env $(cat cfr.env | xargs) python3 benchmarks/carry_forward.py
+
+Everything is done in one transaction (using a made-up semester and
+department) that is rolled back at the end, so nothing is left behind.
+"""
+import sys
+import os
+import timeit
+
+# Import the utils package from the content directory
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'content'))
+from utils import cfrenv #pylint: disable=import-error
+from utils import request #pylint: disable=import-error
+from utils.sql_connection import Transaction #pylint: disable=import-error
+
+ROW_COUNTS = [10, 100, 1000]
+REPEATS = 5
+
+# A semester and department that will not clash with real data
+SEMESTER = ('Summer', 1901)
+DEPT_NAME = 'Carry Forward Benchmark'
+
+# The revisions that are copied from and to
+FROM_CFR = (DEPT_NAME,) + SEMESTER + (0,)
+PER_ROW_CFR = (DEPT_NAME,) + SEMESTER + (1,)
+SET_BASED_CFR = (DEPT_NAME,) + SEMESTER + (2,)
+
+# The link tables, as tuples of a name, the table, its id column,
+# the query that inserts one link and the set-based query
+LINKS = [
+    ("courses", "cfr_request", "course_id", request.INSERT_CFR_COURSE, request.CARRY_FORWARD_COURSES),
+    ("savings", "cfr_savings", "savings_id", request.INSERT_CFR_SAVINGS, request.CARRY_FORWARD_SAVINGS),
+]
+
+class Rollback(Exception):
+    """
+    Raised at the end of the benchmark to roll back its transaction
+    """
+    pass
+
+def set_up(cursor, num_rows: int):
+    """
+    Create a cfr with num_rows courses and salary savings, and two
+    empty revisions after it to copy them to
+    """
+    cursor.execute("DELETE FROM cfr_request WHERE dept_name = %s", (DEPT_NAME,))
+    cursor.execute("DELETE FROM cfr_savings WHERE dept_name = %s", (DEPT_NAME,))
+    cursor.execute("DELETE FROM cfr_department WHERE dept_name = %s", (DEPT_NAME,))
+    for cfr in (FROM_CFR, PER_ROW_CFR, SET_BASED_CFR):
+        cursor.execute(
+            "INSERT INTO cfr_department (dept_name, semester, cal_year, date_initial, revision_num, dean_committed) "
+            "VALUES (%s, %s, %s, NOW(), %s, 0)", cfr)
+
+    courses = [
+        (i, f"BENCH {i}", "M01", "No", "No", 20, f"Instructor {i}", None, "Faculty", "2500.00", "Benchmark")
+        for i in range(num_rows)
+    ]
+    course_ids = request._insert_rows(cursor, request.INSERT_COURSES, request.COURSE_VALUES, courses)
+    cursor.executemany(request.INSERT_CFR_COURSE, [(i,) + FROM_CFR for i in course_ids])
+
+    savings = [("Other", f"Instructor {i}", "1000.00", "Benchmark") for i in range(num_rows)]
+    savings_ids = request._insert_rows(cursor, request.INSERT_SAVINGS, request.SAVINGS_VALUES, savings)
+    cursor.executemany(request.INSERT_CFR_SAVINGS, [(i,) + FROM_CFR for i in savings_ids])
+
+def clear(cursor, table: str, cfr: tuple):
+    """
+    Remove every link to the given cfr from the given table
+    """
+    cursor.execute(
+        f"DELETE FROM {table} WHERE dept_name = %s AND semester = %s AND cal_year = %s AND revision_num = %s",
+        cfr)
+
+def carry_per_row(cursor, table: str, id_column: str, insert_link: str):
+    cursor.execute(
+        f"SELECT {id_column} FROM {table} "
+        "WHERE dept_name = %s AND semester = %s AND cal_year = %s AND revision_num = %s",
+        FROM_CFR)
+    for row in cursor.fetchall():
+        cursor.execute(insert_link, tuple(row) + PER_ROW_CFR)
+
+def carry_set_based(cursor, carry_forward: str):
+    cursor.execute(carry_forward, SET_BASED_CFR + FROM_CFR)
+
+def time_best(set_up: callable, run: callable) -> float:
+    """
+    Get the best time (in seconds) of REPEATS runs of run,
+    calling set_up (untimed) before each one
+    """
+    best = None
+    for _ in range(REPEATS):
+        set_up()
+        start = timeit.default_timer()
+        run()
+        elapsed = timeit.default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    cfrenv.init_environ({})
+    if not cfrenv.verify_environ():
+        print("The CFR environment is missing required variables (see cfr.env)")
+        sys.exit(1)
+
+    print(f"Best of {REPEATS} runs")
+    print(f"{'':<16}{'per row (ms)':>14}{'set-based (ms)':>16}{'speedup':>10}")
+    try:
+        with Transaction() as cursor:
+            cursor.execute("INSERT INTO semester VALUES (%s, %s, 'no')", SEMESTER)
+            for num_rows in ROW_COUNTS:
+                set_up(cursor, num_rows)
+                for (name, table, id_column, insert_link, carry_forward) in LINKS:
+                    per_row = time_best(
+                        lambda: clear(cursor, table, PER_ROW_CFR),
+                        lambda: carry_per_row(cursor, table, id_column, insert_link))
+                    set_based = time_best(
+                        lambda: clear(cursor, table, SET_BASED_CFR),
+                        lambda: carry_set_based(cursor, carry_forward))
+                    label = f"{num_rows} {name}"
+                    print(f"{label:<16}{per_row*1000:>14.1f}{set_based*1000:>16.1f}{per_row/set_based:>9.1f}x")
+            raise Rollback()
+    except Rollback:
+        pass
+
+if __name__ == '__main__':
+    main()
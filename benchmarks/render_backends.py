@@ -0,0 +1,73 @@
+"""
+Compare how long the 'soup' and 'string' rendering backends in
+component_builder take to build the largest tables in the site.
+
+This does not need a database; the tables are filled with made-up
+courses. Run it from anywhere with:
+
+    python benchmarks/render_backends.py [number of rows]
+
+Both backends are also checked to make sure they produce the same html.
+"""
+import sys
+import os
+import timeit
+
+# Import the utils package from the content directory
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'content'))
+from utils import component_builder #pylint: disable=import-error
+from utils import request #pylint: disable=import-error
+
+DEFAULT_ROWS = 500
+REPEATS = 5
+
+def make_courses(num_rows: int) -> list:
+    """
+    Make a list of num_rows course tuples like those
+    returned by db_utils.get_courses()
+    """
+    return [
+        (i, "Yes", "No", "MATH", f"{100 + i % 400}", "M01", f"Course & Title {i}",
+        f"Instructor {i}", "Yes", "2500.00", f"Reason <{i}>")
+        for i in range(num_rows)
+    ]
+
+def make_approval_courses(num_rows: int) -> list:
+    """
+    Make a list of num_rows course tuples like the ones in the
+    course lists returned by db_utils.get_approver_data()
+    """
+    return [c + (None, "A") for c in make_courses(num_rows)]
+
+def main():
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ROWS
+    courses = make_courses(num_rows)
+    approval_courses = make_approval_courses(num_rows)
+    revisions = [courses] * 5
+
+    cases = [
+        ("edit course table",   lambda b: component_builder.build_edit_course_table_body(courses, backend=b)),
+        ("view course table",   lambda b: component_builder.build_view_courses_table(courses, backend=b)),
+        ("approve course table",lambda b: component_builder.build_approve_course_table(approval_courses, backend=b)),
+        ("revision history",    lambda b: component_builder.build_revision_history(revisions, backend=b)),
+    ]
+
+    print(f"{num_rows} rows, best of {REPEATS} runs")
+    print(f"{'':<24}{'soup (ms)':>12}{'string (ms)':>14}{'speedup':>10}")
+    for (name, build) in cases:
+        soup_html = str(build(component_builder.SOUP_BACKEND))
+        string_html = str(build(component_builder.STRING_BACKEND))
+        if soup_html != string_html:
+            print(f"{name}: backends produced different html!")
+            sys.exit(1)
+
+        # Time building the component and turning it into a string,
+        # since that is what happens when a page is rendered
+        soup_time = min(timeit.repeat(
+            lambda: str(build(component_builder.SOUP_BACKEND)), number=1, repeat=REPEATS))
+        string_time = min(timeit.repeat(
+            lambda: str(build(component_builder.STRING_BACKEND)), number=1, repeat=REPEATS))
+        print(f"{name:<24}{soup_time*1000:>12.1f}{string_time*1000:>14.1f}{soup_time/string_time:>9.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Measure the fixed cost of handling a request in wsgi_main, apart from
+any database work or page building, using the two cheapest responses:
+
+    404:        a path that no handler serves (the 404 page is cached)
+    redirect:   '/' without a session cookie, which redirects to /login
+
+This does not need a database; neither response uses one. Made-up
+database settings are put in the environment if there are none, since
+the server refuses to run without them. Run it from anywhere with:
+
+    python benchmarks/wsgi_overhead.py [number of requests]
+"""
+import sys
+import os
+import timeit
+from io import BytesIO
+
+# Import wsgi_main from the content directory
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'content'))
+for var in ('DB_HOST', 'DB_USER', 'DB_PASS', 'DB_DATABASE'):
+    os.environ.setdefault(var, 'benchmark')
+import wsgi_main #pylint: disable=import-error
+
+DEFAULT_REQUESTS = 20000
+REPEATS = 5
+
+# Where the log line for each request is written (see utils.instrumentation)
+ERROR_LOG = open(os.devnull, 'w')
+
+# The requests that are timed, as tuples of a name, the path
+# and the status that is expected
+REQUESTS = [
+    ("404",         "/nope",    "404 Not Found"),
+    ("redirect",    "/",        "303 See Other"),
+]
+
+def make_environ(path: str) -> dict:
+    """
+    Make a WSGI environ for a GET request to the given path
+    """
+    return {
+        'REQUEST_METHOD':   'GET',
+        'PATH_INFO':        path,
+        'QUERY_STRING':     '',
+        'SERVER_NAME':      'localhost',
+        'SERVER_PORT':      '80',
+        'SERVER_PROTOCOL':  'HTTP/1.1',
+        'wsgi.input':       BytesIO(),
+        'wsgi.errors':      ERROR_LOG,
+        'wsgi.version':     (1, 0),
+        'wsgi.url_scheme':  'http',
+        'wsgi.multithread': False,
+        'wsgi.multiprocess':True,
+        'wsgi.run_once':    False,
+    }
+
+def send(path: str) -> str:
+    """
+    Send one request to the application, read the whole
+    response and return its status
+    """
+    status = None
+    def start_response(_status, _headers, _exc_info = None):
+        nonlocal status
+        status = _status
+    for _ in wsgi_main.application(make_environ(path), start_response):
+        pass
+    return status
+
+def main():
+    num_requests = DEFAULT_REQUESTS
+    if len(sys.argv) > 1:
+        num_requests = int(sys.argv[1])
+
+    print(f"Best of {REPEATS} runs of {num_requests} requests")
+    print(f"{'':<12}{'per request (us)':>18}")
+    for (name, path, expected) in REQUESTS:
+        status = send(path)
+        if status != expected:
+            print(f"{name}: expected '{expected}' but got '{status}'")
+            sys.exit(1)
+        best = min(timeit.repeat(lambda: send(path), number=num_requests, repeat=REPEATS))
+        print(f"{name:<12}{best / num_requests * 1e6:>18.1f}")
+
+if __name__ == '__main__':
+    main()
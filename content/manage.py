@@ -0,0 +1,169 @@
+"""
+Command-line tools for running and maintaining the CFR system
+outside of the web server.
+
+The CFR environment is read from the OS environment (as set up by
+cfr.env in the docker container), so in the container this can be run with:
+
+    docker exec cfr python3 /srv/manage.py <command>
+
+Commands:
+    outbox          Run the worker that delivers the email notifications
+                    waiting in the outbox. Runs until interrupted unless
+                    --once is given
+    migrate         Apply any schema migrations (from sql/migrations) that
+                    have not been applied to the database yet
+    check-indexes   EXPLAIN the server's queries and check that each one
+                    is able to use an index
+    check-totals    Check that the totals stored with each cfr match its
+                    courses and salary savings, and fix them if --repair
+                    is given
+    slow-queries    Report the queries in the slow query log that took
+                    the most time (see utils/slow_queries.py)
+
+Since the sql directory is not part of the docker image, 'migrate' is
+meant to be run from a checkout of the repository, for example:
+
+    env $(cat cfr.env | xargs) python3 content/manage.py migrate
+"""
+import sys
+import time
+import argparse
+import traceback
+from utils import cfrenv
+from utils import email_notification
+from utils import migrations
+from utils import db_utils
+from utils import slow_queries
+from utils.sql_connection import Transaction
+
+# Default number of seconds the outbox worker waits between
+# checks when there is nothing to send
+DEFAULT_OUTBOX_INTERVAL = 10
+
+def log(message: str):
+    """
+    Print a timestamped message for the worker's log
+    """
+    print(time.strftime('%Y-%m-%d %H:%M:%S'), message, flush=True)
+
+def run_outbox(args) -> int:
+    """
+    Deliver the emails in the outbox, either once or forever
+    """
+    if not cfrenv.can_do_email():
+        log("Email is not configured (see the SMTP variables in cfr.env)")
+        return 1
+
+    while True:
+        try:
+            (sent, failed) = email_notification.deliver_outbox(args.batch_size)
+            if sent > 0 or failed > 0:
+                log(f"Sent {sent} emails ({failed} failed and will be retried)")
+        except Exception:
+            # Keep the worker alive if the database is briefly unavailable
+            log("Error while delivering the outbox:\n" + traceback.format_exc())
+            (sent, failed) = (0, 0)
+
+        if args.once:
+            return 0
+        # If the batch was full, there may be more waiting already
+        if sent + failed < args.batch_size:
+            time.sleep(args.interval)
+
+def run_migrate(args) -> int:
+    """
+    Apply (or list) the pending migrations
+    """
+    migrations.migrate(args.dir, dry_run=args.dry_run, log=log)
+    return 0
+
+def run_check_indexes(args) -> int:
+    """
+    Check that the server's queries can use indexes
+    """
+    with Transaction() as cursor:
+        passed = migrations.check_indexes(cursor, log=print)
+    return 0 if passed else 1
+
+def run_check_totals(args) -> int:
+    """
+    Check (and optionally repair) the totals stored with each cfr
+    """
+    with Transaction() as cursor:
+        mismatches = db_utils.check_cfr_totals(cursor, repair=args.repair)
+    for (dept_name, semester, cal_year, revision_num) in mismatches:
+        log(f"Wrong totals: {dept_name} {semester} {cal_year} revision {revision_num}")
+    if len(mismatches) == 0:
+        log("All totals are correct.")
+        return 0
+    if args.repair:
+        log(f"Repaired the totals of {len(mismatches)} cfrs")
+        return 0
+    return 1
+
+def run_slow_queries(args) -> int:
+    """
+    Report the queries in the slow query log that took the most time
+    """
+    path = args.log or slow_queries.log_path()
+    entries = slow_queries.read_log(path)
+    if len(entries) == 0:
+        log(f"There are no slow queries in {path}")
+        return 0
+    print(f"{len(entries)} slow queries from {entries[0]['time']} to {entries[-1]['time']}")
+    print(f"{'query':<36}{'count':>8}{'total ms':>12}{'avg ms':>10}{'max ms':>10}{'scans':>8}")
+    for summary in slow_queries.summarize(entries)[:args.top]:
+        print(f"{summary['query']:<36}{summary['count']:>8}{summary['total_ms']:>12.1f}"
+              f"{summary['avg_ms']:>10.1f}{summary['max_ms']:>10.1f}{summary['scans']:>8}")
+    return 0
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Tools for the CFR system")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    outbox = commands.add_parser('outbox', help="deliver queued email notifications")
+    outbox.add_argument('--once', action='store_true',
+        help="deliver one batch and exit instead of running forever")
+    outbox.add_argument('--interval', type=float, default=DEFAULT_OUTBOX_INTERVAL,
+        help="seconds to wait between checks when the outbox is empty")
+    outbox.add_argument('--batch-size', type=int, default=email_notification.DEFAULT_BATCH_SIZE,
+        help="maximum number of emails to send at once")
+    outbox.set_defaults(run=run_outbox)
+
+    migrate = commands.add_parser('migrate', help="apply pending schema migrations")
+    migrate.add_argument('--dir', default=migrations.MIGRATIONS_DIR,
+        help="directory containing the migrations (default: %(default)s)")
+    migrate.add_argument('--dry-run', action='store_true',
+        help="only list the migrations that would be applied")
+    migrate.set_defaults(run=run_migrate)
+
+    check_indexes = commands.add_parser('check-indexes', help="check that queries use indexes")
+    check_indexes.set_defaults(run=run_check_indexes)
+
+    check_totals = commands.add_parser('check-totals', help="check the totals stored with each cfr")
+    check_totals.add_argument('--repair', action='store_true',
+        help="recompute the totals of every cfr if any are wrong")
+    check_totals.set_defaults(run=run_check_totals)
+
+    slow = commands.add_parser('slow-queries', help="report the slowest queries in the slow query log")
+    slow.add_argument('--log', help="path of the log (default: SLOW_QUERY_LOG from the environment)")
+    slow.add_argument('--top', type=int, default=20,
+        help="number of queries to report (default: %(default)s)")
+    slow.set_defaults(run=run_slow_queries)
+
+    args = parser.parse_args()
+
+    cfrenv.init_environ({})
+    if not cfrenv.verify_environ():
+        log("The CFR environment is missing required variables (see cfr.env)")
+        return 1
+
+    try:
+        return args.run(args)
+    except KeyboardInterrupt:
+        return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+// Functions for the previous semesters page
+
+/**
+ * Build a read-only table of courses, matching the ones
+ * that the server builds for the first tab.
+ * @param {string[]} headers The headers for each column
+ * @param {string[][]} courses The cells of each row
+ */
+function buildHistoryTable(headers, courses) {
+    table = document.createElement('table');
+    table.className = "table table-bordered table-striped";
+    table.style.paddingBottom = "50px";
+
+    head = table.createTHead();
+    headRow = head.insertRow(-1);
+    for (i = 0; i < headers.length; i++) {
+        th = document.createElement('th');
+        th.textContent = headers[i];
+        headRow.appendChild(th);
+    }
+
+    body = table.createTBody();
+    for (i = 0; i < courses.length; i++) {
+        row = body.insertRow(-1);
+        for (j = 0; j < courses[i].length; j++) {
+            row.insertCell(-1).textContent = courses[i][j];
+        }
+    }
+    return table;
+}
+
+/**
+ * Replace a placeholder with the revision history
+ * loaded from the URL in its 'data-history-url' attribute.
+ * Does nothing if the placeholder has already been loaded.
+ * @param {HTMLElement} placeholder 
+ */
+function loadHistory(placeholder) {
+    if (placeholder.getAttribute('data-loaded'))
+        return;
+    placeholder.setAttribute('data-loaded', 'true');
+
+    req = new XMLHttpRequest();
+    req.onreadystatechange = function() {
+        if (this.readyState == 4) {
+            if (this.status == 200) {
+                data = JSON.parse(this.response);
+                placeholder.textContent = "";
+                if (data.revisions.length == 0) {
+                    placeholder.textContent = "No revisions available.";
+                    return;
+                }
+                for (r = 0; r < data.revisions.length; r++) {
+                    header = document.createElement('h3');
+                    header.textContent = "Revision " + (data.revisions.length - r);
+                    placeholder.appendChild(header);
+                    placeholder.appendChild(buildHistoryTable(data.headers, data.revisions[r]));
+                }
+            }
+            else {
+                placeholder.removeAttribute('data-loaded');
+                placeholder.textContent = "Something went wrong loading this semester! Server returned: "+this.status;
+            }
+        }
+    }
+    req.open('GET', placeholder.getAttribute('data-history-url'), true);
+    req.send();
+}
+
+// Load the history for a tab the first time it is opened
+document.addEventListener('DOMContentLoaded', function() {
+    links = document.querySelectorAll('#tabbed-nav a[data-toggle="tab"]');
+    for (i = 0; i < links.length; i++) {
+        links[i].addEventListener('click', function() {
+            pane = document.getElementById(this.getAttribute('aria-controls'));
+            placeholder = pane.querySelector('[data-history-url]');
+            if (placeholder)
+                loadHistory(placeholder);
+        });
+    }
+});
@@ -2,18 +2,37 @@
 Functions related to user authentication. Also contains the
 User class to represent a logged-in user.
 
-TODO: Hashing passwords in the database and saving logins to the client
-with cookies is reasonably secure, but we should use something more secure
-if this system ever makes it to large-scale use.
+Once a user logs in, they are given a session: a random token that is
+stored in a cookie on the client and (hashed) in the session table in
+the database. Later requests are authenticated with the token alone.
+Recently used sessions are also kept in an in-memory cache so that most
+requests do not need to touch the database to authenticate at all.
+
+Since each server process has its own cache, a session that is ended
+in one process (for example, by a password change) may still be accepted
+by other processes for up to SESSION_CACHE_TTL seconds.
 """
 import hashlib
+import secrets
 import http.cookies as cookies
 from .sql_connection import Transaction
+from .cache import TTLCache
+from . import cfrenv
 from enum import Enum, auto
 
 # Number of seconds in a day. Used for specifying the Max-Age of cookies
 SECONDS_PER_DAY = 86400
 
+# Name of the cookie that holds the session token
+SESSION_COOKIE = 'session'
+
+# Default number of seconds a session may be cached in memory before
+# checking the database again, and the default maximum number of sessions
+# to keep in memory. (These can be set with SESSION_CACHE_TTL
+# and SESSION_CACHE_SIZE in the CFR environment)
+DEFAULT_SESSION_CACHE_TTL   = 60
+DEFAULT_SESSION_CACHE_SIZE  = 1000
+
 # Query used to select a user from the database.
 # Returns username, type and usr_password
 # Parameters are username and usr_password
@@ -33,6 +52,45 @@ FROM submitter
 WHERE username = %s
 """
 
+# Query to create a new session
+# Parameters are: token_hash, username, lifetime (in seconds)
+INSERT_SESSION = """
+INSERT INTO session (token_hash, username, created, expires)
+VALUES (%s, %s, NOW(), NOW() + INTERVAL %s SECOND)
+"""
+
+# Query to select the user for an unexpired session. Returns the same
+# columns as SELECT_USER_QUERY plus the user's dept_name (which is NULL
+# if they are not a submitter) and the number of seconds left in the session
+# Parameters are: token_hash
+SELECT_SESSION_QUERY = """
+SELECT u.username, u.type, u.usr_password, s.dept_name,
+    TIMESTAMPDIFF(SECOND, NOW(), ses.expires)
+FROM session ses
+    JOIN user u ON u.username = ses.username
+    LEFT JOIN submitter s ON s.username = u.username
+WHERE
+    ses.token_hash = %s AND
+    ses.expires > NOW()
+"""
+
+# Query to end a single session
+# Parameters are: token_hash
+DELETE_SESSION = """
+DELETE FROM session WHERE token_hash = %s
+"""
+
+# Query to end all of a user's sessions
+# Parameters are: username
+DELETE_USER_SESSIONS = """
+DELETE FROM session WHERE username = %s
+"""
+
+# Query to clean up sessions that have expired
+DELETE_EXPIRED_SESSIONS = """
+DELETE FROM session WHERE expires <= NOW()
+"""
+
 class UserRole(Enum):
     """
     Enum representation of user roles
@@ -45,10 +103,13 @@ class User:
     """
     Class representing an authenticated user
     """
-    def __init__(self, user_tup: tuple, password):
+    def __init__(self, user_tup: tuple, password = None):
         """
         Initialize a User. user_tup is the tuple
         (OF RAW BYTES) returned by the MySQL cursor.
+
+        password is the plaintext password, which is only known
+        when the user has just logged in with it.
         """
         self.username       = user_tup[0].decode('utf-8')
         self.role           = UserRole[user_tup[1].decode('utf-8').upper()]
@@ -57,6 +118,33 @@ class User:
         # By default, dept_name is None
         # But this may be set if the user is a submitter
         self.dept_name      = None
+        # The token for the user's session. This is set when the
+        # session is created or when the user is authenticated with it
+        self.session_token  = None
+
+# Cache of recently used sessions. Maps the hash of a session
+# token to the User for that session
+_session_cache: TTLCache = None
+
+def _get_session_cache() -> TTLCache:
+    """
+    Get the session cache, creating it the first time this is called
+    """
+    global _session_cache
+    if _session_cache is None:
+        _session_cache = TTLCache(
+            cfrenv.getint('SESSION_CACHE_SIZE', DEFAULT_SESSION_CACHE_SIZE),
+            cfrenv.getint('SESSION_CACHE_TTL', DEFAULT_SESSION_CACHE_TTL),
+            name = 'sessions'
+        )
+    return _session_cache
+
+def hash_token(token: str) -> bytes:
+    """
+    Hash the given session token and return the digest as bytes.
+    Only the hash of a token is ever stored on the server.
+    """
+    return hashlib.sha256(token.encode('utf-8')).digest()
 
 def authenticate(username, password) -> User:
     """
@@ -84,18 +172,89 @@ def authenticate(username, password) -> User:
 
     return user
 
+def _session_token_from_cookie(cookies_header: str) -> str:
+    """
+    Get the session token out of the content of a "Cookie" header,
+    or None if there isn't one.
+    """
+    cookie = cookies.SimpleCookie()
+    try:
+        cookie.load(cookies_header)
+    except cookies.CookieError:
+        return None
+    if SESSION_COOKIE not in cookie or cookie[SESSION_COOKIE].value == '':
+        return None
+    return cookie[SESSION_COOKIE].value
+
 def authenticate_from_cookie(cookies_header: str) -> User:
     """
-    Authenticate with the credintials defined in a http cookie.
+    Authenticate with the session token defined in a http cookie.
     cookies_header is the content of the "Cookie" header given
     in the request. Returns an instance of user if successful,
     otherwise returns None
+
+    Sessions found in the session cache are accepted without touching
+    the database.
     """
-    cookie = cookies.SimpleCookie()
-    cookie.load(cookies_header)
-    username = cookie['username'].value
-    password = cookie['password'].value
-    return authenticate(username, password)
+    token = _session_token_from_cookie(cookies_header)
+    if token is None:
+        return None
+    token_hash = hash_token(token)
+
+    cache = _get_session_cache()
+    user = cache.get(token_hash)
+    if user is not None:
+        return user
+
+    with Transaction(raw=True, buffered=True) as cursor:
+        cursor.execute(SELECT_SESSION_QUERY, (token_hash,))
+        result = cursor.fetchone()
+
+    if result is None:
+        return None
+
+    user = User(result[:3])
+    if result[3] is not None:
+        user.dept_name = result[3].decode('utf-8')
+    user.session_token = token
+    # Never cache a session for longer than it has left
+    cache.put(token_hash, user, ttl = int(result[4]))
+    return user
+
+def create_session(user: User) -> str:
+    """
+    Start a new session for the given user, which lasts for one day,
+    and return its token. The token is also stored in user.session_token
+    """
+    token = secrets.token_urlsafe(32)
+    with Transaction() as cursor:
+        cursor.execute(INSERT_SESSION, (hash_token(token), user.username, SECONDS_PER_DAY))
+        # Take the opportunity to clean up old sessions
+        cursor.execute(DELETE_EXPIRED_SESSIONS)
+    user.session_token = token
+    return token
+
+def end_session(cookies_header: str):
+    """
+    End the session whose token is in the given "Cookie" header
+    (if there is one).
+    """
+    token = _session_token_from_cookie(cookies_header)
+    if token is None:
+        return
+    token_hash = hash_token(token)
+    _get_session_cache().remove(token_hash)
+    with Transaction() as cursor:
+        cursor.execute(DELETE_SESSION, (token_hash,))
+
+def end_user_sessions(cursor, username: str):
+    """
+    End all of the sessions for the user with the given username, using
+    the given cursor. This should be done whenever the user's password
+    changes.
+    """
+    _get_session_cache().remove_where(lambda k, user: user.username == username)
+    cursor.execute(DELETE_USER_SESSIONS, (username,))
 
 def hash_password(plaintext: str) -> bytes:
     """
@@ -107,26 +266,29 @@ def hash_password(plaintext: str) -> bytes:
 
 def create_cookies(user: User) -> str:
     """
-    Returns a list of cookies used to store the user's login credintials.
-    The cookies are set to expire in one day.
+    Start a new session for the given user and return a list of cookies
+    used to store the session token. The cookies are set to expire in one day.
 
     The returned cookies are in the form of a list where each element
     is the content of a 'Set-Cookie' header in the response.
     """
+    token = create_session(user)
     return [
-        "username={}; Max-Age={}".format(user.username, SECONDS_PER_DAY),
-        "password={}; Max-Age={}".format(user.password, SECONDS_PER_DAY)
+        "{}={}; Max-Age={}; Path=/; HttpOnly".format(SESSION_COOKIE, token, SECONDS_PER_DAY)
     ]
 
 def clear_cookies() -> str:
     """
-    Creates a set of cookies to clear the user's creditinals. This is done
+    Creates a set of cookies to clear the user's session. This is done
     by creating cookies with an empty value and a maximum age of 0.
+    (This also clears the cookies that older versions used to store
+    credentials in)
 
     The returned cookies are in the form of a list where each element
     is the content of a 'Set-Cookie' header in the response.
     """
     return [
+        "{}=; Max-Age=0; Path=/; HttpOnly".format(SESSION_COOKIE),
         "username=; Max-Age=0",
         "password=; Max-Age=0"
     ]
\ No newline at end of file
@@ -0,0 +1,96 @@
+"""
+A small, thread-safe, in-process cache used to avoid repeating work
+(such as database lookups) on every request.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+# The caches that were given a name, by name (see named_caches())
+_named_caches = {}
+
+def named_caches() -> dict:
+    """
+    Get every TTLCache that was given a name, as a dictionary
+    mapping the names to the caches. Their hits and misses
+    are exported by metrics.
+    """
+    return dict(_named_caches)
+
+class TTLCache:
+    """
+    A dictionary-like cache where each entry expires after a number
+    of seconds and the least-recently-used entry is evicted once the
+    cache holds more than max_size entries.
+
+    The cache belongs to a single process. Anything that changes the
+    underlying data must remove the affected entries itself.
+
+    hits and misses count the results of get() so that the
+    effectiveness of the cache can be measured. If the cache is given a
+    name, they are exported by metrics under that name.
+    """
+    def __init__(self, max_size: int, ttl: float, name: str = None):
+        self.max_size   = max_size
+        self.ttl        = ttl
+        self.hits       = 0
+        self.misses     = 0
+        self._entries   = OrderedDict() # Maps keys to (expiry time, value)
+        self._lock      = threading.Lock()
+        if name is not None:
+            _named_caches[name] = self
+
+    def get(self, key, default = None):
+        """
+        Get the value stored for the given key, or default if there isn't
+        one or it has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, ttl: float = None):
+        """
+        Store a value for the given key. The entry expires after the
+        cache's ttl, or after the given ttl if it is shorter.
+        """
+        if ttl is None or ttl > self.ttl:
+            ttl = self.ttl
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last = False)
+
+    def remove(self, key):
+        """
+        Remove the entry for the given key if there is one.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def remove_where(self, predicate: callable):
+        """
+        Remove every entry for which predicate (called with the key
+        and value of the entry) returns True.
+        """
+        with self._lock:
+            for key in [k for (k, e) in self._entries.items() if predicate(k, e[1])]:
+                del self._entries[key]
+
+    def clear(self):
+        """
+        Remove every entry from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
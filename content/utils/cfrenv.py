@@ -6,8 +6,8 @@ environ and stored in a dictionary here. This module should be the
 authortative source on the listed variables and other modules should
 get their values from here rather than the WSGI or OS environ.
 
-init_environ() MUST be called with the WSGI environ as an argument
-to initialize the values in here. After initialization, every value
+init_environ() (or load_environ()) MUST be called with the WSGI environ
+as an argument to initialize the values in here. After initialization, every value
 is gaurenteed to exist but may have a value of None. The initialized
 values will look first to the OS environ for variables and use
 the WSGI environ if a variable is not defined there. If a variable
@@ -24,6 +24,69 @@ Optional:
                     to 'yes.' Does nothing if set to anything else
                     or nonexistant
 
+The following variables are optional and control connection pooling.
+If DB_POOL_SIZE is not set (or is 0), every Transaction opens and
+closes its own connection:
+    DB_POOL_SIZE            The maximum number of connections to keep
+                            open in each process
+    DB_POOL_MAX_IDLE        Number of seconds a connection may sit unused
+                            in the pool before it is closed (default 300).
+                            Checked whenever a connection is borrowed or
+                            given back
+    DB_POOL_MAX_LIFETIME    Number of seconds a connection may live before
+                            it is closed and replaced (default 3600)
+
+The following variables are optional and control how logins are cached:
+    SESSION_CACHE_TTL       Number of seconds a session may be remembered
+                            in memory before checking the database again
+                            (default 60)
+    SESSION_CACHE_SIZE      Maximum number of sessions each process
+                            remembers in memory (default 1000)
+
+The following variable is optional and controls how pages are rendered:
+    RENDER_BACKEND          Either 'soup' (the default) to build page
+                            components with BeautifulSoup, or 'string' to
+                            build them directly as strings of html, which
+                            is faster (see component_builder)
+
+The following variables are optional and control how responses are sent:
+    COMPRESSION             If set to 'no', responses are never compressed
+                            (see middleware). Otherwise, text responses are
+                            compressed with gzip, or brotli if the brotli
+                            module is installed and the client accepts it
+    REQUEST_LOG             If set to 'no', the timings of each request are
+                            not written to the error log (see
+                            instrumentation). They are never logged when
+                            DEBUG is 'yes', since they are sent in a
+                            Server-Timing header instead
+
+The following variables are optional and control the /metrics page
+(see metrics):
+    METRICS_ALLOWED_IPS     A comma-separated list of the IP addresses and
+                            networks (such as 10.0.0.0/8) that may see the
+                            page (default '127.0.0.1, ::1')
+    METRICS_DIR             A directory that every server process can write
+                            to, where each process keeps its counts so that
+                            they can be added up. Needed whenever the server
+                            runs more than one process
+
+The following variables are optional and control the slow query log
+(see slow_queries), which is off unless SLOW_QUERY_MS is set:
+    SLOW_QUERY_MS           Queries that take at least this many
+                            milliseconds are logged
+    SLOW_QUERY_LOG          The path of the log (default
+                            cfr_slow_queries.log in the temp directory)
+    SLOW_QUERY_LOG_SIZE     Size in bytes that the log may reach before it
+                            is rotated (default 10MB)
+
+The following variable is optional and controls how new cfr revisions
+are stored (existing revisions are read correctly either way):
+    REVISION_STORAGE        Either 'full' (the default) to link every
+                            course and salary savings entry to every
+                            revision, or 'delta' to record only the ones
+                            added and removed since the previous revision
+                            (see db_utils.resolve_revision())
+
 The following variables are optional, but if any of them are excluded,
 then email notifications will not work:
     SMTP_SERVER     The hostname of the smtp server to send email from
@@ -31,12 +94,22 @@ then email notifications will not work:
     SMTP_PASSWORD   The password for this address on the SMTP server
     SMTP_PORT       The port to connect to the SMTP server
 
+Emails are sent by the outbox worker (see manage.py) rather than by the
+server itself. The worker also uses this optional variable:
+    SMTP_PLAIN      If set to 'yes', connect to the SMTP server without
+                    STARTTLS and without logging in (so SMTP_PASSWORD
+                    is not needed). This is only meant for testing with
+                    a local server such as aiosmtpd
+
 """
 
 import os
 
 environ = {}
 
+# Whether init_environ() has been called in this process
+_loaded = False
+
 def _init_var(varname: str, wsgi_environ: dict):
     """
     Initialize a variable with the given name.
@@ -56,17 +129,48 @@ def init_environ(wsgi_environ: dict):
     After initialization, every value is gaurenteed to exist 
     but may have a value of None.
     """
+    global _loaded
     _init_var('DB_HOST',        wsgi_environ)
     _init_var('DB_USER',        wsgi_environ)
     _init_var('DB_PASS',        wsgi_environ)
     _init_var('DB_DATABASE',    wsgi_environ)
 
+    _init_var('DB_POOL_SIZE',           wsgi_environ)
+    _init_var('DB_POOL_MAX_IDLE',       wsgi_environ)
+    _init_var('DB_POOL_MAX_LIFETIME',   wsgi_environ)
+
+    _init_var('SESSION_CACHE_TTL',      wsgi_environ)
+    _init_var('SESSION_CACHE_SIZE',     wsgi_environ)
+
+    _init_var('RENDER_BACKEND',         wsgi_environ)
+    _init_var('REVISION_STORAGE',       wsgi_environ)
+    _init_var('COMPRESSION',            wsgi_environ)
+    _init_var('REQUEST_LOG',            wsgi_environ)
+    _init_var('METRICS_ALLOWED_IPS',    wsgi_environ)
+    _init_var('METRICS_DIR',            wsgi_environ)
+    _init_var('SLOW_QUERY_MS',          wsgi_environ)
+    _init_var('SLOW_QUERY_LOG',         wsgi_environ)
+    _init_var('SLOW_QUERY_LOG_SIZE',    wsgi_environ)
+
     _init_var('DEBUG',          wsgi_environ)
 
     _init_var('SMTP_SERVER',    wsgi_environ)
     _init_var('SMTP_ADDRESS',   wsgi_environ)
     _init_var('SMTP_PASSWORD',  wsgi_environ)
     _init_var('SMTP_PORT',      wsgi_environ)
+    _init_var('SMTP_PLAIN',     wsgi_environ)
+
+    _loaded = True
+
+def load_environ(wsgi_environ: dict):
+    """
+    Initialize the variables in the CFR environment (as in init_environ())
+    if they have not already been initialized in this process. The web
+    server calls this on every request, but the variables are only
+    looked up for the first one.
+    """
+    if not _loaded:
+        init_environ(wsgi_environ)
 
 def getenv(varname):
     """
@@ -78,6 +182,20 @@ def getenv(varname):
     else:
         return None
 
+def getint(varname, default: int = None) -> int:
+    """
+    Get the value for the variable with the given name from
+    the CFR environment as an integer. If the variable does not
+    exist or is not a valid integer, default is returned instead.
+    """
+    value = getenv(varname)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
 def verify_environ() -> bool:
     """
     Verify that all required environment variables are present
@@ -95,13 +213,15 @@ def verify_environ() -> bool:
 def can_do_email() -> bool:
     """
     Verify that all email-related environment variables are
-    present and not None.
+    present and not None. (SMTP_PASSWORD is not needed when
+    SMTP_PLAIN is 'yes', since the worker does not log in)
     """
     valid = True
 
     valid = valid and environ['SMTP_SERVER'] is not None
     valid = valid and environ['SMTP_ADDRESS'] is not None
-    valid = valid and environ['SMTP_PASSWORD'] is not None
+    if environ['SMTP_PLAIN'] != 'yes':
+        valid = valid and environ['SMTP_PASSWORD'] is not None
     valid = valid and environ['SMTP_PORT'] is not None
 
     return valid
\ No newline at end of file
@@ -1,6 +1,18 @@
 """
 Functions for constructing various HTML elements and components
 for use in pages
+
+Many of the builders here can use one of two rendering backends,
+chosen with their 'backend' argument:
+    SOUP_BACKEND    Builds the component out of BeautifulSoup tags
+                    and returns it as a Tag or a BeautifulSoup
+    STRING_BACKEND  Builds the component as escaped strings of html
+                    (see markup.py) and returns it as markup.Markup,
+                    which is much faster for large tables
+Both backends produce exactly the same html, and the result of either
+one can be appended to or inserted into a BeautifulSoup. If no backend
+is given, the one named by RENDER_BACKEND in the CFR environment
+is used (or SOUP_BACKEND if that is not set).
 """
 from bs4 import BeautifulSoup as Soup
 from bs4 import Tag
@@ -8,6 +20,12 @@ from .authentication import User
 from . import request
 from . import page_builder
 from . import db_utils
+from . import cfrenv
+from . import markup
+
+# The names of the rendering backends
+SOUP_BACKEND = 'soup'
+STRING_BACKEND = 'string'
 
 # User-readable headers for the read-only version of a course table
 # These should map to the fields of db_utils.REQ_FIELDS
@@ -25,6 +43,10 @@ COURSE_TABLE_HEADERS = [
     "Reason"
 ]
 
+# User-readable headers for a table of the changes made in one
+# revision (see build_revision_diffs)
+REVISION_DIFF_HEADERS = ["Change"] + COURSE_TABLE_HEADERS
+
 # User-readable headers for the course approval table that the
 # approvers will see, with columns for approving individual courses
 COURSE_APPROVAL_HEADERS = [
@@ -73,10 +95,20 @@ TABLE_BUTTON = """
 <button class="btn btn-primary" style="margin:3px"></button>
 """
 
+def _use_strings(backend: str) -> bool:
+    """
+    Return whether or not the given backend (or the default backend,
+    if backend is None) is STRING_BACKEND
+    """
+    if backend is None:
+        backend = cfrenv.getenv('RENDER_BACKEND')
+    return backend == STRING_BACKEND
+
 def build_option_list(
     names: list,
     value_accessor = (lambda n, i: n),
-    selector = (lambda n, i, v: False)
+    selector = (lambda n, i, v: False),
+    backend: str = None
 ) -> Soup:
     """
     Construct a list of option elements (for use inside a select)
@@ -94,6 +126,9 @@ def build_option_list(
     index and value of an option and returns a boolean indicating
     whether or not that option should be marked as selected.
     """
+    if _use_strings(backend):
+        return markup.join(_option_elements(names, value_accessor, selector))
+
     soup = page_builder.soup_from_text("")
     for i in range(len(names)):
         option = soup.new_tag('option')
@@ -105,6 +140,55 @@ def build_option_list(
         soup.append(option)
     return soup
 
+def _option_elements(names: list, value_accessor, selector) -> list:
+    """
+    Render a list of option elements (as in build_option_list)
+    and return them as a list of markup.Html
+    """
+    options = []
+    for i in range(len(names)):
+        value = value_accessor(names[i], i)
+        attrs = {'value': value}
+        if selector(names[i], i, value):
+            attrs['selected'] = 'selected'
+        options.append(markup.element('option', attrs, names[i]))
+    return options
+
+def _select_cell(string: str, names: list, values: list, attrs = {}) -> markup.Html:
+    """
+    Render a table cell containing a select element, which is what
+    replace_cell_with_select makes out of a cell containing the given string.
+    """
+    options = _option_elements(
+        names,
+        value_accessor= (lambda n, i: values[i]),
+        selector= (lambda n, i, v: v == string))
+    return markup.element('td', None, markup.element('select', attrs, options))
+
+def _checkbox_cell(attrs = {}) -> markup.Html:
+    """
+    Render a table cell containing a checkbox, which is what
+    replace_cell_with_checkbox makes out of a cell.
+    """
+    checkbox_attrs = {'type': 'checkbox'}
+    checkbox_attrs.update(attrs)
+    return markup.element('td', {'class': 'noprint'}, markup.element('input', checkbox_attrs))
+
+def _cell(content = "", editable = False) -> markup.Html:
+    """
+    Render a table cell (as in add_cell_to_row)
+    """
+    if editable:
+        return markup.element('td', {'contenteditable': "true", 'class': "editable"}, str(content))
+    return markup.element('td', None, str(content))
+
+def _header_row(headers: list) -> markup.Html:
+    """
+    Render a thead with one row of th elements with the given headers
+    """
+    return markup.element('thead', None, markup.element('tr', None,
+        [markup.element('th', None, header) for header in headers]))
+
 def replace_cell_with_select(cell: Tag, names: list, values: list, attrs = {}):
     """
     Replaces the contents of a table cell with a select element with options
@@ -205,7 +289,7 @@ def add_empty_row(table: Tag, num_cells: int, editable = False) -> Tag:
     table.append(row.tr)
     return table('tr')[-1]
 
-def build_tbody_from_tups(tups: list, editable = False) -> Tag:
+def build_tbody_from_tups(tups: list, editable = False, backend: str = None) -> Tag:
     """
     Build a new tbody element with contents defined by the given list
     of tuples, where each tuple defines one row of the table, and
@@ -214,12 +298,17 @@ def build_tbody_from_tups(tups: list, editable = False) -> Tag:
     editable determines whether or not the user will be able to edit
     the contents of the cells in the table (false by default)
     """
+    if _use_strings(backend):
+        return markup.join([markup.element('tbody', None, [
+            markup.element('tr', None, [_cell(val, editable) for val in tup]) for tup in tups
+        ])])
+
     soup = page_builder.soup_from_text("<tbody></tbody>")
     for tup in tups:
         add_row_from_tuple(soup.tbody, tup, editable=editable)
     return soup.tbody
 
-def build_edit_course_table_body(course_list: list) -> Tag:
+def build_edit_course_table_body(course_list: list, tbody_id: str = None, backend: str = None) -> Tag:
     """
     Build the tbody for an editable table of courses defined
     in course_list and return the tbody as a tag.
@@ -230,8 +319,22 @@ def build_edit_course_table_body(course_list: list) -> Tag:
     for for the "delete course" option.
 
     If course_list is empty, there will be a single, empty row in the table
-    """
-    body = build_tbody_from_tups(course_list, editable=True)
+
+    If tbody_id is given, it will be the id of the tbody.
+    """
+    if _use_strings(backend):
+        rows = course_list
+        if len(course_list) == 0:
+            rows = [("",) * len(request.REQ_FIELDS)]
+        return markup.join([markup.element('tbody', {'id': tbody_id}, [
+            markup.element('tr', None,
+                [_cell(val, editable=True) for val in row] + [_checkbox_cell({'id': 'checkCFR'})]
+            ) for row in rows
+        ])])
+
+    body = build_tbody_from_tups(course_list, editable=True, backend=SOUP_BACKEND)
+    if tbody_id is not None:
+        body['id'] = tbody_id
     if len(course_list) == 0:
         add_empty_row(body, len(request.REQ_FIELDS), editable=True)
     # Add a new cell with a checkbox to each row
@@ -241,7 +344,7 @@ def build_edit_course_table_body(course_list: list) -> Tag:
 
     return body
 
-def build_view_courses_table(courses_list: list) -> Tag:
+def build_view_courses_table(courses_list: list, backend: str = None) -> Tag:
     """
     Build the table element for a read-only table of courses defined
     in course_list and return the table as a tag
@@ -250,6 +353,8 @@ def build_view_courses_table(courses_list: list) -> Tag:
     fields described in db_utils.REQ_FIELDS. The returned table will
     have headers corresponding to COURSE_TABLE_HEADERS
     """
+    if _use_strings(backend):
+        return markup.join([_view_table(COURSE_TABLE_HEADERS, courses_list)])
 
     # Build table
     soup = page_builder.soup_from_text("<table></table>")
@@ -276,7 +381,19 @@ def build_view_courses_table(courses_list: list) -> Tag:
 
     return soup.table
 
-def build_view_savings_table(savings_list: list) -> Tag:
+def _view_table(headers: list, tups: list) -> markup.Html:
+    """
+    Render a read-only table (as in build_view_courses_table) with
+    the given headers and one row for each tuple in tups.
+    """
+    return markup.element('table', {'class': "table table-bordered table-striped", 'style': "padding-bottom: 50px"}, [
+        _header_row(headers),
+        markup.element('tbody', None, [
+            markup.element('tr', None, [_cell(val) for val in tup]) for tup in tups
+        ])
+    ])
+
+def build_view_savings_table(savings_list: list, backend: str = None) -> Tag:
     """
     Build the table element for a read-only table of savings defined
     in savings_list and return the table as a tag
@@ -285,6 +402,8 @@ def build_view_savings_table(savings_list: list) -> Tag:
     fields described in db_utils.SAL_FIELDS. The returned table will
     have headers corresponding to SAVINGS_HEADERS
     """
+    if _use_strings(backend):
+        return markup.join([_view_table(SAVINGS_HEADERS, savings_list)])
 
     # Build table
     soup = page_builder.soup_from_text("<table></table>")
@@ -311,7 +430,7 @@ def build_view_savings_table(savings_list: list) -> Tag:
 
     return soup.table
 
-def build_edit_savings_table_body(savings_list: list) -> Tag:
+def build_edit_savings_table_body(savings_list: list, tbody_id: str = None, backend: str = None) -> Tag:
     """
     Build the tbody for an editable table of salary savings defined
     in savings_list and return the tbody as a tag.
@@ -322,8 +441,27 @@ def build_edit_savings_table_body(savings_list: list) -> Tag:
     for for the "delete entry" option.
 
     If savings_list is empty, there will be a single, empty row in the table
+
+    If tbody_id is given, it will be the id of the tbody.
     """
-    body = build_tbody_from_tups(savings_list)
+    if _use_strings(backend):
+        if len(savings_list) == 0:
+            rows = [("",) * len(request.SAL_FIELDS)]
+            editable = True
+        else:
+            rows = savings_list
+            editable = False
+        return markup.join([markup.element('tbody', {'id': tbody_id}, [
+            markup.element('tr', None,
+                [_select_cell(str(row[0]), LEAVE_TYPE_NAMES, LEAVE_TYPE_VALUES, attrs= {'class': 'form-control'})] +
+                [_cell(val, editable=editable) for val in row[1:]] +
+                [_checkbox_cell()]
+            ) for row in rows
+        ])])
+
+    body = build_tbody_from_tups(savings_list, backend=SOUP_BACKEND)
+    if tbody_id is not None:
+        body['id'] = tbody_id
     if len(savings_list) == 0:
         add_empty_row(body, len(request.SAL_FIELDS), editable=True)
     # Add a new cell with a checkbox to each row
@@ -341,7 +479,7 @@ def build_edit_savings_table_body(savings_list: list) -> Tag:
 
     return body
 
-def build_approve_table_body(summary: list):
+def build_approve_table_body(summary: list, backend: str = None):
     """
     Build the tbody of the main table for the approver course funding request page.
 
@@ -353,9 +491,35 @@ def build_approve_table_body(summary: list):
     This summary can be gotten as the 'summary' element of the dict returned
     by db_utils.get_approver_data()
     """
+    if _use_strings(backend):
+        rows = []
+        for (index, tup) in enumerate(summary):
+            approved = tup[5]
+            if approved:
+                src = "/static/images/check.png"
+                action = "Already approved"
+            else:
+                src = "/static/images/x.png"
+                action = markup.join([
+                    "\n",
+                    markup.element('button', {
+                        'class': "btn btn-primary",
+                        'style': "margin:3px",
+                        'onclick': f"summonModal(\"modal_cfr_{index}\")"
+                    }, "Approve Courses"),
+                    "\n"
+                ])
+            rows.append(markup.element('tr', None,
+                [_cell(val) for val in tup[:3]] +
+                [_cell(tup[3], editable=True)] +
+                [_cell(val) for val in tup[4:-1]] +
+                [markup.element('td', None, markup.element('img', {'height': "30px", 'src': src}))] +
+                [markup.element('td', None, action)]
+            ))
+        return markup.join([markup.element('tbody', None, rows)])
 
     # Create the table rows from the summary
-    body = build_tbody_from_tups(summary)
+    body = build_tbody_from_tups(summary, backend=SOUP_BACKEND)
 
     index = 0
     # Iterate through each row
@@ -394,7 +558,7 @@ def build_approve_table_body(summary: list):
 
     return body
 
-def build_approve_course_table(course_list: list) -> Tag:
+def build_approve_course_table(course_list: list, backend: str = None) -> Tag:
     """
     Build the "Approve Courses" table that the approver uses to 
     approve and set commitment codes for courses.
@@ -406,6 +570,20 @@ def build_approve_course_table(course_list: list) -> Tag:
     Tuples like these can be gotten as the elements of the 'course_lists'
     elements in the dict returned by db_utils.get_approver_data()
     """
+    if _use_strings(backend):
+        rows = []
+        for course in course_list:
+            rows.append(markup.element('tr', None,
+                [_cell(val) for val in course[:9]] +
+                [_cell(course[9], editable=True)] +
+                [_cell(course[10])] +
+                [_select_cell(str(course[12]), COMMITMENT_CODES, COMMITMENT_CODES, attrs= {'class': 'form-control'})] +
+                [_checkbox_cell()]
+            ))
+        return markup.join([markup.element('table', {'class': 'table table-bordered table-striped', 'style': 'padding-bottom: 50px'}, [
+            _header_row(COURSE_APPROVAL_HEADERS),
+            markup.element('tbody', None, rows)
+        ])])
 
     # Build table
     soup = page_builder.soup_from_text("<table></table>")
@@ -452,7 +630,7 @@ def build_approve_course_table(course_list: list) -> Tag:
 
     return soup.table
 
-def build_revision_history(course_lists: list) -> Soup:
+def build_revision_history(course_lists: list, backend: str = None) -> Soup:
     """
     Build a series of tables representing the revisions defined
     in course_lists and return it as a Soup.
@@ -465,6 +643,15 @@ def build_revision_history(course_lists: list) -> Soup:
     The returned soup contains headers labeling the tables as revisions
     in reverse-chronologial order.
     """
+    if _use_strings(backend):
+        if len(course_lists) == 0:
+            return markup.join(["No revisions available."])
+        parts = []
+        for i in range(len(course_lists)):
+            parts.append(markup.element('h3', None, f"Revision {len(course_lists) - i}"))
+            parts.append(_view_table(COURSE_TABLE_HEADERS, course_lists[i]))
+        return markup.join(parts)
+
     soup = page_builder.soup_from_text("")
 
     if len(course_lists) == 0:
@@ -475,12 +662,141 @@ def build_revision_history(course_lists: list) -> Soup:
             header.string = f"Revision {len(course_lists) - i}"
             soup.append(header)
 
-            table = build_view_courses_table(course_lists[i])
+            table = build_view_courses_table(course_lists[i], backend=SOUP_BACKEND)
             soup.append(table)
 
     return soup
 
-def build_modal(title: str, modal_id: str, content) -> Tag:
+def iter_revision_history(course_lists: list, backend: str = None):
+    """
+    Build the same revision history as build_revision_history, but yield
+    it one revision (a header and its table) at a time, so that a page
+    can be streamed to the client while the later revisions are still
+    being built (see page_builder.PageStream).
+    """
+    if len(course_lists) == 0:
+        yield build_revision_history(course_lists, backend=backend)
+        return
+
+    for i in range(len(course_lists)):
+        label = f"Revision {len(course_lists) - i}"
+        if _use_strings(backend):
+            yield markup.join([
+                markup.element('h3', None, label),
+                _view_table(COURSE_TABLE_HEADERS, course_lists[i])
+            ])
+            continue
+
+        soup = page_builder.soup_from_text("")
+        header = soup.new_tag('h3')
+        header.string = label
+        soup.append(header)
+        soup.append(build_view_courses_table(course_lists[i], backend=SOUP_BACKEND))
+        yield soup
+
+def _diff_rows(diff: dict) -> list:
+    """
+    Get the rows of the table for one of the revision diffs from
+    db_utils.get_revision_diffs(), as tuples with values corresponding
+    to REVISION_DIFF_HEADERS
+    """
+    rows = [("Added",) + tuple(course) for course in diff['added']]
+    rows += [("Removed",) + tuple(course) for course in diff['removed']]
+    for (before, after, fields) in diff['changed']:
+        rows.append(("Before",) + tuple(before))
+        rows.append(("After",) + tuple(after))
+    return rows
+
+def _diff_summary(diff: dict) -> str:
+    """
+    Get a sentence describing how many courses changed in one of the
+    revision diffs from db_utils.get_revision_diffs()
+    """
+    return (f"{len(diff['added'])} added, {len(diff['removed'])} removed, "
+        f"{len(diff['changed'])} changed, {diff['unchanged']} unchanged")
+
+def build_revision_diffs(diffs: list, backend: str = None) -> Soup:
+    """
+    Build a series of tables showing only the courses that changed in
+    each revision and return it as a Soup.
+
+    diffs is a list as returned by db_utils.get_revision_diffs() (latest
+    revision first). Each revision gets a header (labeled as in
+    build_revision_history), a summary of how many courses changed and,
+    if any did, a table with one row for each added or removed course and
+    two rows (before and after) for each changed course.
+    """
+    if _use_strings(backend):
+        if len(diffs) == 0:
+            return markup.join(["No revisions available."])
+        parts = []
+        for i in range(len(diffs)):
+            parts.append(markup.element('h3', None, f"Revision {len(diffs) - i}"))
+            parts.append(markup.element('p', None, _diff_summary(diffs[i])))
+            rows = _diff_rows(diffs[i])
+            if len(rows) > 0:
+                parts.append(_view_table(REVISION_DIFF_HEADERS, rows))
+        return markup.join(parts)
+
+    soup = page_builder.soup_from_text("")
+
+    if len(diffs) == 0:
+        soup.append("No revisions available.")
+        return soup
+
+    for i in range(len(diffs)):
+        header = soup.new_tag('h3')
+        header.string = f"Revision {len(diffs) - i}"
+        soup.append(header)
+
+        summary = soup.new_tag('p')
+        summary.string = _diff_summary(diffs[i])
+        soup.append(summary)
+
+        rows = _diff_rows(diffs[i])
+        if len(rows) == 0:
+            continue
+
+        # Build table
+        table = soup.new_tag('table')
+        table['class'] = "table table-bordered table-striped"
+        table['style'] = "padding-bottom: 50px"
+
+        # Build thead
+        head = soup.new_tag('thead')
+        row = soup.new_tag('tr')
+        head.append(row)
+        for header in REVISION_DIFF_HEADERS:
+            cell = soup.new_tag('th')
+            cell.string = header
+            row.append(cell)
+        table.append(head)
+
+        # Build tbody
+        body = soup.new_tag('tbody')
+        table.append(body)
+        for row in rows:
+            add_row_from_tuple(body, row)
+        soup.append(table)
+
+    return soup
+
+def build_lazy_placeholder(url: str, backend: str = None) -> Tag:
+    """
+    Build a placeholder for content that will be loaded by the client
+    later and return it as a tag.
+
+    url is the address the client should load the content from. It is
+    stored in the placeholder's 'data-history-url' attribute.
+    """
+    if _use_strings(backend):
+        return markup.join([markup.element('div', {'class': "lazy-placeholder", 'data-history-url': url}, "Loading...")])
+    soup = page_builder.soup_from_text('<div class="lazy-placeholder"></div>')
+    soup.div['data-history-url'] = url
+    soup.div.string = "Loading..."
+    return soup.div
+
+def build_modal(title: str, modal_id: str, content, backend: str = None) -> Tag:
     """
     Build a modal and return it as a tag.
 
@@ -490,6 +806,17 @@ def build_modal(title: str, modal_id: str, content) -> Tag:
 
     Every modal contains a "Close" button in its footer
     """
+    if _use_strings(backend):
+        return markup.join([markup.element('div', {'class': "modal", 'id': modal_id},
+            markup.element('div', {'class': 'modal-content'}, [
+                markup.element('div', {'class': 'modal-header'}, markup.element('h1', None, title)),
+                markup.element('div', {'class': 'modal-body'}, content),
+                markup.element('div', {'class': 'modal-footer'}, markup.element('button', {
+                    'class': 'btn btn-default',
+                    'onclick': f"dismissModal(\"{modal_id}\")"
+                }, 'Close'))
+            ])
+        )])
 
     # Build modal div
     soup = page_builder.soup_from_text("<div class=\"modal\"></div>")
@@ -527,7 +854,7 @@ def build_modal(title: str, modal_id: str, content) -> Tag:
     soup.div.append(content_div)
     return soup.div
 
-def build_tabs(content_list: list, tab_names: list, tab_ids: list) -> Tag:
+def build_tabs(content_list: list, tab_names: list, tab_ids: list, backend: str = None) -> Tag:
     """
     Build a tab pane element from the given content with the given names
     and return it as a tag.
@@ -537,6 +864,34 @@ def build_tabs(content_list: list, tab_names: list, tab_ids: list) -> Tag:
     tab_names is the user-readable names that will label each tab.
     tab_ids are the internal names used to identify each tab.
     """
+    if _use_strings(backend):
+        tabs = []
+        panes = []
+        for i in range(min([len(content_list), len(tab_names), len(tab_ids)])):
+            link_attrs = {
+                'href': '#'+tab_ids[i],
+                'aria-controls': tab_ids[i],
+                'role': 'tab',
+                'data-toggle': 'tab'
+            }
+            pane_attrs = {
+                'role': 'tabpanel',
+                'class': 'tab-pane fade',
+                'id': tab_ids[i]
+            }
+            if i == 0:
+                pane_attrs['class'] = 'tab-pane fade in active'
+                link_attrs['class'] = 'active'
+            tabs.append(markup.element('li', {'role': 'presentation'}, markup.element('a', link_attrs, tab_names[i])))
+            panes.append(markup.element('div', pane_attrs, content_list[i]))
+
+        # The nav and content are placed after the (empty) tabs div
+        return markup.join([
+            markup.element('div', {'id': "tabs"}),
+            markup.element('div', {'id': 'tabbed-nav', 'class': 'noprint'},
+                markup.element('ul', {'class': 'nav nav-tabs', 'role': 'tablist'}, tabs)),
+            markup.element('div', {'class': 'tab-content padded-15'}, panes)
+        ])
     soup = page_builder.soup_from_text('<div id="tabs"></div>')
 
     tabnav = soup.new_tag('div')
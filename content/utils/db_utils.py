@@ -21,6 +21,9 @@ with it very dynamically.
 from .authentication import User
 from mysql.connector.cursor import CursorBase
 from .sql_connection import Transaction
+from .cache import TTLCache
+from . import cfrenv
+from . import refcache
 
 # Definition of all the fields in a course request.
 # These should correspond to the field names in the database
@@ -107,8 +110,8 @@ SELECT_SAVINGS = (
 # Parameters are: dept_name, semester, cal_year and revision_num
 SELECT_TOTAL_SAVINGS = """
 SELECT SUM(s.savings), SUM(s.confirmed_amt)
-FROM sal_savings s, cfr_request c
-WHERE s.id = c.course_id AND
+FROM sal_savings s, cfr_savings c
+WHERE s.id = c.savings_id AND
     c.dept_name = %s AND
     c.semester = %s AND
     c.cal_year = %s AND
@@ -160,21 +163,437 @@ SELECT_REVISIONS = """
     ORDER BY revision_num DESC
 """
 
+# Query to select all of the cfr revisions for a department
+# in every semester
+# Returned columns are: dept_name, semester, cal_year, date_initial,
+#   date_revised, revision_num, cfr_submitter and dean_committed
+# Parameters are: dept_name
+SELECT_ALL_REVISIONS = """
+    SELECT dept_name,
+        semester,
+        cal_year,
+        date_initial,
+        date_revised,
+        revision_num,
+        cfr_submitter,
+        dean_committed
+    FROM cfr_department
+    WHERE dept_name = %s
+    ORDER BY cal_year, semester, revision_num DESC
+"""
+
+# Query to select the courses of every cfr revision for a department
+# in a semester, labeled with the revision they belong to.
+# Returned columns are: semester, cal_year, revision_num and then
+#   the fields in REQ_FIELDS
+# Parameters are: dept_name, semester, cal_year
+SELECT_SEMESTER_REVISION_COURSES = (
+    "SELECT c.semester, c.cal_year, c.revision_num, "+(", ".join("r."+f for f in REQ_FIELDS))+" "
+    "FROM request r, cfr_request c "
+    "WHERE r.id = c.course_id AND "
+    "c.dept_name = %s AND "
+    "c.semester = %s AND "
+    "c.cal_year = %s "
+    "ORDER BY r.id"
+)
+
+# Query to select the courses of every cfr revision for a department
+# in every semester, labeled with the revision they belong to.
+# Returned columns are: semester, cal_year, revision_num and then
+#   the fields in REQ_FIELDS
+# Parameters are: dept_name
+SELECT_ALL_REVISION_COURSES = (
+    "SELECT c.semester, c.cal_year, c.revision_num, "+(", ".join("r."+f for f in REQ_FIELDS))+" "
+    "FROM request r, cfr_request c "
+    "WHERE r.id = c.course_id AND "
+    "c.dept_name = %s "
+    "ORDER BY r.id"
+)
+
 # Query to insert a new entry into the cfr_department table.
 # This is meant to be used for the first revision of a semester.
 # If you're adding a new revision to a previous cfr, use the NEW_REVISION query.
-# Parameters are: semester, cal_year, date_initial and cfr_submitter
+# Parameters are: dept_name, semester, cal_year, cfr_submitter and storage
 NEW_CFR_DEPT = """
 INSERT INTO cfr_department
-VALUES (%s, %s, %s, NOW(), NULL, 0, %s, 0)
+    (dept_name, semester, cal_year, date_initial, date_revised,
+    revision_num, cfr_submitter, dean_committed, storage)
+VALUES (%s, %s, %s, NOW(), NULL, 0, %s, 0, %s)
 """
 
 # Query to insert a new entry into the cfr_department table
 # as a new revision to a previous cfr
-# Parameters are: semester, cal_year, date_initial, revision_num, cfr_submitter and dean_committed
+# Parameters are: dept_name, semester, cal_year, date_initial, revision_num,
+#   cfr_submitter, dean_committed and storage
 NEW_REVISION = """
 INSERT INTO cfr_department
-VALUES (%s, %s, %s, %s, NOW(), %s, %s, %s)
+    (dept_name, semester, cal_year, date_initial, date_revised,
+    revision_num, cfr_submitter, dean_committed, storage)
+VALUES (%s, %s, %s, %s, NOW(), %s, %s, %s, %s)
+"""
+
+# The ways a revision's courses and savings can be stored
+# (see REVISION_STORAGE in cfrenv and resolve_revision())
+FULL_STORAGE = 'full'
+DELTA_STORAGE = 'delta'
+
+# The kinds of rows that belong to a revision
+COURSE_ROWS = 'courses'
+SAVINGS_ROWS = 'savings'
+
+# Query to get how a cfr is stored
+# Returned columns are: storage, materialized
+# Parameters are: dept_name, semester, cal_year, revision_num
+SELECT_CFR_STORAGE = """
+SELECT storage, materialized
+FROM cfr_department
+WHERE dept_name = %s AND
+    semester = %s AND
+    cal_year = %s AND
+    revision_num = %s
+"""
+
+# Query to get how every revision of a department's cfr in a semester is stored
+# Returned columns are: revision_num, materialized
+# Parameters are: dept_name, semester, cal_year
+SELECT_SEMESTER_STORAGE = """
+SELECT revision_num, materialized
+FROM cfr_department
+WHERE dept_name = %s AND
+    semester = %s AND
+    cal_year = %s
+ORDER BY revision_num
+"""
+
+# Query to mark a cfr as no longer being materialized
+# (once its courses and savings have been moved to the next revision)
+# Parameters are: dept_name, semester, cal_year, revision_num
+UNMATERIALIZE_CFR = """
+UPDATE cfr_department
+SET materialized = 'no'
+WHERE dept_name = %s AND
+    semester = %s AND
+    cal_year = %s AND
+    revision_num = %s
+"""
+
+# Queries to get the ids of the courses/savings linked to a cfr
+# Returned columns are: course_id/savings_id
+# Parameters are: dept_name, semester, cal_year, revision_num
+SELECT_COURSE_LINKS = """
+SELECT course_id
+FROM cfr_request
+WHERE dept_name = %s AND
+    semester = %s AND
+    cal_year = %s AND
+    revision_num = %s
+"""
+SELECT_SAVINGS_LINKS = """
+SELECT savings_id
+FROM cfr_savings
+WHERE dept_name = %s AND
+    semester = %s AND
+    cal_year = %s AND
+    revision_num = %s
+"""
+
+# Queries to get the ids of the courses/savings linked to every revision
+# of a department's cfr in a semester
+# Returned columns are: revision_num, course_id/savings_id
+# Parameters are: dept_name, semester, cal_year
+SELECT_SEMESTER_COURSE_LINKS = """
+SELECT revision_num, course_id
+FROM cfr_request
+WHERE dept_name = %s AND
+    semester = %s AND
+    cal_year = %s
+"""
+SELECT_SEMESTER_SAVINGS_LINKS = """
+SELECT revision_num, savings_id
+FROM cfr_savings
+WHERE dept_name = %s AND
+    semester = %s AND
+    cal_year = %s
+"""
+
+# Queries to get the courses/savings added to and removed from every
+# 'delta' revision of a department's cfr in a semester
+# Returned columns are: revision_num, course_id/savings_id, change_type
+# Parameters are: dept_name, semester, cal_year
+SELECT_SEMESTER_COURSE_DELTAS = """
+SELECT revision_num, course_id, change_type
+FROM cfr_request_delta
+WHERE dept_name = %s AND
+    semester = %s AND
+    cal_year = %s
+"""
+SELECT_SEMESTER_SAVINGS_DELTAS = """
+SELECT revision_num, savings_id, change_type
+FROM cfr_savings_delta
+WHERE dept_name = %s AND
+    semester = %s AND
+    cal_year = %s
+"""
+
+# Number of resolved revisions (see resolve_revision()) remembered by each
+# process, and for how many seconds
+RESOLVED_CACHE_SIZE = 500
+RESOLVED_CACHE_TTL  = 60 * 60
+
+_resolved = TTLCache(max_size = RESOLVED_CACHE_SIZE, ttl = RESOLVED_CACHE_TTL, name = 'resolved_revisions')
+
+# The queries used by resolve_semester() for each kind of row,
+# as tuples of the query for its links and the query for its deltas
+_RESOLVE_QUERIES = {
+    COURSE_ROWS:    (SELECT_SEMESTER_COURSE_LINKS, SELECT_SEMESTER_COURSE_DELTAS),
+    SAVINGS_ROWS:   (SELECT_SEMESTER_SAVINGS_LINKS, SELECT_SEMESTER_SAVINGS_DELTAS),
+}
+
+# Queries to select courses/savings (or their approval information) by id.
+# Formatted with one "%s" for each id (separated by commas)
+# Returned columns are: id and then the fields in REQ_FIELDS (SELECT_COURSES_BY_ID),
+#   approver and commitment_code (SELECT_COURSE_APPROVALS_BY_ID) or
+#   the fields in SAL_FIELDS (SELECT_SAVINGS_BY_ID)
+# Parameters are: each id
+SELECT_COURSES_BY_ID = (
+    "SELECT id, "+(", ".join(REQ_FIELDS))+" "
+    "FROM request "
+    "WHERE id IN ({}) "
+    "ORDER BY id"
+)
+SELECT_COURSE_APPROVALS_BY_ID = """
+SELECT approver, commitment_code
+FROM request
+WHERE id IN ({})
+ORDER BY id
+"""
+SELECT_SAVINGS_BY_ID = (
+    "SELECT "+(", ".join(SAL_FIELDS))+" "
+    "FROM sal_savings "
+    "WHERE id IN ({}) "
+    "ORDER BY id"
+)
+
+# Subqueries that compute the totals stored in each row of cfr_department
+# from its courses and salary savings. Each one refers to the cfr_department
+# row as "d", so they can only be used inside of the queries below
+_CFR_COURSES = """
+    FROM request r
+        JOIN cfr_request c ON r.id = c.course_id
+    WHERE c.dept_name = d.dept_name AND
+        c.semester = d.semester AND
+        c.cal_year = d.cal_year AND
+        c.revision_num = d.revision_num
+"""
+_CFR_SAVINGS = """
+    FROM sal_savings s
+        JOIN cfr_savings c ON s.id = c.savings_id
+    WHERE c.dept_name = d.dept_name AND
+        c.semester = d.semester AND
+        c.cal_year = d.cal_year AND
+        c.revision_num = d.revision_num
+"""
+COMPUTED_TOTAL_COST = "(SELECT IFNULL(SUM(r.cost), 0)" + _CFR_COURSES + ")"
+COMPUTED_COURSE_COUNT = "(SELECT COUNT(*)" + _CFR_COURSES + ")"
+COMPUTED_APPROVED_COUNT = "(SELECT COUNT(r.approver)" + _CFR_COURSES + ")"
+COMPUTED_TOTAL_SAVINGS = "(SELECT IFNULL(SUM(s.savings), 0)" + _CFR_SAVINGS + ")"
+COMPUTED_CONFIRMED_SAVINGS = "(SELECT IFNULL(SUM(s.confirmed_amt), 0)" + _CFR_SAVINGS + ")"
+
+# SET clause that recomputes every total of a cfr_department row.
+# (MySQL assigns these from left to right, so funds_needed
+# is computed from the new totals)
+_SET_CFR_TOTALS = (
+    "SET d.total_cost = " + COMPUTED_TOTAL_COST + ", "
+    "d.total_savings = " + COMPUTED_TOTAL_SAVINGS + ", "
+    "d.confirmed_savings = " + COMPUTED_CONFIRMED_SAVINGS + ", "
+    "d.course_count = " + COMPUTED_COURSE_COUNT + ", "
+    "d.approved_count = " + COMPUTED_APPROVED_COUNT + ", "
+    "d.funds_needed = GREATEST(d.total_cost - d.total_savings - d.dean_committed, 0) "
+)
+
+# Query to recompute the totals of a cfr
+# Parameters are: dept_name, semester, cal_year, revision_num
+REFRESH_CFR_TOTALS = (
+    "UPDATE cfr_department d " + _SET_CFR_TOTALS +
+    "WHERE d.dept_name = %s AND "
+    "d.semester = %s AND "
+    "d.cal_year = %s AND "
+    "d.revision_num = %s"
+)
+
+# Query to recompute the totals of every materialized revision of a
+# department's cfr in a semester (see refresh_semester_cfr_totals())
+# Parameters are: dept_name, semester, cal_year
+REFRESH_SEMESTER_CFR_TOTALS = (
+    "UPDATE cfr_department d " + _SET_CFR_TOTALS +
+    "WHERE d.dept_name = %s AND "
+    "d.semester = %s AND "
+    "d.cal_year = %s AND "
+    "d.materialized = 'yes'"
+)
+
+# Query to recompute the totals of every materialized cfr
+REFRESH_ALL_CFR_TOTALS = "UPDATE cfr_department d " + _SET_CFR_TOTALS + "WHERE d.materialized = 'yes'"
+
+# Query to find every materialized cfr whose stored totals do not
+# match its courses and salary savings
+# Returned columns are: dept_name, semester, cal_year, revision_num
+SELECT_CFR_TOTAL_MISMATCHES = (
+    "SELECT d.dept_name, d.semester, d.cal_year, d.revision_num "
+    "FROM cfr_department d "
+    "WHERE d.materialized = 'yes' AND ("
+    "d.total_cost <> " + COMPUTED_TOTAL_COST + " OR "
+    "d.total_savings <> " + COMPUTED_TOTAL_SAVINGS + " OR "
+    "d.confirmed_savings <> " + COMPUTED_CONFIRMED_SAVINGS + " OR "
+    "d.course_count <> " + COMPUTED_COURSE_COUNT + " OR "
+    "d.approved_count <> " + COMPUTED_APPROVED_COUNT + " OR "
+    "d.funds_needed <> GREATEST(d.total_cost - d.total_savings - d.dean_committed, 0)) "
+    "ORDER BY d.cal_year, d.semester, d.dept_name, d.revision_num"
+)
+
+# Query to select courses by id along with their content hashes,
+# for comparing revisions. Formatted with one "%s" for each id
+# (separated by commas)
+# Returned columns are: id, content_hash and then the fields in REQ_FIELDS
+# Parameters are: each id
+SELECT_DIFF_COURSES = (
+    "SELECT id, content_hash, "+(", ".join(REQ_FIELDS))+" "
+    "FROM request "
+    "WHERE id IN ({}) "
+    "ORDER BY id"
+)
+
+# Queries to compute the totals of a list of courses/savings by id, for
+# cfrs that are not materialized. Formatted with one "%s" for each id
+# (separated by commas)
+# Returned columns are: SUM(cost), COUNT(*), COUNT(approver) (for courses)
+#   or SUM(savings), SUM(confirmed_amt) (for savings)
+# Parameters are: each id
+COURSE_TOTALS_BY_ID = """
+SELECT IFNULL(SUM(cost), 0), COUNT(*), COUNT(approver)
+FROM request
+WHERE id IN ({})
+"""
+SAVINGS_TOTALS_BY_ID = """
+SELECT IFNULL(SUM(savings), 0), IFNULL(SUM(confirmed_amt), 0)
+FROM sal_savings
+WHERE id IN ({})
+"""
+
+# Query to set the totals of a cfr to the given values
+# Parameters are: total_cost, total_savings, confirmed_savings, course_count,
+#   approved_count, dept_name, semester, cal_year, revision_num
+SET_CFR_TOTALS = """
+UPDATE cfr_department
+SET total_cost = %s,
+    total_savings = %s,
+    confirmed_savings = %s,
+    course_count = %s,
+    approved_count = %s,
+    funds_needed = GREATEST(total_cost - total_savings - dean_committed, 0)
+WHERE dept_name = %s AND
+    semester = %s AND
+    cal_year = %s AND
+    revision_num = %s
+"""
+
+# Query to get every cfr that is not materialized, along with its totals
+# Returned columns are: dept_name, semester, cal_year, revision_num,
+#   total_cost, total_savings, confirmed_savings, course_count, approved_count
+SELECT_UNMATERIALIZED_CFRS = """
+SELECT dept_name, semester, cal_year, revision_num,
+    total_cost, total_savings, confirmed_savings, course_count, approved_count
+FROM cfr_department
+WHERE materialized = 'no'
+ORDER BY cal_year, semester, dept_name, revision_num
+"""
+
+# Query to find every department and semester with a cfr that
+# has a course approved by a user
+# Returned columns are: dept_name, semester, cal_year
+# Parameters are: approver, approver
+SELECT_SEMESTERS_APPROVED_BY = """
+SELECT c.dept_name, c.semester, c.cal_year
+FROM request r
+    JOIN cfr_request c ON r.id = c.course_id
+WHERE r.approver = %s
+UNION
+SELECT c.dept_name, c.semester, c.cal_year
+FROM request r
+    JOIN cfr_request_delta c ON r.id = c.course_id
+WHERE r.approver = %s
+"""
+
+# Subquery selecting the latest revision number of each department's cfr
+# in a semester. Returned columns are: dept_name, revision_num
+# Parameters are: semester, cal_year
+LATEST_REVISIONS = """
+SELECT dept_name, MAX(revision_num) AS revision_num
+FROM cfr_department
+WHERE semester = %s AND cal_year = %s
+GROUP BY dept_name
+"""
+
+# Query to select the latest cfr revision of every department (that
+# still has submitters) in a semester, along with its totals
+# Returned columns are: dept_name, semester, cal_year, date_initial,
+#   date_revised, revision_num, cfr_submitter, dean_committed,
+#   total_cost, total_savings, confirmed_savings, course_count,
+#   approved_count and funds_needed
+# Parameters are: semester, cal_year, semester, cal_year
+SELECT_LATEST_CFRS = """
+SELECT d.dept_name,
+    d.semester,
+    d.cal_year,
+    d.date_initial,
+    d.date_revised,
+    d.revision_num,
+    d.cfr_submitter,
+    d.dean_committed,
+    d.total_cost,
+    d.total_savings,
+    d.confirmed_savings,
+    d.course_count,
+    d.approved_count,
+    d.funds_needed
+FROM cfr_department d
+    JOIN (""" + LATEST_REVISIONS + """) latest
+    ON d.dept_name = latest.dept_name AND d.revision_num = latest.revision_num
+WHERE d.semester = %s AND
+    d.cal_year = %s AND
+    d.dept_name IN (SELECT dept_name FROM submitter)
+ORDER BY d.dept_name
+"""
+
+# Query to select the courses in the latest cfr revision of every
+# department in a semester, along with their approval information.
+# Returned columns are: dept_name, then the fields in REQ_FIELDS,
+#   then approver and commitment_code
+# Parameters are: semester, cal_year, semester, cal_year
+SELECT_LATEST_COURSES = (
+    "SELECT c.dept_name, "+(", ".join("r."+f for f in REQ_FIELDS))+", "
+    "r.approver, r.commitment_code "
+    "FROM request r "
+    "JOIN cfr_request c ON r.id = c.course_id "
+    "JOIN ("+LATEST_REVISIONS+") latest "
+    "ON c.dept_name = latest.dept_name AND c.revision_num = latest.revision_num "
+    "WHERE c.semester = %s AND "
+    "c.cal_year = %s "
+    "ORDER BY c.dept_name, r.id"
+)
+
+# The name of the row in the cache_version table that is bumped
+# whenever any cfr data changes (see get_data_version())
+CFR_VERSION_NAME = 'cfr'
+
+# Query to get the versions of the reference data (see refcache)
+# and of the cfr data
+# Returned columns are: name and version
+# Parameters are: the two names
+SELECT_DATA_VERSIONS = """
+SELECT name, version
+FROM cache_version
+WHERE name IN (%s, %s)
 """
 
 # Query to get the currently active semester
@@ -243,6 +662,8 @@ def quick_exec(function: callable, *args):
 
     This is useful when you only need to perform one db_utils function
     and don't want to bother creating a Transaction/cursor yourself.
+    (If a RequestScope is active, the function joins the request's
+    transaction like any other Transaction does)
     """
     with Transaction() as cursor:
         return function(cursor, *args)
@@ -264,13 +685,23 @@ def does_user_exist(cursor: CursorBase, username: str) -> bool:
     cursor.fetchall()
     return cursor.rowcount > 0
 
+def _load_departments(cursor: CursorBase) -> tuple:
+    cursor.execute(DEPARTMENTS_QUERY)
+    return tuple([d[0] for d in cursor.fetchall()])
+
 def get_departments(cursor: CursorBase) -> list:
     """
     Get a list of the names of all departments in the database, using
     the given cursor.
+
+    (This is cached by refcache, so anything that adds or removes
+    submitters must call refcache.invalidate())
     """
-    cursor.execute(DEPARTMENTS_QUERY)
-    return [d[0] for d in cursor.fetchall()]
+    return list(refcache.get(cursor, 'departments', _load_departments))
+
+def _load_semesters(cursor: CursorBase) -> tuple:
+    cursor.execute(SEMESTERS_QUERY)
+    return tuple(cursor.fetchall())
 
 def get_semesters(cursor: CursorBase) -> list:
     """
@@ -279,9 +710,15 @@ def get_semesters(cursor: CursorBase) -> list:
 
     The returned list is a list of tuples representing the 
     season and cal_year of a semester (in that order).
+
+    (This is cached by refcache, so anything that changes the
+    semesters must call refcache.invalidate())
     """
-    cursor.execute(SEMESTERS_QUERY)
-    return cursor.fetchall()
+    return list(refcache.get(cursor, 'semesters', _load_semesters))
+
+def _load_active_semester(cursor: CursorBase) -> tuple:
+    cursor.execute(ACTIVE_SEMESTER_QUERY)
+    return cursor.fetchone()
 
 def get_active_semester(cursor: CursorBase) -> tuple:
     """
@@ -289,9 +726,11 @@ def get_active_semester(cursor: CursorBase) -> tuple:
 
     The returned value is a tuple representing the season
     and cal_year of the semester (in that order)
+
+    (This is cached by refcache, so anything that changes the
+    active semester must call refcache.invalidate())
     """
-    cursor.execute(ACTIVE_SEMESTER_QUERY)
-    return cursor.fetchone()
+    return refcache.get(cursor, 'active_semester', _load_active_semester)
 
 def get_current_cfr(cursor: CursorBase, dept_name: str) -> tuple:
     """
@@ -316,10 +755,14 @@ def create_cfr(cursor: CursorBase, user: User):
     Insert a new cfr into cfr_department table
     for the department represented by the given user in the
     currently active semester, using the given cursor.
+
+    Returns the primary key of the new cfr as a tuple of
+    dept_name, semester, cal_year and revision_num.
     """
     semester = get_active_semester(cursor)
-    query = (user.dept_name, semester[0], semester[1], user.username)
+    query = (user.dept_name, semester[0], semester[1], user.username, revision_storage())
     cursor.execute(NEW_CFR_DEPT, query)
+    return (user.dept_name, semester[0], semester[1], 0)
 
 def create_new_revision(cursor: CursorBase, user: User):
     """
@@ -329,15 +772,116 @@ def create_new_revision(cursor: CursorBase, user: User):
 
     If no cfrs exist yet for the department, one will
     be created.
+
+    Returns the primary key of the new cfr as a tuple of
+    dept_name, semester, cal_year and revision_num. (The previous
+    revision, if there is one, always has a revision_num one less
+    than the new one)
     """
 
     current = get_current_cfr(cursor, user.dept_name)
     if current is None:
-        create_cfr(cursor, user)
+        return create_cfr(cursor, user)
     else:
         revision = current[5] + 1
-        data = (current[0], current[1], current[2], current[3], revision, user.username, current[7])
+        data = (current[0], current[1], current[2], current[3], revision, user.username, current[7], revision_storage())
         cursor.execute(NEW_REVISION, data)
+        return (current[0], current[1], current[2], revision)
+
+def revision_storage() -> str:
+    """
+    Get how new cfr revisions should be stored (REVISION_STORAGE
+    in cfrenv): either FULL_STORAGE (the default) or DELTA_STORAGE
+    """
+    if cfrenv.getenv('REVISION_STORAGE') == DELTA_STORAGE:
+        return DELTA_STORAGE
+    return FULL_STORAGE
+
+def resolve_semester(cursor: CursorBase, kind: str, dept_name: str, semester: tuple) -> dict:
+    """
+    Work out which courses or savings belong to every revision of the given
+    department's cfr in the given semester that is not materialized, using
+    the given cursor. (see resolve_revision())
+
+    kind is either COURSE_ROWS or SAVINGS_ROWS.
+    semester should be a tuple containing the season and
+    cal_year of the semester (in that order).
+
+    Returns a dictionary where each key is the revision_num of a revision
+    that is not materialized and each value is a sorted list of the ids
+    of its courses or savings. This takes at most three queries.
+    """
+    (select_links, select_deltas) = _RESOLVE_QUERIES[kind]
+    params = (dept_name, semester[0], semester[1])
+    cursor.execute(SELECT_SEMESTER_STORAGE, params)
+    storage = cursor.fetchall()
+    if all(materialized == 'yes' for (revision_num, materialized) in storage):
+        return {}
+
+    cursor.execute(select_links, params)
+    links = {}
+    for (revision_num, row_id) in cursor.fetchall():
+        links.setdefault(revision_num, set()).add(row_id)
+
+    cursor.execute(select_deltas, params)
+    added = {}
+    removed = {}
+    for (revision_num, row_id, change_type) in cursor.fetchall():
+        changes = added if change_type == 'add' else removed
+        changes.setdefault(revision_num, set()).add(row_id)
+
+    # Start from the first revision and apply each delta in turn,
+    # starting over whenever a revision is materialized
+    resolved = {}
+    current = set()
+    for (revision_num, materialized) in storage:
+        if materialized == 'yes':
+            current = links.get(revision_num, set())
+            continue
+        current = (current - removed.get(revision_num, set())) | added.get(revision_num, set())
+        resolved[revision_num] = sorted(current)
+        _resolved.put((kind, dept_name, semester[0], int(semester[1]), revision_num), tuple(resolved[revision_num]))
+    return resolved
+
+def resolve_revision(cursor: CursorBase, kind: str, cfr: tuple) -> list:
+    """
+    Get the ids of the courses or savings (depending on whether kind
+    is COURSE_ROWS or SAVINGS_ROWS) that belong to the given cfr if
+    it is not materialized, using the given cursor.
+
+    cfr is the primary key of the cfr as a tuple of
+    dept_name, semester, cal_year and revision_num.
+
+    Returns a sorted list of ids, or None if the cfr is materialized
+    (or does not exist), in which case its courses and savings are
+    simply the ones linked to it in cfr_request and cfr_savings.
+
+    Revisions are stored in one of two ways (see REVISION_STORAGE in cfrenv):
+    A 'full' revision has every one of its courses and savings linked
+    to it. A 'delta' revision only records the ones that were added or
+    removed since the revision before it (in cfr_request_delta and
+    cfr_savings_delta). The latest revision is always materialized (linked
+    like a 'full' revision) so the current cfr can be read directly. When
+    a new 'delta' revision is made, the links are moved to it from the
+    previous one, so storage only grows with the number of changes.
+
+    Revisions that are not materialized never change, so they are
+    remembered by each process once they have been resolved.
+    """
+    ids = _resolved.get((kind, cfr[0], cfr[1], int(cfr[2]), cfr[3]))
+    if ids is not None:
+        return list(ids)
+    return resolve_semester(cursor, kind, cfr[0], cfr[1:3]).get(cfr[3])
+
+def _select_by_id(cursor: CursorBase, query: str, ids: list) -> list:
+    """
+    Run one of the *_BY_ID queries for the given ids using the given
+    cursor and return all of the rows
+    """
+    if len(ids) == 0:
+        return []
+    cursor.execute(query.format(", ".join(["%s"] * len(ids))), tuple(ids))
+    return cursor.fetchall()
 
 def get_all_revisions_for_semester(cursor: CursorBase, dept_name: str, semester: tuple) -> list:
     """
@@ -367,6 +911,181 @@ def get_all_revisions_for_active_semester(cursor: CursorBase, dept_name: str) ->
     semester = get_active_semester(cursor)
     return get_all_revisions_for_semester(cursor, dept_name, semester)
 
+def get_revision_history(cursor: CursorBase, dept_name: str, semester: tuple = None) -> dict:
+    """
+    Get the courses in every cfr revision for the given department,
+    using the given cursor. This takes two queries no matter how many
+    revisions or semesters there are (plus a few more for each semester
+    with revisions that are not materialized, see resolve_revision()).
+
+    If semester (a tuple containing the season and cal_year of a semester,
+    in that order) is given, only revisions in that semester are included.
+    Otherwise, revisions in every semester are included.
+
+    The returned value is a dictionary where each key is a tuple of the
+    season and cal_year (as an int) of a semester, and each value is a list
+    with one element for each revision in that semester (latest revision first).
+    Each element is a list of tuples with fields corresponding to REQ_FIELDS.
+    Semesters with no revisions are not included.
+    """
+    if semester is None:
+        cursor.execute(SELECT_ALL_REVISIONS, (dept_name,))
+        revisions = cursor.fetchall()
+        cursor.execute(SELECT_ALL_REVISION_COURSES, (dept_name,))
+    else:
+        revisions = get_all_revisions_for_semester(cursor, dept_name, semester)
+        cursor.execute(SELECT_SEMESTER_REVISION_COURSES, (dept_name, semester[0], semester[1]))
+
+    # Group the courses by the revision they belong to
+    courses_by_revision = {}
+    for row in cursor.fetchall():
+        key = (row[0], int(row[1]), row[2])
+        courses_by_revision.setdefault(key, []).append(tuple(row[3:]))
+
+    # Revisions with no linked courses may just not be materialized,
+    # so get their courses (if they have any) by id instead
+    resolved = {}
+    for revision in revisions:
+        key = (revision[1], int(revision[2]), revision[5])
+        if key not in courses_by_revision:
+            ids = resolve_revision(cursor, COURSE_ROWS, (revision[0],) + key)
+            if ids:
+                resolved[key] = ids
+    if len(resolved) > 0:
+        all_ids = sorted(set(i for ids in resolved.values() for i in ids))
+        courses = {row[0]: tuple(row[1:]) for row in _select_by_id(cursor, SELECT_COURSES_BY_ID, all_ids)}
+        for (key, ids) in resolved.items():
+            courses_by_revision[key] = [courses[i] for i in ids]
+
+    history = {}
+    for revision in revisions:
+        semester_key = (revision[1], int(revision[2]))
+        history.setdefault(semester_key, []).append(
+            courses_by_revision.get(semester_key + (revision[5],), []))
+    return history
+
+def get_revision_ids(cursor: CursorBase, kind: str, dept_name: str, semester: tuple) -> dict:
+    """
+    Get the ids of the courses or savings (depending on whether kind is
+    COURSE_ROWS or SAVINGS_ROWS) in every revision of the given department's
+    cfr in the given semester, using the given cursor. Only ids are read,
+    not the courses or savings themselves.
+
+    Returns a dictionary where each key is a revision_num and each value is
+    a set of ids. Revisions with no courses or savings may be left out.
+    """
+    (select_links, select_deltas) = _RESOLVE_QUERIES[kind]
+    cursor.execute(select_links, (dept_name, semester[0], semester[1]))
+    ids = {}
+    for (revision_num, row_id) in cursor.fetchall():
+        ids.setdefault(revision_num, set()).add(row_id)
+    for (revision_num, resolved) in resolve_semester(cursor, kind, dept_name, semester).items():
+        ids[revision_num] = set(resolved)
+    return ids
+
+def _diff_courses(prev_ids: set, ids: set, courses: dict) -> dict:
+    """
+    Compare the courses in two consecutive revisions, given as sets of ids.
+    courses is a dictionary of (content_hash, course tuple) for the id of
+    every course that is in only one of the revisions.
+
+    A course that kept its id is unchanged. Otherwise, an added and a removed
+    course with the same content hash are the same course (it was inserted
+    again rather than reused), and an added and a removed course with the
+    same course and section are a changed course. Everything else was
+    really added or removed.
+    """
+    added = sorted(ids - prev_ids)
+    removed = sorted(prev_ids - ids)
+    unchanged = len(ids & prev_ids)
+
+    # Match by content hash first
+    removed_by_hash = {}
+    for course_id in removed:
+        removed_by_hash.setdefault(courses[course_id][0], []).append(course_id)
+    remaining = []
+    for course_id in added:
+        matches = removed_by_hash.get(courses[course_id][0])
+        if matches:
+            matches.pop(0)
+            unchanged += 1
+        else:
+            remaining.append(course_id)
+    removed = [i for ids_ in removed_by_hash.values() for i in ids_]
+    removed.sort()
+
+    # Then by course and section (REQ_FIELDS 1 and 2)
+    removed_by_section = {}
+    for course_id in removed:
+        course = courses[course_id][1]
+        removed_by_section.setdefault((course[1], course[2]), []).append(course_id)
+    diff = {'added': [], 'removed': [], 'changed': [], 'unchanged': unchanged}
+    for course_id in remaining:
+        course = courses[course_id][1]
+        matches = removed_by_section.get((course[1], course[2]))
+        if matches:
+            before = courses[matches.pop(0)][1]
+            fields = [REQ_FIELDS[i] for i in range(len(REQ_FIELDS)) if before[i] != course[i]]
+            diff['changed'].append((before, course, fields))
+        else:
+            diff['added'].append(course)
+    for course_id in sorted(i for ids_ in removed_by_section.values() for i in ids_):
+        diff['removed'].append(courses[course_id][1])
+    return diff
+
+def get_revision_diffs(cursor: CursorBase, dept_name: str, semester: tuple) -> list:
+    """
+    Get what changed in each cfr revision for the given department in the
+    given semester, using the given cursor. Only the ids of each revision's
+    courses are compared, and only the courses that changed are read, so
+    this takes the same few queries no matter how many revisions there are.
+
+    semester should be a tuple containing the season and
+    cal_year of the semester (in that order).
+
+    The returned value is a list with one element for each revision (latest
+    revision first), each being a dictionary with the fields:
+        'revision':     The revision's tuple from cfr_department (with the same
+                        fields as get_all_revisions_for_semester())
+        'added':        A list of the courses added in the revision
+        'removed':      A list of the courses removed in the revision
+        'changed':      A list of the courses that were changed in the revision,
+                        each being a tuple of the course before and after the
+                        change, and a list of the names (from REQ_FIELDS) of the
+                        fields that changed
+        'unchanged':    The number of courses that did not change
+    Courses are tuples with fields corresponding to REQ_FIELDS. The first
+    revision is compared to an empty revision, so all of its courses are added.
+    """
+    revisions = get_all_revisions_for_semester(cursor, dept_name, semester)
+    ids = get_revision_ids(cursor, COURSE_ROWS, dept_name, semester)
+
+    # Find every course that is in one revision but not the one before it
+    revision_nums = sorted(revision[5] for revision in revisions)
+    pairs = []
+    changed_ids = set()
+    prev_ids = set()
+    for revision_num in revision_nums:
+        revision_ids = ids.get(revision_num, set())
+        pairs.append((prev_ids, revision_ids))
+        changed_ids |= revision_ids ^ prev_ids
+        prev_ids = revision_ids
+
+    courses = {}
+    for row in _select_by_id(cursor, SELECT_DIFF_COURSES, sorted(changed_ids)):
+        courses[row[0]] = (row[1], tuple(row[2:]))
+
+    diffs = {}
+    for (revision_num, (prev_ids, revision_ids)) in zip(revision_nums, pairs):
+        diffs[revision_num] = _diff_courses(prev_ids, revision_ids, courses)
+
+    result = []
+    for revision in revisions:
+        diff = diffs[revision[5]]
+        diff['revision'] = revision
+        result.append(diff)
+    return result
+
 def get_courses(cursor: CursorBase, cfr: tuple) -> list:
     """
     Get a list of courses associated with the given cfr, using the given
@@ -382,7 +1101,13 @@ def get_courses(cursor: CursorBase, cfr: tuple) -> list:
     """
     cfr_data = (cfr[0], cfr[1], cfr[2], cfr[5])
     cursor.execute(SELECT_COURSES, cfr_data)
-    return cursor.fetchall()
+    courses = cursor.fetchall()
+    # A cfr with no linked courses may just not be materialized
+    if len(courses) == 0:
+        ids = resolve_revision(cursor, COURSE_ROWS, cfr_data)
+        if ids:
+            courses = [tuple(row[1:]) for row in _select_by_id(cursor, SELECT_COURSES_BY_ID, ids)]
+    return courses
 
 def get_course_approvals(cursor: CursorBase, cfr: tuple) -> list:
     """
@@ -399,7 +1124,13 @@ def get_course_approvals(cursor: CursorBase, cfr: tuple) -> list:
     """
     cfr_data = (cfr[0], cfr[1], cfr[2], cfr[5])
     cursor.execute(SELECT_COURSE_APPROVALS, cfr_data)
-    return cursor.fetchall()
+    approvals = cursor.fetchall()
+    # A cfr with no linked courses may just not be materialized
+    if len(approvals) == 0:
+        ids = resolve_revision(cursor, COURSE_ROWS, cfr_data)
+        if ids:
+            approvals = _select_by_id(cursor, SELECT_COURSE_APPROVALS_BY_ID, ids)
+    return approvals
 
 def get_current_courses(cursor: CursorBase, dept_name: str) -> list:
     """
@@ -433,7 +1164,13 @@ def get_savings(cursor: CursorBase, cfr: tuple) -> list:
     """
     cfr_data = (cfr[0], cfr[1], cfr[2], cfr[5])
     cursor.execute(SELECT_SAVINGS, cfr_data)
-    return cursor.fetchall()
+    savings = cursor.fetchall()
+    # A cfr with no linked savings may just not be materialized
+    if len(savings) == 0:
+        ids = resolve_revision(cursor, SAVINGS_ROWS, cfr_data)
+        if ids:
+            savings = _select_by_id(cursor, SELECT_SAVINGS_BY_ID, ids)
+    return savings
 
 def get_current_savings(cursor: CursorBase, dept_name: str) -> list:
     """
@@ -455,7 +1192,8 @@ def get_current_savings(cursor: CursorBase, dept_name: str) -> list:
 def get_approver_data(cursor: CursorBase) -> dict:
     """
     Get a dictionary of data used for assembling the approver page, using the
-    given cursor.
+    given cursor. This takes the same number of queries no matter how many
+    departments there are.
 
     The returned dictionary has the following fields: Each field is a list
     where each element corresponds to a particular department (only departments
@@ -483,44 +1221,160 @@ def get_approver_data(cursor: CursorBase) -> dict:
         'course_lists': []
     }
 
-    depts = get_departments(cursor)
-    for dept in depts:
-        cfr = get_current_cfr(cursor, dept)
-        # Skip department if there is no current cfr
-        if cfr is None:
-            continue
-
-        courses = get_courses(cursor, cfr)
-        # Skip department if there are no courses in this cfr
-        if len(courses) == 0:
-            continue
-        course_approvals = get_course_approvals(cursor, cfr)
-
-        savings = get_savings(cursor, cfr)
+    # Everything is fetched in a fixed number of queries, no matter
+    # how many departments there are. The totals for the summary are
+    # kept up to date in cfr_department, so they are not computed here
+    semester = get_active_semester(cursor)
+    params = (semester[0], semester[1], semester[0], semester[1])
 
-        all_approved = True
-        total_cost = 0
-        for i in range(len(courses)):
-            total_cost += courses[i][9]
-            all_approved = all_approved and (course_approvals[i][0] is not None)
+    cursor.execute(SELECT_LATEST_CFRS, params)
+    # Skip departments if there are no courses in their cfr
+    cfrs = [cfr for cfr in cursor.fetchall() if cfr[11] > 0]
+    if len(cfrs) == 0:
+        return data
 
-        total_savings = 0
-        for i in range(len(savings)):
-            total_savings += savings[i][2]
+    # Group the courses by department
+    cursor.execute(SELECT_LATEST_COURSES, params)
+    courses_by_dept = {}
+    for row in cursor.fetchall():
+        courses_by_dept.setdefault(row[0], []).append(tuple(row[1:]))
 
+    for cfr in cfrs:
+        dept = cfr[0]
+        all_approved = cfr[12] == cfr[11]
 
-        committed = cfr[7]
-        funds_needed = total_cost - total_savings - committed
-        if funds_needed < 0:
-            funds_needed = 0
-        
         data['dept_names'].append(dept)
-        data['summary'].append((dept, total_cost, total_savings, committed, funds_needed, all_approved))
-        data['course_lists'].append(
-            [course+course_approvals[i] for (i, course) in enumerate(courses)])
+        data['summary'].append((dept, cfr[8], cfr[9], cfr[7], cfr[13], all_approved))
+        data['course_lists'].append(courses_by_dept.get(dept, []))
 
     return data
 
+def refresh_cfr_totals(cursor: CursorBase, cfr: tuple):
+    """
+    Recompute the totals stored in cfr_department (total_cost,
+    total_savings, confirmed_savings, course_count, approved_count
+    and funds_needed) for the given cfr, using the given cursor.
+
+    cfr is the primary key of the cfr as a tuple of
+    dept_name, semester, cal_year and revision_num. The cfr must be
+    materialized (as the latest revision always is).
+
+    Anything that changes a cfr's courses or salary savings must call
+    this with the same cursor, so the totals change in the same transaction.
+    This also bumps the cfr data version (see get_data_version()).
+    """
+    cursor.execute(REFRESH_CFR_TOTALS, cfr)
+    bump_cfr_version(cursor)
+
+def _compute_totals(cursor: CursorBase, course_ids: list, savings_ids: list) -> tuple:
+    """
+    Compute the totals of the given courses and savings using the given
+    cursor, as a tuple of total_cost, total_savings, confirmed_savings,
+    course_count and approved_count
+    """
+    (total_cost, course_count, approved_count) = (0, 0, 0)
+    if len(course_ids) > 0:
+        (total_cost, course_count, approved_count) = _select_by_id(cursor, COURSE_TOTALS_BY_ID, course_ids)[0]
+    (total_savings, confirmed_savings) = (0, 0)
+    if len(savings_ids) > 0:
+        (total_savings, confirmed_savings) = _select_by_id(cursor, SAVINGS_TOTALS_BY_ID, savings_ids)[0]
+    return (total_cost, total_savings, confirmed_savings, course_count, approved_count)
+
+def _resolved_totals(cursor: CursorBase, dept_name: str, semester: tuple) -> dict:
+    """
+    Compute the totals (as in _compute_totals()) of every revision of the given
+    department's cfr in the given semester that is not materialized, using the
+    given cursor. Returns a dictionary of the totals keyed by revision_num.
+    """
+    courses = resolve_semester(cursor, COURSE_ROWS, dept_name, semester)
+    if len(courses) == 0:
+        return {}
+    savings = resolve_semester(cursor, SAVINGS_ROWS, dept_name, semester)
+    return {
+        revision_num: _compute_totals(cursor, course_ids, savings.get(revision_num, []))
+        for (revision_num, course_ids) in courses.items()
+    }
+
+def refresh_semester_cfr_totals(cursor: CursorBase, dept_name: str, semester: tuple):
+    """
+    Recompute the totals (as in refresh_cfr_totals()) of every revision
+    of the given department's cfr in the given semester, using the given cursor.
+
+    This is needed when a course is changed in place, because an
+    unchanged course is shared by every revision it appears in.
+    This also bumps the cfr data version (see get_data_version()).
+    """
+    cursor.execute(REFRESH_SEMESTER_CFR_TOTALS, (dept_name, semester[0], semester[1]))
+    for (revision_num, totals) in _resolved_totals(cursor, dept_name, semester).items():
+        cursor.execute(SET_CFR_TOTALS, totals + (dept_name, semester[0], semester[1], revision_num))
+    bump_cfr_version(cursor)
+
+def get_data_version(cursor: CursorBase) -> str:
+    """
+    Get a string identifying the current version of everything that the
+    server's pages are built from, using the given cursor. It changes
+    whenever the reference data (see refcache) or any cfr data changes,
+    so it can be used to tell whether a page that was already sent to
+    the client is still up to date without building it again.
+    """
+    cursor.execute(SELECT_DATA_VERSIONS, (refcache.VERSION_NAME, CFR_VERSION_NAME))
+    versions = dict(cursor.fetchall())
+    return f"{versions.get(refcache.VERSION_NAME, 0)}.{versions.get(CFR_VERSION_NAME, 0)}"
+
+def bump_cfr_version(cursor: CursorBase):
+    """
+    Bump the cfr data version (see get_data_version()) using the given cursor.
+
+    Anything that changes cfrs, courses, salary savings, approvals or
+    commitments must call this (or refresh_cfr_totals(), which calls it)
+    with the same cursor, so that pages built from the old data are not
+    mistaken for being up to date.
+    """
+    cursor.execute(refcache.BUMP_VERSION, (CFR_VERSION_NAME,))
+
+def get_semesters_approved_by(cursor: CursorBase, username: str) -> list:
+    """
+    Get every department and semester with a cfr that has a course
+    approved by the given user, using the given cursor, as a list of
+    tuples of dept_name and a semester tuple (season and cal_year).
+    """
+    cursor.execute(SELECT_SEMESTERS_APPROVED_BY, (username, username))
+    return [(row[0], (row[1], row[2])) for row in cursor.fetchall()]
+
+def check_cfr_totals(cursor: CursorBase, repair: bool = False) -> list:
+    """
+    Find every cfr whose totals in cfr_department do not match its courses
+    and salary savings, using the given cursor, and return a list of their
+    primary keys.
+
+    If repair is True, the totals of every cfr are recomputed as well.
+    This reads every cfr in the database, so it is meant to be run offline
+    (see the 'check-totals' command in manage.py), not by the server.
+    """
+    cursor.execute(SELECT_CFR_TOTAL_MISMATCHES)
+    mismatches = [tuple(row) for row in cursor.fetchall()]
+    if repair and len(mismatches) > 0:
+        cursor.execute(REFRESH_ALL_CFR_TOTALS)
+
+    # Revisions that are not materialized are checked one semester at a time
+    cursor.execute(SELECT_UNMATERIALIZED_CFRS)
+    stored_by_semester = {}
+    for row in cursor.fetchall():
+        stored_by_semester.setdefault((row[0], (row[1], row[2])), {})[row[3]] = tuple(row[4:])
+    for ((dept_name, semester), stored) in stored_by_semester.items():
+        computed = _resolved_totals(cursor, dept_name, semester)
+        for (revision_num, totals) in stored.items():
+            if totals == computed.get(revision_num):
+                continue
+            mismatches.append((dept_name, semester[0], semester[1], revision_num))
+            if repair and revision_num in computed:
+                cursor.execute(SET_CFR_TOTALS,
+                    computed[revision_num] + (dept_name, semester[0], semester[1], revision_num))
+
+    if repair and len(mismatches) > 0:
+        bump_cfr_version(cursor)
+    return mismatches
+
 # Helper function to parse emails into a list
 # Parameter: emails is a list of tuples 
 def _list_emails(emails):
@@ -532,33 +1386,21 @@ def _list_emails(emails):
 
 # Function to get emails for all users
 # Returns a list of emails
-def get_all_emails():
-    with Transaction() as cursor:
-        cursor.execute(ALL_EMAILS, params=None)
-        all_emails = cursor.fetchall()
-
-    email_list = _list_emails(all_emails)
-    return email_list
+def get_all_emails(cursor: CursorBase):
+    cursor.execute(ALL_EMAILS, params=None)
+    return _list_emails(cursor.fetchall())
 
 # Function to get emails of submitters for a department
-# Parameter is a tuple with the department name
+# Parameter is a string with the department name
 # Returns a list of emails
-def get_emails_by_dept(dept_name):
-    with Transaction() as cursor:
-        cursor.execute(EMAILS_BY_DEPT, (dept_name,))
-        dept_emails = cursor.fetchall()
-
-    email_list = _list_emails(dept_emails)
-    return email_list
+def get_emails_by_dept(cursor: CursorBase, dept_name):
+    cursor.execute(EMAILS_BY_DEPT, (dept_name,))
+    return _list_emails(cursor.fetchall())
 
 # Functions to get emails of users of a certain type
 # Parameter is a string of user type: 
 # submitter', approver', 'admin'
 # Returns a list of emails
-def get_emails_by_type(type):
-    with Transaction() as cursor:
-        cursor.execute(EMAILS_BY_TYPE, (type,))
-        emails_by_type = cursor.fetchall()
-
-    email_list = _list_emails(emails_by_type)
-    return email_list
+def get_emails_by_type(cursor: CursorBase, type):
+    cursor.execute(EMAILS_BY_TYPE, (type,))
+    return _list_emails(cursor.fetchall())
@@ -1,119 +1,196 @@
+"""
+Writes email notifications to the outbox and delivers them.
+
+Emails are not sent while a request is being handled. Instead, the
+compose_*_email functions add them to the email_outbox table in the
+same transaction as the change they describe, so a notification is only
+kept if that change is committed and the request never has to wait for
+the mail server.
+
+deliver_outbox() sends whatever is waiting in the outbox. It is run by
+the outbox worker (see manage.py), not by the web server. Recipients are
+looked up when an email is delivered, all of the emails in a batch are
+sent over one SMTP connection, and emails that fail are retried later
+with an exponential backoff. If the SMTP server can not be reached at
+all, the rest of the batch is put off until later rather than waiting
+for it to time out once for every email.
+"""
+import time
 import smtplib
 from . import db_utils
 from . import cfrenv
+from . import instrumentation
+from .sql_connection import Transaction
+from mysql.connector.cursor import CursorBase
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
-def send_email_notification(composed_email):
+# The maximum number of emails delivered by one call to deliver_outbox()
+DEFAULT_BATCH_SIZE = 50
+
+# An email that fails this many times is not tried again
+MAX_ATTEMPTS = 8
+
+# Number of seconds to wait before retrying an email the first time.
+# This doubles with every failed attempt, up to RETRY_MAX_DELAY
+RETRY_BASE_DELAY    = 60
+RETRY_MAX_DELAY     = 6 * 60 * 60
+
+# Number of seconds to wait for the SMTP server before giving up
+SMTP_TIMEOUT = 30
+
+# The emails in a batch are set aside for the worker that is delivering
+# them for SMTP_TIMEOUT seconds per email plus CLAIM_MARGIN seconds (see
+# claim_timeout()). If that worker dies, another may try after that long.
+# The worker stops sending CLAIM_MARGIN seconds before its claim runs out,
+# which leaves time for the email that is being sent to finish
+CLAIM_MARGIN = 5 * 60
+
+# The emails that have been sent (or failed) are recorded in the outbox
+# after every this many, so a worker that dies part of the way through a
+# batch only sends this many of them again
+RECORD_EVERY = 10
+
+# Query to add an email to the outbox
+# Parameters are: recipient_kind, recipient_arg, subject, body
+INSERT_EMAIL = """
+INSERT INTO email_outbox
+    (recipient_kind, recipient_arg, subject, body, created, next_attempt)
+VALUES (%s, %s, %s, %s, NOW(), NOW())
+"""
+
+# Query to get (and lock) the emails in the outbox that are ready to be sent
+# Returned columns are: id, recipient_kind, recipient_arg, subject, body, attempts
+# Parameters are: max attempts, max number of emails
+SELECT_PENDING_EMAILS = """
+SELECT id, recipient_kind, recipient_arg, subject, body, attempts
+FROM email_outbox
+WHERE sent IS NULL AND attempts < %s AND next_attempt <= NOW()
+ORDER BY id
+LIMIT %s
+FOR UPDATE
+"""
+
+# Query to set an email aside so that no other worker sends it
+# Parameters are: seconds to set it aside for, id
+CLAIM_EMAIL = """
+UPDATE email_outbox
+SET next_attempt = NOW() + INTERVAL %s SECOND
+WHERE id = %s
+"""
+
+# Query to mark an email as sent
+# Parameters are: id
+MARK_EMAIL_SENT = """
+UPDATE email_outbox
+SET sent = NOW(), attempts = attempts + 1, last_error = NULL
+WHERE id = %s
+"""
+
+# Query to record a failed attempt to send an email
+# Parameters are: error message, seconds until the next attempt, id
+MARK_EMAIL_FAILED = """
+UPDATE email_outbox
+SET attempts = attempts + 1, last_error = %s, next_attempt = NOW() + INTERVAL %s SECOND
+WHERE id = %s
+"""
+
+# Query to put off an email that was claimed but not tried, without
+# counting it as an attempt
+# Parameters are: seconds until the next attempt, id
+POSTPONE_EMAIL = """
+UPDATE email_outbox
+SET next_attempt = NOW() + INTERVAL %s SECOND
+WHERE id = %s
+"""
+
+# Query to count the emails in the outbox that have not been sent
+# Returned columns are: number of emails waiting to be sent, number that
+#   will not be tried again, seconds since the oldest waiting one was added
+# Parameters are: max attempts, max attempts, max attempts
+SELECT_OUTBOX_BACKLOG = """
+SELECT
+    COALESCE(SUM(attempts < %s), 0),
+    COALESCE(SUM(attempts >= %s), 0),
+    COALESCE(TIMESTAMPDIFF(SECOND, MIN(IF(attempts < %s, created, NULL)), NOW()), 0)
+FROM email_outbox
+WHERE sent IS NULL
+"""
+
+def create_message(body: str) -> str:
+    """
+    Wrap the body of an email message with a greeting and footer and
+    return the new string
     """
-    Connects to NMSU's SMTP server to send an
-    email notification.
+    return f"Hello!\n\n{body}\n\n- Course Funding Request System\n (Do not reply to this email)"
 
-    composed_email is a fully composed
-    MIMEMultipart email message.
+def queue_email(recipient_kind: str, recipient_arg: str, subject: str, body: str, cursor: CursorBase = None):
     """
+    Add an email to the outbox to be sent by the outbox worker.
+
+    recipient_kind and recipient_arg describe who the email is for:
+        'all'   every user (recipient_arg is ignored)
+        'dept'  the submitters for the department named by recipient_arg
+        'type'  every user whose type is recipient_arg
+
+    If a cursor is given, the email is added using it (and so is part
+    of that cursor's transaction). Otherwise, a new Transaction is used.
 
+    If email is not configured, this does nothing.
+    """
     if not cfrenv.can_do_email():
         # If email isn't configured, forget it
         return
 
-    host      = cfrenv.getenv('SMTP_SERVER')
-    address     = cfrenv.getenv('SMTP_ADDRESS')
-    password    = cfrenv.getenv('SMTP_PASSWORD')
-    port        = cfrenv.getenv('SMTP_PORT')
-
-    try:
-        server = smtplib.SMTP(host=host, port=port)
-        server.starttls()
-        server.login(address, password)
-        server.send_message(composed_email)
-    except Exception:
-        pass
-    finally:
-        server.quit()
+    params = (recipient_kind, recipient_arg, subject, body)
+    with instrumentation.timer('email'):
+        if cursor is None:
+            with Transaction() as cursor:
+                cursor.execute(INSERT_EMAIL, params)
+        else:
+            cursor.execute(INSERT_EMAIL, params)
 
-def create_message(body: str) -> str:
+def get_outbox_backlog(cursor: CursorBase) -> tuple:
     """
-    Wrap the body of an email message with a greeting and footer and
-    return the new string
+    Get the state of the outbox as a tuple of the number of emails
+    waiting to be sent, the number that failed too many times to be
+    tried again and the age (in seconds) of the oldest waiting email
     """
-    return f"Hello!\n\n{body}\n\n- Course Funding Request System\n (Do not reply to this email)"
+    cursor.execute(SELECT_OUTBOX_BACKLOG, (MAX_ATTEMPTS,) * 3)
+    (waiting, failed, oldest) = cursor.fetchone()
+    return (int(waiting), int(failed), int(oldest))
 
-def compose_new_cfr_email(dept):
+def compose_new_cfr_email(dept, cursor: CursorBase = None):
     """
     Composes a an email notification to be sent when a new
     CFR is created.
 
     dept is the name of the department the submission is for.
+    cursor is passed along to queue_email()
     """
-    # Get a list of submitter emails for a department
-    submitter_emails = db_utils.get_emails_by_dept(dept)
-
-    # Get a list of approver emails
-    approver_emails = db_utils.get_emails_by_type('approver')
-
-    # create message
-    email_to_submitter = MIMEMultipart()
-    email_to_approvers = MIMEMultipart()
-
-    # set up message parameters
-    email_to_submitter['Subject'] = f'{dept} CFR Submission'
-    email_to_submitter['To'] = ','.join(submitter_emails)
-    email_to_submitter['From'] = cfrenv.getenv('SMTP_ADDRESS')
-
-    email_to_approvers['Subject'] = f'{dept} CFR Submission'
-    email_to_approvers['To'] = ','.join(approver_emails)
-    email_to_approvers['From'] = cfrenv.getenv('SMTP_ADDRESS')
-
-    # add message body
-    message_to_submitter = create_message(f'Your Course Funding Request for {dept} has been submitted.')
-    email_to_submitter.attach(MIMEText(message_to_submitter, 'plain'))
-
-    message_to_approvers = create_message(f'A Course Funding Request for {dept} has been submitted.')
-    email_to_approvers.attach(MIMEText(message_to_approvers, 'plain'))
-
-    # send message
-    send_email_notification(email_to_submitter)
-    send_email_notification(email_to_approvers)
-
-def compose_cfr_revision_email(dept):
+    queue_email('dept', dept, f'{dept} CFR Submission',
+        create_message(f'Your Course Funding Request for {dept} has been submitted.'),
+        cursor)
+    queue_email('type', 'approver', f'{dept} CFR Submission',
+        create_message(f'A Course Funding Request for {dept} has been submitted.'),
+        cursor)
+
+def compose_cfr_revision_email(dept, cursor: CursorBase = None):
     """
     Composes a an email notification to be sent when a
     revision is made to an existing CFR.
 
     dept is the name of the department the submission is for
+    cursor is passed along to queue_email()
     """
-    # Get a list of submitter emails for a department
-    submitter_emails = db_utils.get_emails_by_dept(dept)
-
-    # Get a list of approver emails
-    approver_emails = db_utils.get_emails_by_type('approver')
-
-    # create message
-    email_to_submitter = MIMEMultipart()
-    email_to_approvers = MIMEMultipart()
-
-    # set up message parameters
-    email_to_submitter['Subject'] = f'{dept} CFR Revision'
-    email_to_submitter['To'] = ','.join(submitter_emails)
-    email_to_submitter['From'] = cfrenv.getenv('SMTP_ADDRESS')
-
-    email_to_approvers['Subject'] = f'{dept} CFR Revision'
-    email_to_approvers['To'] = ','.join(approver_emails)
-    email_to_approvers['From'] = cfrenv.getenv('SMTP_ADDRESS')
-
-    # add message body
-    message_to_submitter = create_message(f'Your revision has been submitted for {dept}.')
-    email_to_submitter.attach(MIMEText(message_to_submitter, 'plain'))
-
-    message_to_approvers = create_message(f'A new revision for {dept}\'s Course Funding Request has been submitted.')
-    email_to_approvers.attach(MIMEText(message_to_approvers, 'plain'))
-
-    # send message
-    send_email_notification(email_to_submitter)
-    send_email_notification(email_to_approvers)
-
-def compose_approve_course_email(dept, course_list):
+    queue_email('dept', dept, f'{dept} CFR Revision',
+        create_message(f'Your revision has been submitted for {dept}.'),
+        cursor)
+    queue_email('type', 'approver', f'{dept} CFR Revision',
+        create_message(f'A new revision for {dept}\'s Course Funding Request has been submitted.'),
+        cursor)
+
+def compose_approve_course_email(dept, course_list, cursor: CursorBase = None):
     """
     Compose an email notification to be sent when courses
     are approved.
@@ -121,62 +198,234 @@ def compose_approve_course_email(dept, course_list):
     dept is the name of the department the courses belong to
     course_list is a list of dicts describing the approved courses
         each with the fields 'course' and 'sec'
+    cursor is passed along to queue_email()
     """
-
-    submitter_emails    = db_utils.get_emails_by_dept(dept)
-    approver_emails     = db_utils.get_emails_by_type('approver')
-
-    # create message
-    email_to_submitter = MIMEMultipart()
-    email_to_approvers = MIMEMultipart()
-
-    # set up message parameters
-    email_to_submitter['Subject'] = f'{dept} CFR Approval'
-    email_to_submitter['To'] = ','.join(submitter_emails)
-    email_to_submitter['From'] = cfrenv.getenv('SMTP_ADDRESS')
-
-    email_to_approvers['Subject'] = f'{dept} CFR Approval'
-    email_to_approvers['To'] = ','.join(approver_emails)
-    email_to_approvers['From'] = cfrenv.getenv('SMTP_ADDRESS')
-
     if len(course_list) > 0:
         course_description = "Approved Courses:\n"+"\n".join([f"{c['course']} - {c['sec']}" for c in course_list])
     else:
         # If no courses approved, forget it
         return
 
-    message_to_submitter = create_message(f"Some of the courses in {dept}'s request have been approved.\n\n{course_description}")
-    email_to_submitter.attach(MIMEText(message_to_submitter, 'plain'))
-
-    message_to_approvers = create_message(f"Your approvals in {dept}'s request have been received.\n\n{course_description}")
-    email_to_approvers.attach(MIMEText(message_to_approvers, 'plain'))
+    queue_email('dept', dept, f'{dept} CFR Approval',
+        create_message(f"Some of the courses in {dept}'s request have been approved.\n\n{course_description}"),
+        cursor)
+    queue_email('type', 'approver', f'{dept} CFR Approval',
+        create_message(f"Your approvals in {dept}'s request have been received.\n\n{course_description}"),
+        cursor)
 
-    # send message
-    send_email_notification(email_to_submitter)
-    send_email_notification(email_to_approvers)
-
-def compose_open_semester_email(season, year):
+def compose_open_semester_email(season, year, cursor: CursorBase = None):
     """
     Composes an email notification to be sent to all users
     when a cfr semester has been opened
 
-    season is a string containing the name of the opened 
+    season is a string containing the name of the opened
     semester: 'Fall', 'Spring', 'Summer'
+    cursor is passed along to queue_email()
+    """
+    queue_email('all', None, 'CFR season now open',
+        create_message(f'Course funding request season for {season} {year} is now open'),
+        cursor)
+
+def get_recipients(cursor: CursorBase, recipient_kind: str, recipient_arg: str) -> list:
+    """
+    Get the list of email addresses described by recipient_kind and
+    recipient_arg (see queue_email()) using the given cursor.
+    """
+    if recipient_kind == 'all':
+        return db_utils.get_all_emails(cursor)
+    elif recipient_kind == 'dept':
+        return db_utils.get_emails_by_dept(cursor, recipient_arg)
+    elif recipient_kind == 'type':
+        return db_utils.get_emails_by_type(cursor, recipient_arg)
+    else:
+        return []
+
+def claim_timeout(batch_size: int) -> int:
+    """
+    Get the number of seconds that a batch of the given size is set
+    aside for the worker delivering it (see CLAIM_MARGIN)
+    """
+    return batch_size * SMTP_TIMEOUT + CLAIM_MARGIN
+
+def is_connection_error(err: Exception) -> bool:
     """
-    # Get the email adresses of all users
-    email_adresses = db_utils.get_all_emails()
+    Return whether or not the given error (raised while sending an email)
+    means that the SMTP server could not be reached or logged in to, so
+    that no other email would get through right now either
+    """
+    if isinstance(err, (smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected,
+            smtplib.SMTPAuthenticationError)):
+        return True
+    # Every SMTPException is an OSError, but only the others are
+    # problems with the connection (like a refused connection or a timeout)
+    return isinstance(err, OSError) and not isinstance(err, smtplib.SMTPException)
+
+def retry_delay(attempts: int) -> int:
+    """
+    Get the number of seconds to wait before trying to send an email
+    again after it has failed the given number of times (counting the
+    attempt that just failed)
+    """
+    return min(RETRY_BASE_DELAY * (2 ** (attempts - 1)), RETRY_MAX_DELAY)
+
+class SMTPSession:
+    """
+    A connection to the SMTP server that is opened when the first
+    email is sent and reused for every email after that.
 
-    # Create message
-    email_message = MIMEMultipart()
+    SMTPSession is a context manager designed to be used with the 'with'
+    statement. The connection is closed when the block exits.
 
-    # Set up parameters
-    email_message['Subject'] = 'CFR season now open'
-    email_message['TO'] = ','.join(email_adresses)
-    email_message['From'] = cfrenv.getenv('SMTP_ADDRESS')
+    If SMTP_PLAIN is 'yes' in the CFR environment, the connection does not
+    use STARTTLS or log in (which is useful for testing against a local
+    server such as aiosmtpd).
+    """
+    def __init__(self):
+        self._server = None
+
+    def _connect(self):
+        server = smtplib.SMTP(
+            host    = cfrenv.getenv('SMTP_SERVER'),
+            port    = cfrenv.getenv('SMTP_PORT'),
+            timeout = SMTP_TIMEOUT
+        )
+        if cfrenv.getenv('SMTP_PLAIN') != 'yes':
+            server.starttls()
+            server.login(cfrenv.getenv('SMTP_ADDRESS'), cfrenv.getenv('SMTP_PASSWORD'))
+        return server
+
+    def send(self, message):
+        """
+        Send the given email message, connecting to the server first if needed.
+        If the server has dropped the connection since the last message,
+        this reconnects once and tries again.
+        """
+        if self._server is None:
+            self._server = self._connect()
+            self._server.send_message(message)
+            return
+        try:
+            self._server.send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            self._server = self._connect()
+            self._server.send_message(message)
+
+    def close(self):
+        """
+        Close the connection to the server if there is one
+        """
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+def build_message(subject: str, body: str, recipients: list):
+    """
+    Build and return a MIMEMultipart email message from the outbox
+    """
+    message = MIMEMultipart()
+    message['Subject'] = subject
+    message['To'] = ','.join(recipients)
+    message['From'] = cfrenv.getenv('SMTP_ADDRESS')
+    message.attach(MIMEText(body, 'plain'))
+    return message
+
+def deliver_outbox(batch_size: int = DEFAULT_BATCH_SIZE) -> tuple:
+    """
+    Send up to batch_size of the emails that are waiting in the outbox.
+    Returns a tuple of the number of emails that were sent and the number
+    that failed (and will be tried again later).
+
+    The emails are claimed in their own transaction before any of them are
+    sent, so the database is not kept waiting on the mail server. The claim
+    lasts long enough for every email to time out (see claim_timeout()),
+    and if sending still takes so long that the claim is about to run out,
+    the emails that are left are given back to be sent by the next batch,
+    so other workers will not send them too.
+
+    If the SMTP server can not be reached (see is_connection_error()), the
+    email that failed is retried later as usual, and the emails after it
+    are put off for as long without counting it as an attempt.
+    """
+    if not cfrenv.can_do_email():
+        return (0, 0)
+
+    claim = claim_timeout(batch_size)
+    deadline = time.monotonic() + claim - CLAIM_MARGIN
+    with Transaction() as cursor:
+        cursor.execute(SELECT_PENDING_EMAILS, (MAX_ATTEMPTS, batch_size))
+        emails = cursor.fetchall()
+        if len(emails) == 0:
+            return (0, 0)
+        cursor.executemany(CLAIM_EMAIL, [(claim, email[0]) for email in emails])
+
+        # Look up each distinct list of recipients only once
+        recipients = {}
+        for email in emails:
+            key = (email[1], email[2])
+            if key not in recipients:
+                recipients[key] = get_recipients(cursor, email[1], email[2])
+
+    num_sent = 0
+    num_failed = 0
+    # The results that have not been recorded yet
+    sent = []
+    failed = []
+    postponed = []
+    try:
+        with SMTPSession() as session:
+            for (i, (email_id, kind, arg, subject, body, attempts)) in enumerate(emails):
+                if time.monotonic() >= deadline:
+                    postponed += [(0, email[0]) for email in emails[i:]]
+                    break
+                to = recipients[(kind, arg)]
+                # An email with nobody to send it to is simply finished
+                if len(to) == 0:
+                    sent.append((email_id,))
+                else:
+                    try:
+                        session.send(build_message(subject, body, to))
+                        sent.append((email_id,))
+                    except Exception as e:
+                        delay = retry_delay(attempts + 1)
+                        failed.append((repr(e), delay, email_id))
+                        if is_connection_error(e):
+                            postponed += [(delay, email[0]) for email in emails[i + 1:]]
+                            break
+                        # Start over with a new connection for the next email
+                        session.close()
+
+                if len(sent) + len(failed) >= RECORD_EVERY:
+                    _record_results(sent, failed, [])
+                    num_sent += len(sent)
+                    num_failed += len(failed)
+                    (sent, failed) = ([], [])
+    finally:
+        _record_results(sent, failed, postponed)
+    num_sent += len(sent)
+    num_failed += len(failed)
 
-    # Add message body
-    message = create_message(f'Course funding request season for {season} {year} is now open')
-    email_message.attach(MIMEText(message, 'plain'))
+    return (num_sent, num_failed)
 
-    # Send email
-    send_email_notification(email_message)
+def _record_results(sent: list, failed: list, postponed: list):
+    """
+    Record the emails that were sent, failed or put off (as the parameters
+    of MARK_EMAIL_SENT, MARK_EMAIL_FAILED and POSTPONE_EMAIL) in the outbox
+    """
+    if len(sent) == 0 and len(failed) == 0 and len(postponed) == 0:
+        return
+    with Transaction() as cursor:
+        if len(sent) > 0:
+            cursor.executemany(MARK_EMAIL_SENT, sent)
+        if len(failed) > 0:
+            cursor.executemany(MARK_EMAIL_FAILED, failed)
+        if len(postponed) > 0:
+            cursor.executemany(POSTPONE_EMAIL, postponed)
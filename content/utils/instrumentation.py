@@ -0,0 +1,397 @@
+"""
+Records where the time goes while the web server handles a request.
+
+For each request, this keeps track of:
+
+    total       The wall time of the whole request
+    db          The time spent running queries, and how many were run in
+                each Transaction. Every query is counted under the name of
+                the query constant it came from (such as
+                db_utils.SELECT_COURSES), so a query that is run once per
+                row stands out right away.
+    auth        Logging the user in
+    render      Building the page in the request's handler
+    serialize   Turning pages into bytes (page_builder.soup_to_bytes)
+    email       Queueing email notifications
+    stream      Building and sending the sections of a PageStream, which
+                happens after the response has been started
+
+Each timer only counts the time spent in its own code. Time spent in a
+timer inside of it, or in a query, is counted there instead, so the
+timings add up to (about) the total.
+
+When DEBUG is 'yes' in the CFR environment, the timings are sent back
+in a Server-Timing header, which browsers show with the request in their
+developer tools (streamed sections are not included, since the header is
+sent before they are built). Otherwise, each request is written to the
+server's error log (wsgi.errors) as one line of JSON, unless REQUEST_LOG
+is 'no'.
+
+Nothing is recorded outside of a request (for example, in manage.py),
+but the slow query log (see slow_queries) works everywhere.
+"""
+import sys
+import json
+import time
+import threading
+import importlib
+from contextlib import contextmanager
+from . import cfrenv
+from . import metrics
+from . import slow_queries
+
+# The modules whose query constants are used to name the queries
+QUERY_MODULES = [
+    'db_utils', 'request', 'users', 'semesters',
+    'authentication', 'refcache', 'email_notification',
+]
+
+# The name of queries that are not one of the query constants
+UNKNOWN_QUERY = 'other'
+
+# The most queries that are listed by name in the Server-Timing header
+MAX_TIMING_QUERIES = 10
+
+# The key in the WSGI environ that the RequestStats of the request are
+# put in, so that whatever called the application (such as the benchmark
+# in debug.py) can read them once the response has been sent
+STATS_KEY = 'cfr.stats'
+
+# The most built queries (see _query_name()) that are remembered
+MAX_NAME_CACHE = 1000
+
+# Thread-local storage used to keep track of the current request's stats
+_local = threading.local()
+
+# Maps the text of each query constant to its name, and the part of each
+# constant that is built with str.format() before the first '{' to its
+# name. Both are filled in by _load_query_names() the first time they
+# are needed
+_query_names = None
+_query_prefixes = None
+
+# Names of the built queries that have been seen already
+_name_cache = {}
+
+def _load_query_names():
+    """
+    Find the query constants in each of the QUERY_MODULES
+    """
+    global _query_names, _query_prefixes
+    names = {}
+    prefixes = []
+    for module_name in QUERY_MODULES:
+        module = importlib.import_module('.' + module_name, __package__)
+        for (name, value) in vars(module).items():
+            if not name.isupper() or not isinstance(value, str):
+                continue
+            if not value.lstrip().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE')):
+                continue
+            names[value] = name
+            if '{' in value:
+                prefixes.append((value[:value.index('{')], name))
+    # Check the longest prefixes first so the most specific one wins
+    prefixes.sort(key=lambda prefix: len(prefix[0]), reverse=True)
+    _query_prefixes = prefixes
+    _query_names = names
+
+def _query_name(query: str) -> str:
+    """
+    Get the name of the query constant that the given query came from,
+    or UNKNOWN_QUERY if it didn't come from one
+    """
+    if _query_names is None:
+        _load_query_names()
+    name = _query_names.get(query)
+    if name is not None:
+        return name
+
+    # The query may have been built from a constant with str.format()
+    name = _name_cache.get(query)
+    if name is None:
+        name = UNKNOWN_QUERY
+        for (prefix, prefix_name) in _query_prefixes:
+            if query.startswith(prefix):
+                name = prefix_name
+                break
+        if len(_name_cache) < MAX_NAME_CACHE:
+            _name_cache[query] = name
+    return name
+
+class RequestStats:
+    """
+    The timings for one request (see the top of this file)
+
+    timers maps the name of each timer to the number of seconds counted
+    by it, queries maps the name of each query to a list of the number
+    of times it was run and the number of seconds it took, and
+    transactions has a list of the number of queries and the seconds
+    they took for each Transaction.
+    """
+    def __init__(self):
+        self.start          = time.perf_counter()
+        self.timers         = {}
+        self.queries        = {}
+        self.transactions   = []
+        # A list for each timer that is running of its name, the time it
+        # started and the number of seconds that belong to something else
+        self._running       = []
+
+    def elapsed(self) -> float:
+        """
+        Get the number of seconds since the request started
+        """
+        return time.perf_counter() - self.start
+
+    @property
+    def db_time(self) -> float:
+        return sum(seconds for (_, seconds) in self.queries.values())
+
+    @property
+    def query_count(self) -> int:
+        return sum(count for (count, _) in self.queries.values())
+
+    def add_time(self, name: str, seconds: float):
+        """
+        Count the given number of seconds for the timer with the
+        given name, and not for the timer it happened inside of
+        """
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+        if len(self._running) > 0:
+            self._running[-1][2] += seconds
+
+    def add_query(self, name: str, seconds: float, transaction: list):
+        """
+        Count a query with the given name that took the given number of
+        seconds in the given transaction (from begin_transaction())
+        """
+        counts = self.queries.get(name)
+        if counts is None:
+            counts = self.queries[name] = [0, 0.0]
+        counts[0] += 1
+        counts[1] += seconds
+        transaction[0] += 1
+        transaction[1] += seconds
+        if len(self._running) > 0:
+            self._running[-1][2] += seconds
+
+    def begin_transaction(self) -> list:
+        """
+        Start counting the queries of a new Transaction
+        """
+        transaction = [0, 0.0]
+        self.transactions.append(transaction)
+        return transaction
+
+    def server_timing(self) -> str:
+        """
+        Get the value of the Server-Timing header for the request so far
+        """
+        metrics = [
+            _metric('total', self.elapsed()),
+            _metric('db', self.db_time,
+                f"{self.query_count} queries in {len(self.transactions)} transactions"),
+        ]
+        for (name, seconds) in self.timers.items():
+            metrics.append(_metric(name, seconds))
+        most_run = sorted(self.queries.items(), key=lambda query: query[1][0], reverse=True)
+        for (name, (count, seconds)) in most_run[:MAX_TIMING_QUERIES]:
+            metrics.append(_metric('q_' + name, seconds, f"{count}x {name}"))
+        return ', '.join(metrics)
+
+    def log_record(self, environ: dict, status: str) -> dict:
+        """
+        Get the line that is logged for the request
+        (with the given WSGI environ and status) as a dict
+        """
+        return {
+            'time':         time.strftime('%Y-%m-%d %H:%M:%S'),
+            'method':       environ.get('REQUEST_METHOD', 'GET'),
+            'path':         environ.get('PATH_INFO', '/'),
+            'status':       int(status.split(' ')[0]) if status is not None else None,
+            'total_ms':     _ms(self.elapsed()),
+            'db_ms':        _ms(self.db_time),
+            'queries':      self.query_count,
+            'transactions': [[count, _ms(seconds)] for (count, seconds) in self.transactions],
+            'timers_ms':    {name: _ms(seconds) for (name, seconds) in self.timers.items()},
+            'query_counts': {name: count for (name, (count, _)) in self.queries.items()},
+        }
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
+
+def _metric(name: str, seconds: float, description: str = None) -> str:
+    """
+    Format one metric of a Server-Timing header
+    """
+    metric = f"{name};dur={_ms(seconds)}"
+    if description is not None:
+        metric += f';desc="{description}"'
+    return metric
+
+def current() -> RequestStats:
+    """
+    Get the stats of the request being handled on this
+    thread, or None if there isn't one
+    """
+    return getattr(_local, 'stats', None)
+
+@contextmanager
+def timer(name: str):
+    """
+    A context manager that counts the time spent inside of it for the
+    timer with the given name. This does nothing outside of a request.
+
+    Example:
+
+    with instrumentation.timer('auth'):
+        user = authentication.authenticate_from_cookie(cookies)
+    """
+    stats = current()
+    if stats is None:
+        yield
+        return
+    running = [name, time.perf_counter(), 0.0]
+    stats._running.append(running)
+    try:
+        yield
+    finally:
+        stats._running.pop()
+        elapsed = time.perf_counter() - running[1]
+        stats.add_time(name, elapsed - running[2])
+        # The timer this one is inside of should only count its own
+        # time, but add_time() already took off the part counted here
+        if len(stats._running) > 0:
+            stats._running[-1][2] += running[2]
+
+def timed(name: str, iterable):
+    """
+    Iterate over the given iterable, counting the time taken to get
+    each item for the timer with the given name
+    """
+    iterator = iter(iterable)
+    while True:
+        stats = current()
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            if stats is not None:
+                stats.add_time(name, time.perf_counter() - start)
+        yield item
+
+class InstrumentedCursor:
+    """
+    Wraps a cursor so that the time taken by each query is counted for
+    the current request (if stats is given) and slow queries are written
+    to the slow query log (if slow_after, the number of seconds a query
+    must take to be slow, is given). Everything else is passed along to
+    the wrapped cursor. sql_connection.Transaction returns one of these
+    while a request is being handled or the slow query log is on.
+
+    connection is the connection the cursor belongs to, which slow
+    queries are EXPLAINed on.
+    """
+    def __init__(self, cursor, connection, stats: RequestStats = None, slow_after: float = None):
+        self._cursor        = cursor
+        self._connection    = connection
+        self._stats         = stats
+        self._slow_after    = slow_after
+        if stats is not None:
+            self._transaction = stats.begin_transaction()
+
+    def _count(self, operation, params, seconds: float, many: bool, failed: bool):
+        """
+        Count a query that took the given number of seconds. Queries that
+        failed are counted, but there is nothing to EXPLAIN for them.
+        """
+        name = _query_name(operation)
+        if self._stats is not None:
+            self._stats.add_query(name, seconds, self._transaction)
+        if self._slow_after is not None and seconds >= self._slow_after and not failed:
+            slow_queries.record(self._connection, name, operation, params, seconds, many)
+
+    def execute(self, operation, params = None, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = self._cursor.execute(operation, params, *args, **kwargs)
+        except Exception:
+            self._count(operation, params, time.perf_counter() - start, False, True)
+            raise
+        self._count(operation, params, time.perf_counter() - start, False, False)
+        return result
+
+    def executemany(self, operation, seq_params, *args, **kwargs):
+        seq_params = list(seq_params)
+        start = time.perf_counter()
+        try:
+            result = self._cursor.executemany(operation, seq_params, *args, **kwargs)
+        except Exception:
+            self._count(operation, seq_params, time.perf_counter() - start, True, True)
+            raise
+        self._count(operation, seq_params, time.perf_counter() - start, True, False)
+        return result
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+def instrument_cursor(cursor, connection):
+    """
+    Get the given cursor (from the given connection) wrapped in an
+    InstrumentedCursor if a request is being handled or the slow query
+    log is on, or the cursor itself otherwise
+    """
+    stats = current()
+    slow_after = slow_queries.threshold()
+    if stats is None and slow_after is None:
+        return cursor
+    return InstrumentedCursor(cursor, connection, stats, slow_after)
+
+def wrap(app: callable) -> callable:
+    """
+    Wrap the given WSGI application so that the timings of each
+    request are recorded and reported (as described above), and
+    counted for the /metrics page (see metrics)
+    """
+    def application(environ, start_response):
+        stats = RequestStats()
+        environ[STATS_KEY] = stats
+        cfrenv.load_environ(environ)
+        debug = cfrenv.getenv('DEBUG') == 'yes'
+        status = None
+
+        def timing_response(_status, headers, exc_info = None):
+            nonlocal status
+            status = _status
+            if debug:
+                headers = list(headers) + [('Server-Timing', stats.server_timing())]
+            if exc_info is None:
+                return start_response(_status, headers)
+            return start_response(_status, headers, exc_info)
+
+        _local.stats = stats
+        result = app(environ, timing_response)
+        failed = False
+        try:
+            yield from result
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+            _local.stats = None
+            # A response that breaks off part of the way through is an error,
+            # even if it started out as a success
+            metrics.observe(environ.get(metrics.ROUTE_KEY, metrics.NO_ROUTE),
+                '500' if failed else status, stats.elapsed())
+            if not debug and cfrenv.getenv('REQUEST_LOG') != 'no':
+                errors = environ.get('wsgi.errors', sys.stderr)
+                errors.write(json.dumps(stats.log_record(environ, status)) + '\n')
+
+    return application
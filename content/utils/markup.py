@@ -0,0 +1,108 @@
+"""
+Functions for building html as escaped strings rather than
+BeautifulSoup trees.
+
+This is the basis of the 'string' rendering backend in component_builder.
+The html produced here is written to be exactly what BeautifulSoup would
+produce when serializing the equivalent tags with its default formatter
+(attributes in alphabetical order, '&', '<' and '>' escaped in text and
+attribute values, and void elements such as input closed with '/>').
+"""
+from bs4 import Tag
+from bs4.element import PreformattedString
+
+# Elements that never have content or a closing tag
+VOID_ELEMENTS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'keygen', 'link', 'menuitem', 'meta', 'param', 'source',
+    'track', 'wbr'
+}
+
+class Html(str):
+    """
+    A string of html that has already been rendered and escaped.
+    This is what element() returns.
+    """
+    pass
+
+class Markup(PreformattedString):
+    """
+    A finished piece of html that has already been rendered and escaped.
+
+    Markup is a kind of BeautifulSoup string, so it can be appended to
+    or inserted into a soup like any other element, and it will be output
+    as-is (rather than escaped) when the soup is serialized.
+    """
+    pass
+
+def escape(text) -> str:
+    """
+    Escape the given value (converted to a string)
+    for use as the text inside of an element.
+    """
+    return str(text).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def quote_attribute(value) -> str:
+    """
+    Escape and quote the given value for use as an attribute value.
+
+    Lists and tuples are joined with spaces (like class lists). The value
+    is quoted with double quotes unless it contains a double quote (and
+    no single quotes), in which case single quotes are used.
+    """
+    if isinstance(value, (list, tuple)):
+        value = ' '.join(value)
+    value = escape(value)
+    if '"' in value:
+        if "'" in value:
+            return '"' + value.replace('"', '&quot;') + '"'
+        return "'" + value + "'"
+    return '"' + value + '"'
+
+def render(content) -> str:
+    """
+    Render the given content into a string of html.
+
+    content can be Html or Markup (which is returned unchanged), a
+    BeautifulSoup or Tag (which is serialized), None (which renders as
+    nothing) or anything else (which is converted to a string and escaped).
+    """
+    if content is None:
+        return ''
+    if isinstance(content, (Html, Markup)):
+        return str(content)
+    if isinstance(content, Tag):
+        return content.decode()
+    return escape(content)
+
+def element(name: str, attrs: dict = None, content = None) -> Html:
+    """
+    Render an html element with the given tag name, attributes and content
+    and return it as Html.
+
+    attrs is a dictionary of attribute names and values (or None for no
+    attributes). Attributes with a value of None are left out.
+    content is rendered with render() unless it is a list, in which case
+    each item is rendered and joined together.
+    """
+    html = '<' + name
+    if attrs:
+        for key in sorted(attrs.keys()):
+            if attrs[key] is not None:
+                html += ' ' + key + '=' + quote_attribute(attrs[key])
+
+    if name in VOID_ELEMENTS:
+        return Html(html + '/>')
+
+    if isinstance(content, list):
+        inner = ''.join([render(c) for c in content])
+    else:
+        inner = render(content)
+    return Html(html + '>' + inner + '</' + name + '>')
+
+def join(parts: list) -> Markup:
+    """
+    Join together a list of anything that render() accepts
+    into a single piece of Markup.
+    """
+    return Markup(''.join([render(p) for p in parts]))
@@ -0,0 +1,373 @@
+"""
+Counts the requests handled by the web server and exports them, along
+with the state of the server, in the Prometheus text format for the
+/metrics page (see wsgi_main).
+
+The following are exported:
+
+    cfr_requests_total              Requests handled, by route and status
+    cfr_request_duration_seconds    A histogram of how long requests took,
+                                    by route
+    cfr_cache_hits_total            Hits and misses of each named
+    cfr_cache_misses_total          cache.TTLCache, and the ratio
+    cfr_cache_hit_ratio             between them
+    cfr_db_pool_*                   The connections in the connection pools
+                                    (see sql_connection)
+    cfr_email_outbox_*              The emails waiting in the outbox (these
+                                    are read from the database by wsgi_main).
+                                    cfr_email_outbox_up is 0 and the others
+                                    are left out if it could not be read
+    cfr_metrics_processes           The number of server processes that
+                                    are reporting metrics
+
+The route of a request is the top part of its path if it has a handler,
+or 'none' if it doesn't, so a scan of made-up paths does not add new
+labels. A request that failed after its response was started is counted
+as a 500.
+
+Every server process counts its own requests. When the server runs more
+than one process (as mod_wsgi usually does), METRICS_DIR must be set in
+the CFR environment to a directory that every process can write to. Each
+process then writes its counts to a file in that directory (at most once
+every FLUSH_INTERVAL seconds) and /metrics adds up the files of every
+process. The counts of processes that have exited are kept, but their
+gauges (such as open connections) are not. Without METRICS_DIR, /metrics
+only has the counts of the process that answers it.
+"""
+import os
+import json
+import ipaddress
+import time
+import fcntl
+import threading
+from . import cfrenv
+from . import cache
+
+# The upper bounds (in seconds) of the buckets of the request histograms
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The route of requests that do not have a handler
+NO_ROUTE = 'none'
+
+# The key in the WSGI environ that wsgi_main sets to the route of the request
+ROUTE_KEY = 'cfr.route'
+
+# Number of seconds between writing this process's counts to METRICS_DIR
+FLUSH_INTERVAL = 1.0
+
+# The names of the files in METRICS_DIR: one for each running process
+# and one that the counts of processes that have exited are added to
+PROCESS_FILE_PREFIX = 'process-'
+EXITED_FILE         = 'exited.json'
+LOCK_FILE           = 'metrics.lock'
+
+# The addresses that may see the /metrics page if METRICS_ALLOWED_IPS
+# is not set in the CFR environment
+DEFAULT_ALLOWED_IPS = '127.0.0.1, ::1'
+
+# The MIME Type of the /metrics page
+METRICS_MIME = "text/plain; version=0.0.4; charset=utf-8"
+
+# The counts of this process. requests maps (route, status) to the number
+# of requests, and durations maps each route to a list of the number of
+# requests in each bucket (with one more for slower requests), the total
+# number of seconds and the number of requests
+_requests = {}
+_durations = {}
+_lock = threading.Lock()
+
+# Whether the counts have changed since they were last written, and the
+# process that the thread writing them was started in (see _start_flusher())
+_dirty = False
+_flusher_pid = None
+
+# Functions that are called to get the gauges of this process
+# (see collect_gauges())
+_gauge_collectors = []
+
+def collect_gauges(collector: callable) -> callable:
+    """
+    A decorator that registers the decorated function to be called for the
+    gauges of this process whenever they are exported. It should return a
+    dictionary mapping the name of each gauge to its value, and the gauges
+    of every running process are added up.
+    """
+    _gauge_collectors.append(collector)
+    return collector
+
+def is_allowed(address: str) -> bool:
+    """
+    Check if a client with the given IP address may see the /metrics page.
+    METRICS_ALLOWED_IPS is a comma-separated list of addresses and
+    networks (such as 10.0.0.0/8) that may see it.
+    """
+    if address is None:
+        return False
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    allowed = cfrenv.getenv('METRICS_ALLOWED_IPS') or DEFAULT_ALLOWED_IPS
+    for network in allowed.split(','):
+        network = network.strip()
+        if network == '':
+            continue
+        try:
+            if address in ipaddress.ip_network(network, strict=False):
+                return True
+        except ValueError:
+            continue # Skip anything that isn't an address
+    return False
+
+def observe(route: str, status: str, seconds: float):
+    """
+    Count a request to the given route that was answered with
+    the given status (such as '200 OK') and took the given time
+    """
+    global _dirty
+    code = status.split(' ')[0] if status is not None else '500'
+    bucket = 0
+    while bucket < len(DURATION_BUCKETS) and seconds > DURATION_BUCKETS[bucket]:
+        bucket += 1
+    with _lock:
+        key = (route, code)
+        _requests[key] = _requests.get(key, 0) + 1
+        histogram = _durations.get(route)
+        if histogram is None:
+            histogram = _durations[route] = [0] * (len(DURATION_BUCKETS) + 1) + [0.0, 0]
+        histogram[bucket] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+        _dirty = True
+    if cfrenv.getenv('METRICS_DIR') is not None and _flusher_pid != os.getpid():
+        _start_flusher()
+
+def snapshot() -> dict:
+    """
+    Get this process's counts and gauges as a dictionary
+    that can be stored as JSON
+    """
+    with _lock:
+        requests = [[route, code, count] for ((route, code), count) in _requests.items()]
+        durations = {route: list(histogram) for (route, histogram) in _durations.items()}
+    gauges = {}
+    for collector in _gauge_collectors:
+        gauges.update(collector())
+    return {
+        'pid':          os.getpid(),
+        'requests':     requests,
+        'durations':    durations,
+        'caches':       {name: [c.hits, c.misses] for (name, c) in cache.named_caches().items()},
+        'gauges':       gauges,
+    }
+
+def _write_json(path: str, data: dict):
+    """
+    Replace the file at the given path with the given data as JSON, all
+    at once so that nothing reading it sees half of it
+    """
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as temp:
+        json.dump(data, temp)
+    os.replace(temp_path, path)
+
+def _process_file(directory: str) -> str:
+    return os.path.join(directory, f"{PROCESS_FILE_PREFIX}{os.getpid()}.json")
+
+def flush():
+    """
+    Write this process's counts to its file in METRICS_DIR
+    (if METRICS_DIR is set)
+    """
+    global _dirty
+    directory = cfrenv.getenv('METRICS_DIR')
+    if directory is None:
+        return
+    _dirty = False
+    _write_json(_process_file(directory), snapshot())
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        if _dirty:
+            try:
+                flush()
+            except OSError:
+                pass # Try again next time
+
+def _start_flusher():
+    """
+    Start the thread that writes this process's counts to METRICS_DIR.
+    Threads do not survive a fork, so this is done once in each process.
+    """
+    global _flusher_pid
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_loop, name='metrics-flusher', daemon=True).start()
+
+def _is_running(pid: int) -> bool:
+    """
+    Check if the process with the given id is still running
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass # It is running as someone else
+    return True
+
+def _read_json(path: str) -> dict:
+    """
+    Read a file written by _write_json(), or return None if it is
+    gone or unreadable (such as when its process is being cleaned up)
+    """
+    try:
+        with open(path) as data:
+            return json.load(data)
+    except (OSError, ValueError):
+        return None
+
+def _merge(total: dict, counts: dict):
+    """
+    Add the counts (but not the gauges) of one snapshot()
+    to another one
+    """
+    requests = {(route, code): count for (route, code, count) in total['requests']}
+    for (route, code, count) in counts['requests']:
+        requests[(route, code)] = requests.get((route, code), 0) + count
+    total['requests'] = [[route, code, count] for ((route, code), count) in requests.items()]
+    for (route, histogram) in counts['durations'].items():
+        if route in total['durations']:
+            histogram = [a + b for (a, b) in zip(total['durations'][route], histogram)]
+        total['durations'][route] = histogram
+    for (name, (hits, misses)) in counts['caches'].items():
+        (total_hits, total_misses) = total['caches'].get(name, (0, 0))
+        total['caches'][name] = [total_hits + hits, total_misses + misses]
+
+def _empty_snapshot() -> dict:
+    return {'requests': [], 'durations': {}, 'caches': {}, 'gauges': {}}
+
+def _process_files(directory: str) -> list:
+    """
+    Get the paths of the process files in the given directory,
+    as tuples of the process id and the path
+    """
+    files = []
+    for name in os.listdir(directory):
+        if name.startswith(PROCESS_FILE_PREFIX) and name.endswith('.json'):
+            pid = int(name[len(PROCESS_FILE_PREFIX):-len('.json')])
+            files.append((pid, os.path.join(directory, name)))
+    return files
+
+def _collect_exited(directory: str, files: list) -> list:
+    """
+    Add the counts of every process in the given list of process files
+    that has exited to the EXITED_FILE and remove their files, so the
+    directory does not keep growing as processes are replaced.
+
+    Returns the files of the processes that are still running.
+    """
+    running = [(pid, path) for (pid, path) in files if _is_running(pid)]
+    if len(running) == len(files):
+        return running
+    exited_path = os.path.join(directory, EXITED_FILE)
+    total = _read_json(exited_path) or _empty_snapshot()
+    for (pid, path) in files:
+        if (pid, path) not in running:
+            counts = _read_json(path)
+            if counts is not None:
+                _merge(total, counts)
+    _write_json(exited_path, total)
+    for (pid, path) in files:
+        if (pid, path) not in running:
+            os.remove(path)
+    return running
+
+def collect() -> tuple:
+    """
+    Get the counts of every process (or just this one if METRICS_DIR
+    is not set) added together in one snapshot(), along with the
+    number of processes that are running
+    """
+    directory = cfrenv.getenv('METRICS_DIR')
+    if directory is None:
+        return (snapshot(), 1)
+
+    flush()
+    # Only one process at a time may collect, so that the counts of
+    # a process that has exited are never added up twice
+    with open(os.path.join(directory, LOCK_FILE), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        running = _collect_exited(directory, _process_files(directory))
+        total = _read_json(os.path.join(directory, EXITED_FILE)) or _empty_snapshot()
+        processes = 0
+        for (_, path) in running:
+            counts = _read_json(path)
+            if counts is None:
+                continue
+            processes += 1
+            _merge(total, counts)
+            for (gauge, value) in counts['gauges'].items():
+                total['gauges'][gauge] = total['gauges'].get(gauge, 0) + value
+    return (total, processes)
+
+def _labels(**labels) -> str:
+    escaped = [
+        key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+        for (key, value) in labels.items()
+    ]
+    return '{' + ','.join(escaped) + '}'
+
+def _number(value) -> str:
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def render(extra_gauges: dict = {}) -> bytes:
+    """
+    Export the metrics of every process, along with the given
+    gauges, in the Prometheus text format
+    """
+    (total, processes) = collect()
+    lines = []
+
+    def header(name: str, kind: str, description: str):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    header('cfr_requests_total', 'counter', 'Requests handled, by route and status')
+    for (route, code, count) in sorted(total['requests']):
+        lines.append(f"cfr_requests_total{_labels(route=route, status=code)} {count}")
+
+    header('cfr_request_duration_seconds', 'histogram', 'How long requests took, by route')
+    for route in sorted(total['durations']):
+        histogram = total['durations'][route]
+        cumulative = 0
+        for (bound, count) in zip(DURATION_BUCKETS + ('+Inf',), histogram):
+            cumulative += count
+            lines.append(f"cfr_request_duration_seconds_bucket{_labels(route=route, le=bound)} {cumulative}")
+        lines.append(f"cfr_request_duration_seconds_sum{_labels(route=route)} {_number(histogram[-2])}")
+        lines.append(f"cfr_request_duration_seconds_count{_labels(route=route)} {histogram[-1]}")
+
+    header('cfr_cache_hits_total', 'counter', 'Lookups that were found in each cache')
+    for (name, (hits, _)) in sorted(total['caches'].items()):
+        lines.append(f"cfr_cache_hits_total{_labels(cache=name)} {hits}")
+    header('cfr_cache_misses_total', 'counter', 'Lookups that were not found in each cache')
+    for (name, (_, misses)) in sorted(total['caches'].items()):
+        lines.append(f"cfr_cache_misses_total{_labels(cache=name)} {misses}")
+    header('cfr_cache_hit_ratio', 'gauge', 'The fraction of lookups in each cache that were found')
+    for (name, (hits, misses)) in sorted(total['caches'].items()):
+        ratio = hits / (hits + misses) if hits + misses > 0 else 0.0
+        lines.append(f"cfr_cache_hit_ratio{_labels(cache=name)} {_number(ratio)}")
+
+    gauges = dict(total['gauges'])
+    gauges.update(extra_gauges)
+    gauges['cfr_metrics_processes'] = processes
+    for name in sorted(gauges):
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {_number(gauges[name])}")
+
+    return ('\n'.join(lines) + '\n').encode('utf-8')
@@ -0,0 +1,323 @@
+"""
+WSGI middleware that wraps wsgi_main's application to compress responses
+and answer conditional GET requests.
+
+Responses with a text content type are compressed with brotli (if the
+brotli module is installed) or gzip, whichever the client prefers in its
+Accept-Encoding header. This can be turned off by setting COMPRESSION to
+'no' in the CFR environment (for example, if the web server already
+compresses responses itself).
+
+Every successful GET response gets a strong ETag: the one the application
+set, if it set one, or else a hash of the body. When the client's
+If-None-Match header has the same ETag, the body is dropped and 304 Not
+Modified is sent instead. Responses that are streamed (see
+page_builder.PageStream) are sent as they are built, so they are never
+hashed and only have an ETag if the application set one. Every other
+response is sent all at once with a Content-Length.
+
+Handlers that can tell whether a page has changed without building it
+(see page_etag()) should check not_modified() first and respond with 304
+themselves, so the page is not built at all.
+"""
+import zlib
+import hashlib
+from pathlib import Path
+from . import cfrenv
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content types that are compressed
+COMPRESSIBLE_TYPES = ['text/', 'application/json', 'application/javascript']
+
+# Compression levels for gzip (1-9) and brotli (0-11)
+GZIP_LEVEL      = 6
+BROTLI_QUALITY  = 5
+
+# The key in the WSGI environ that wsgi_main sets to True when the
+# response is being streamed, so it must not be held back
+STREAMING_KEY = 'cfr.streaming'
+
+# The directory whose files the pages are built from (see page_etag())
+CONTENT_DIR = Path(__file__).parent.parent
+
+# The version of the code and html files, as found by _code_version()
+_code_version_cache = None
+
+def _code_version() -> str:
+    """
+    Get a string that changes whenever any of the python or html files
+    that pages are built from are changed. This is only found once per
+    process, unless DEBUG is 'yes' in the CFR environment.
+    """
+    global _code_version_cache
+    if _code_version_cache is not None and cfrenv.getenv('DEBUG') != 'yes':
+        return _code_version_cache
+    latest = 0
+    for pattern in ('*.py', '*.html'):
+        for path in CONTENT_DIR.rglob(pattern):
+            latest = max(latest, path.stat().st_mtime_ns)
+    _code_version_cache = str(latest)
+    return _code_version_cache
+
+def make_etag(*parts) -> str:
+    """
+    Make a strong ETag (including its quotes) from a hash of the
+    given parts, which may be bytes or anything else that can be
+    converted to a string
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode('utf-8')
+        digest.update(part)
+        digest.update(b'\0')
+    return '"' + digest.hexdigest()[:32] + '"'
+
+def page_etag(data_version: str, *parts) -> str:
+    """
+    Make an ETag for a page that is built from the database, without
+    building the page.
+
+    data_version is the version of the data the page is built from
+    (from db_utils.get_data_version()) and parts should include everything
+    else the page depends on, such as the user and the query string.
+    The version of the code is included too, so pages change when the
+    server is updated.
+    """
+    return make_etag(_code_version(), data_version, *parts)
+
+def _accepted_encodings(environ: dict) -> dict:
+    """
+    Parse the request's Accept-Encoding header into a dictionary
+    mapping each encoding to its q-value
+    """
+    accepted = {}
+    for item in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        fields = item.strip().split(';')
+        name = fields[0].strip().lower()
+        if name == '':
+            continue
+        quality = 1.0
+        for param in fields[1:]:
+            (key, _, value) = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+    return accepted
+
+def choose_encoding(environ: dict) -> str:
+    """
+    Choose the encoding ('br' or 'gzip') to compress the response to
+    the given request with, or None if it should not be compressed
+    """
+    if cfrenv.getenv('COMPRESSION') == 'no':
+        return None
+    accepted = _accepted_encodings(environ)
+    choices = ['gzip']
+    if brotli is not None:
+        choices.insert(0, 'br')
+    best = None
+    for encoding in choices:
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    return best[0] if best is not None else None
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    """
+    Get the ETag for the given encoding of a response, since a
+    strong ETag must be different for each encoding
+    """
+    if encoding is None:
+        return etag
+    return etag[:-1] + '-' + encoding + '"'
+
+def not_modified(environ: dict, etag: str) -> bool:
+    """
+    Check if the request's If-None-Match header matches the given ETag
+    (or any encoding of it), meaning the client already has the response
+    """
+    header = environ.get('HTTP_IF_NONE_MATCH')
+    if header is None:
+        return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return True
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        for encoding in ('br', 'gzip'):
+            suffix = '-' + encoding + '"'
+            if tag.endswith(suffix):
+                tag = tag[:-len(suffix)] + '"'
+        if tag == etag:
+            return True
+    return False
+
+def _get_header(headers: list, name: str) -> str:
+    """
+    Get the value of the header with the given name from a
+    list of (name, value) tuples, or None if it isn't there
+    """
+    for (key, value) in headers:
+        if key.lower() == name.lower():
+            return value
+    return None
+
+def _without_headers(headers: list, *names) -> list:
+    """
+    Get a copy of a list of (name, value) tuples
+    without the headers with the given names
+    """
+    names = [name.lower() for name in names]
+    return [(key, value) for (key, value) in headers if key.lower() not in names]
+
+def _is_compressible(headers: list) -> bool:
+    """
+    Check if a response with the given headers should be compressed
+    """
+    if _get_header(headers, 'Content-Encoding') is not None:
+        return False
+    content_type = _get_header(headers, 'Content-Type') or ''
+    return any(content_type.startswith(t) for t in COMPRESSIBLE_TYPES)
+
+def _add_vary(headers: list) -> list:
+    """
+    Add Accept-Encoding to the Vary header in the given headers
+    """
+    vary = _get_header(headers, 'Vary')
+    if vary is None:
+        return headers + [('Vary', 'Accept-Encoding')]
+    if 'accept-encoding' in vary.lower():
+        return headers
+    return _without_headers(headers, 'Vary') + [('Vary', vary + ', Accept-Encoding')]
+
+class _Compressor:
+    """
+    Compresses a response a piece at a time with the given encoding.
+    Each piece is flushed so that it can be sent right away.
+    """
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            # 31 is the window size for a gzip header and trailer
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == 'br':
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """
+    Compress a whole response with the given encoding ('br' or 'gzip')
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+def wrap(app: callable) -> callable:
+    """
+    Wrap the given WSGI application with compression and conditional
+    GET support (as described above) and return the new application
+    """
+    def application(environ, start_response):
+        status = None
+        headers = None
+        started = False
+
+        def capture_response(_status, _headers, exc_info = None):
+            nonlocal status, headers
+            # Once the response has been started, it is too late
+            # to change it, so the error goes to the server
+            if exc_info is not None and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            status = _status
+            headers = list(_headers)
+            return _write
+
+        def _write(data):
+            raise RuntimeError("write() is not supported. Yield the response instead.")
+
+        result = app(environ, capture_response)
+        try:
+            chunks = iter(result)
+            first = next(chunks, b'')
+            streaming = environ.get(STREAMING_KEY, False)
+
+            # Compressing is decided per request, so caches must know that
+            encoding = None
+            if _is_compressible(headers):
+                encoding = choose_encoding(environ)
+                headers = _add_vary(headers)
+
+            # Responses that set cookies (like logging in) are never cached
+            code = status.split(' ')[0]
+            cacheable = (
+                environ.get('REQUEST_METHOD', 'GET') in ('GET', 'HEAD') and
+                code in ('200', '304') and
+                _get_header(headers, 'Set-Cookie') is None
+            )
+            etag = _get_header(headers, 'ETag')
+            headers = _without_headers(headers, 'ETag', 'Content-Length')
+
+            # A streamed response is sent as it is built, so it
+            # only has an ETag if the application gave it one
+            if not streaming:
+                body = first + b''.join(chunks)
+                if cacheable and etag is None and code == '200':
+                    etag = make_etag(body)
+
+            if cacheable and etag is not None:
+                headers.append(('ETag', encoded_etag(etag, encoding)))
+                if _get_header(headers, 'Cache-Control') is None:
+                    headers.append(('Cache-Control', 'private, no-cache'))
+                if code == '304' or not_modified(environ, etag):
+                    started = True
+                    start_response('304 Not Modified', headers)
+                    return
+
+            if streaming:
+                if encoding is not None:
+                    headers.append(('Content-Encoding', encoding))
+                started = True
+                start_response(status, headers)
+                if encoding is None:
+                    yield first
+                    yield from chunks
+                    return
+                # Send each piece as soon as it is ready
+                compressor = _Compressor(encoding)
+                yield compressor.compress(first)
+                for chunk in chunks:
+                    yield compressor.compress(chunk)
+                yield compressor.finish()
+                return
+
+            if encoding is not None and len(body) > 0:
+                body = compress(body, encoding)
+                headers.append(('Content-Encoding', encoding))
+            headers.append(('Content-Length', str(len(body))))
+            started = True
+            start_response(status, headers)
+            yield body
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    return application
@@ -0,0 +1,308 @@
+"""
+Applies the schema migrations in sql/migrations and checks that the
+queries used by the server are able to use indexes.
+
+Each migration is a .sql file named with its version number and a
+description (such as 001_query_indexes.sql), and migrations are applied
+in order of their version numbers. The versions that have been applied
+are recorded in the schema_migrations table, so each one is only applied
+once.
+
+Migrations must also be safe to apply to a database that already has
+their changes (such as one created from the latest create_schema.sql),
+so errors saying that a table, column or index already exists (or that
+one being dropped does not exist) are ignored.
+
+Statements in a migration are separated by semicolons, so semicolons
+must not appear anywhere else (such as inside of strings).
+"""
+import os
+import re
+from mysql.connector import Error as MySQLError
+from mysql.connector.cursor import CursorBase
+from .sql_connection import Transaction
+from . import db_utils
+from . import request
+from . import email_notification
+
+# Where migrations are found by default (relative to a checkout of the repository)
+MIGRATIONS_DIR = os.path.normpath(
+    os.path.join(os.path.dirname(__file__), '..', '..', 'sql', 'migrations'))
+
+# Migration file names look like "001_description.sql"
+MIGRATION_FILE = re.compile(r'^(?P<version>\d+)_.*\.sql$')
+
+# MySQL error codes that mean a migration's change was already made
+ALREADY_APPLIED_ERRORS = {
+    1050,   # Table already exists
+    1060,   # Duplicate column name
+    1061,   # Duplicate key name
+    1091,   # Can't DROP; check that column/key exists
+}
+
+# Query to create the table that records which migrations were applied
+CREATE_MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations(
+    version     INT NOT NULL,
+    name        VARCHAR(255) NOT NULL,
+    applied     DATETIME NOT NULL,
+
+    PRIMARY KEY (version)
+)
+"""
+
+# Query to get the versions of all applied migrations
+# Returned columns are: version
+SELECT_APPLIED = """
+SELECT version
+FROM schema_migrations
+"""
+
+# Query to record that a migration was applied
+# Parameters are: version, name
+INSERT_APPLIED = """
+INSERT INTO schema_migrations (version, name, applied)
+VALUES (%s, %s, NOW())
+"""
+
+def find_migrations(directory: str = MIGRATIONS_DIR) -> list:
+    """
+    Get a list of every migration in the given directory, as tuples of
+    the version number and file name, in the order they should be applied.
+    """
+    migrations = []
+    for name in os.listdir(directory):
+        match = MIGRATION_FILE.match(name)
+        if match:
+            migrations.append((int(match.group('version')), name))
+    migrations.sort()
+    return migrations
+
+def split_statements(sql: str) -> list:
+    """
+    Split the text of a migration into a list of its statements,
+    leaving out comments.
+    """
+    sql = re.sub(r'/\*.*?\*/', '', sql, flags=re.DOTALL)
+    sql = re.sub(r'^\s*(--|#).*$', '', sql, flags=re.MULTILINE)
+    return [s.strip() for s in sql.split(';') if s.strip() != '']
+
+def get_pending(cursor: CursorBase, directory: str = MIGRATIONS_DIR) -> list:
+    """
+    Get a list of the migrations (as in find_migrations()) in the given
+    directory that have not been applied yet, using the given cursor.
+    """
+    cursor.execute(CREATE_MIGRATIONS_TABLE)
+    cursor.execute(SELECT_APPLIED)
+    applied = {row[0] for row in cursor.fetchall()}
+    return [m for m in find_migrations(directory) if m[0] not in applied]
+
+def apply_migration(cursor: CursorBase, directory: str, version: int, name: str, log: callable = print):
+    """
+    Apply one migration using the given cursor and record that it was applied.
+    """
+    with open(os.path.join(directory, name), 'r') as f:
+        statements = split_statements(f.read())
+    for statement in statements:
+        try:
+            cursor.execute(statement)
+        except MySQLError as e:
+            if e.errno not in ALREADY_APPLIED_ERRORS:
+                raise
+            log(f"  (already done: {e.msg})")
+    cursor.execute(INSERT_APPLIED, (version, name))
+
+def migrate(directory: str = MIGRATIONS_DIR, dry_run: bool = False, log: callable = print) -> list:
+    """
+    Apply every pending migration in the given directory, in order, and
+    return a list of the ones that were applied. Each migration is applied
+    in its own Transaction (though MySQL commits most schema changes
+    immediately anyway).
+
+    If dry_run is True, the pending migrations are only listed.
+    """
+    with Transaction() as cursor:
+        pending = get_pending(cursor, directory)
+
+    if len(pending) == 0:
+        log("The database is up to date.")
+    for (version, name) in pending:
+        if dry_run:
+            log(f"Would apply {name}")
+            continue
+        log(f"Applying {name}")
+        with Transaction() as cursor:
+            apply_migration(cursor, directory, version, name, log)
+    return pending
+
+# Parameters used to EXPLAIN the queries below
+_REVISION = ('CS', 'Fall', 2019, 0)
+_SEMESTER = ('Fall', 2019)
+
+# Every query that check_indexes() checks, as tuples of the module
+# it belongs to, its name and the parameters to EXPLAIN it with
+QUERY_CHECKS = [
+    (db_utils, 'SELECT_COURSES',                    _REVISION),
+    (db_utils, 'SELECT_TOTAL_COST',                 _REVISION),
+    (db_utils, 'SELECT_COURSE_APPROVALS',           _REVISION),
+    (db_utils, 'SELECT_SAVINGS',                    _REVISION),
+    (db_utils, 'SELECT_TOTAL_SAVINGS',              _REVISION),
+    (db_utils, 'SELECT_CFR_DEPT',                   _REVISION[:3]),
+    (db_utils, 'SELECT_REVISIONS',                  _REVISION[:3]),
+    (db_utils, 'SELECT_ALL_REVISIONS',              _REVISION[:1]),
+    (db_utils, 'SELECT_SEMESTER_REVISION_COURSES',  _REVISION[:3]),
+    (db_utils, 'SELECT_ALL_REVISION_COURSES',       _REVISION[:1]),
+    (db_utils, 'LATEST_REVISIONS',                  _SEMESTER),
+    (db_utils, 'SELECT_LATEST_CFRS',                _SEMESTER + _SEMESTER),
+    (db_utils, 'SELECT_LATEST_COURSES',             _SEMESTER + _SEMESTER),
+    (db_utils, 'REFRESH_CFR_TOTALS',                _REVISION),
+    (db_utils, 'REFRESH_SEMESTER_CFR_TOTALS',       _REVISION[:3]),
+    (db_utils, 'SELECT_SEMESTERS_APPROVED_BY',      ('admin', 'admin')),
+    (db_utils, 'COURSE_TOTALS_BY_ID',               (1,)),
+    (db_utils, 'SAVINGS_TOTALS_BY_ID',              (1,)),
+    (db_utils, 'SET_CFR_TOTALS',                    (0, 0, 0, 0, 0) + _REVISION),
+    (db_utils, 'SELECT_CFR_STORAGE',                _REVISION),
+    (db_utils, 'SELECT_SEMESTER_STORAGE',           _REVISION[:3]),
+    (db_utils, 'UNMATERIALIZE_CFR',                 _REVISION),
+    (db_utils, 'SELECT_COURSE_LINKS',               _REVISION),
+    (db_utils, 'SELECT_SAVINGS_LINKS',              _REVISION),
+    (db_utils, 'SELECT_SEMESTER_COURSE_LINKS',      _REVISION[:3]),
+    (db_utils, 'SELECT_SEMESTER_SAVINGS_LINKS',     _REVISION[:3]),
+    (db_utils, 'SELECT_SEMESTER_COURSE_DELTAS',     _REVISION[:3]),
+    (db_utils, 'SELECT_SEMESTER_SAVINGS_DELTAS',    _REVISION[:3]),
+    (db_utils, 'SELECT_COURSES_BY_ID',              (1,)),
+    (db_utils, 'SELECT_COURSE_APPROVALS_BY_ID',     (1,)),
+    (db_utils, 'SELECT_SAVINGS_BY_ID',              (1,)),
+    (db_utils, 'SELECT_DIFF_COURSES',               (1,)),
+    (db_utils, 'SELECT_DATA_VERSIONS',              ('reference', 'cfr')),
+    (db_utils, 'ACTIVE_SEMESTER_QUERY',             ()),
+    (db_utils, 'SEMESTERS_QUERY',                   ()),
+    (db_utils, 'USERNAMES_QUERY',                   ()),
+    (db_utils, 'SELECT_USER',                       ('admin',)),
+    (db_utils, 'DEPARTMENTS_QUERY',                 ()),
+    (db_utils, 'ALL_EMAILS',                        ()),
+    (db_utils, 'EMAILS_BY_DEPT',                    ('CS',)),
+    (db_utils, 'EMAILS_BY_TYPE',                    ('approver',)),
+    (request,  'SELECT_COURSE_HASHES',              _REVISION),
+    (request,  'SELECT_SAVINGS_HASHES',             _REVISION),
+    (request,  'CARRY_FORWARD_COURSES',             _REVISION[:3] + (1,) + _REVISION),
+    (request,  'CARRY_FORWARD_SAVINGS',             _REVISION[:3] + (1,) + _REVISION),
+    (request,  'MOVE_COURSE_LINKS',                 (1,) + _REVISION),
+    (request,  'MOVE_SAVINGS_LINKS',                (1,) + _REVISION),
+    (request,  'DELETE_CFR_COURSE',                 (1,) + _REVISION),
+    (request,  'DELETE_CFR_SAVINGS',                (1,) + _REVISION),
+    (request,  'SELECT_APPROVAL_KEYS',              _REVISION),
+    (request,  'APPROVE_COURSES',                   (1, 'EM', 1, 100, 'admin', 1)),
+    (request,  'SELECT_LATEST_REVISION_NUMS',       _SEMESTER + ('CS',)),
+    (request,  'ADD_COMMITMENTS',                   ('CS', 0) + _SEMESTER + ('CS', 0)),
+    (email_notification, 'SELECT_OUTBOX_BACKLOG',   (email_notification.MAX_ATTEMPTS,) * 3),
+]
+
+# How to format the queries in QUERY_CHECKS that are built
+# for a number of rows (here, always for one row)
+QUERY_FORMATS = {
+    (request, 'APPROVE_COURSES'):               (request.APPROVAL_CASE, '%s'),
+    (request, 'SELECT_LATEST_REVISION_NUMS'):   ('%s',),
+    (request, 'ADD_COMMITMENTS'):               (request.COMMITMENT_CASE, request.COMMITMENT_CFR),
+    (db_utils, 'COURSE_TOTALS_BY_ID'):          ('%s',),
+    (db_utils, 'SAVINGS_TOTALS_BY_ID'):         ('%s',),
+    (db_utils, 'SELECT_COURSES_BY_ID'):         ('%s',),
+    (db_utils, 'SELECT_COURSE_APPROVALS_BY_ID'):('%s',),
+    (db_utils, 'SELECT_SAVINGS_BY_ID'):         ('%s',),
+    (db_utils, 'SELECT_DIFF_COURSES'):          ('%s',),
+}
+
+# Queries that check_indexes() does not check, because they do
+# not read from any tables (other than the row they insert), or
+# because they are meant to read every row (and are only run offline)
+UNCHECKED_QUERIES = {
+    (db_utils, 'NEW_CFR_DEPT'),
+    (db_utils, 'NEW_REVISION'),
+    (db_utils, 'REFRESH_ALL_CFR_TOTALS'),
+    (db_utils, 'SELECT_CFR_TOTAL_MISMATCHES'),
+    (db_utils, 'SELECT_UNMATERIALIZED_CFRS'),
+    (request,  'INSERT_COURSES'),
+    (request,  'INSERT_SAVINGS'),
+    (request,  'INSERT_CFR_COURSE'),
+    (request,  'INSERT_CFR_SAVINGS'),
+    (request,  'INSERT_COURSE_DELTA'),
+    (request,  'INSERT_SAVINGS_DELTA'),
+    (request,  'GET_ID_INCREMENT'),
+}
+
+def _query_constants(module) -> list:
+    """
+    Get the names of every query constant defined in the given module
+    """
+    return [
+        name for (name, value) in vars(module).items()
+        if name.isupper() and isinstance(value, str) and
+            re.match(r'\s*(SELECT|INSERT|UPDATE|DELETE)\b', value)
+    ]
+
+def explain(cursor: CursorBase, query: str, params: tuple) -> list:
+    """
+    EXPLAIN the given query with the given parameters using the given
+    cursor, and return the rows of the plan as dicts.
+    """
+    cursor.execute("EXPLAIN " + query, params)
+    columns = cursor.column_names
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def check_plan(plan: list) -> tuple:
+    """
+    Check whether every table read in the given plan (from explain())
+    uses an index.
+
+    Returns a tuple of two lists of messages: problems (tables that are
+    read without any usable index) and notes (tables with a usable index
+    that MySQL chose not to use, which usually means the table is too
+    small for the index to be worth it).
+    """
+    problems = []
+    notes = []
+    for row in plan:
+        table = row.get('table')
+        # Skip derived tables, unions and the table being inserted into
+        if table is None or table.startswith('<') or row.get('select_type') == 'INSERT':
+            continue
+        if row.get('key') is not None:
+            continue
+        if row.get('possible_keys') is not None:
+            notes.append(f"{table}: not using {row['possible_keys']} (table is probably too small)")
+        else:
+            problems.append(f"{table}: read without an index ({row.get('type')})")
+    return (problems, notes)
+
+def check_indexes(cursor: CursorBase, log: callable = print) -> bool:
+    """
+    EXPLAIN every query in QUERY_CHECKS using the given cursor and check
+    that each one can use an index for every table it reads. Any query
+    constant in db_utils or request that is in neither QUERY_CHECKS nor
+    UNCHECKED_QUERIES is also reported, so new queries are not missed.
+
+    Returns True if all of the checks passed.
+    """
+    passed = True
+    checked = set()
+    for (module, name, params) in QUERY_CHECKS:
+        checked.add((module, name))
+        query = getattr(module, name)
+        if (module, name) in QUERY_FORMATS:
+            query = query.format(*QUERY_FORMATS[(module, name)])
+        (problems, notes) = check_plan(explain(cursor, query, params))
+        if len(problems) > 0:
+            passed = False
+            log(f"FAIL {name}")
+        else:
+            log(f"ok   {name}")
+        for message in problems + notes:
+            log(f"       {message}")
+
+    for module in (db_utils, request):
+        for name in _query_constants(module):
+            if (module, name) not in checked and (module, name) not in UNCHECKED_QUERIES:
+                passed = False
+                log(f"FAIL {name} (not in migrations.QUERY_CHECKS)")
+
+    return passed
@@ -1,19 +1,28 @@
 """
 Functions for using BeatifulSoup to construct web pages
 """
+import os
+import re
+import copy
 import traceback
 from datetime import datetime
 from pathlib import Path
+from urllib.parse import urlencode
 from bs4 import BeautifulSoup as Soup
 from bs4 import Comment
+from bs4 import Tag
 from . import cfrenv
 from . import component_builder
 from . import request
 from . import users
 from . import semesters
 from . import db_utils
+from . import markup
+from . import middleware
+from . import instrumentation
 from .sql_connection import Transaction
 from .authentication import User, UserRole
+from .errors import Error400
 
 # The RESOURCE_DIR refers to directory containing resource files
 # loaded by the page builder. Usually, these are html files that
@@ -22,23 +31,83 @@ from .authentication import User, UserRole
 # Right now, this is pointing to the directory 'resource' in the web root
 RESOURCE_DIR = Path(__file__).parent.parent.joinpath("resource")
 
+# The name of the placeholder elements that mark where the
+# sections of a PageStream go
+STREAM_PLACEHOLDER = 'cfr-stream-section'
+
+# A PageStream collects at least this many bytes of its sections
+# before sending them, rather than sending every row on its own
+STREAM_CHUNK_SIZE = 16 * 1024
+
+# The value of the 'view' parameter that makes the revisions page (and
+# /revision_history) show only what changed in each revision
+DIFF_VIEW = 'diff'
+
+# Cache of parsed html files. Maps the path of each file to a tuple
+# of the file's modification time and its parsed BeautifulSoup (with
+# all comments already removed). These soups must never be modified;
+# soup_from_file hands out copies of them.
+_template_cache = {}
+
+# The tag that marks where the #pagecontent element was taken out
+# of page_wrapper.html when it is split up by _wrapper_pieces
+WRAPPER_MARKER = 'cfr-page-content'
+
+# Cache of the pieces of page_wrapper.html (see _wrapper_pieces). Maps
+# includeNavbar to a tuple of the cached soup they were made from and
+# the pieces
+_wrapper_cache = {}
+
+# Cache of fully-rendered pages that only depend on the content
+# of html files (see render_page_from_file). Maps the arguments used
+# to build each page to a tuple of the cached soups it was built from,
+# the encoded page and its ETag
+_rendered_page_cache = {}
+
+def _load_template(url) -> Soup:
+    """
+    Get the parsed BeautifulSoup for the html file at the given path
+    from the template cache, parsing it first if it is not already
+    cached. The returned soup must not be modified.
+
+    Each file is only parsed once per process, unless the environment
+    variable 'DEBUG' is 'yes', in which case a file is parsed again
+    whenever it has been modified.
+    """
+    cached = _template_cache.get(url)
+    if cached is not None and cfrenv.getenv('DEBUG') != 'yes':
+        return cached[1]
+
+    mtime = os.path.getmtime(url)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(url) as f:
+        soup = Soup(f, "html.parser")
+    for comment in soup.find_all(text=lambda text:isinstance(text, Comment)):
+        comment.extract()
+    _template_cache[url] = (mtime, soup)
+    return soup
+
 def soup_from_file(path, absolute_path = False) -> Soup:
     """
     Parse an html file into a BeautifulSoup and return it.
+    All html comments in the file are removed.
 
     By default, this will look for the given filename inside
     the RESOURCE_DIR, but if absolute_path is True, then the path
     will be interpreted as an absolute path for a file anywhere on
     the machine.
+
+    Files are only actually parsed once and cached, so this returns a
+    copy of the cached soup which can be modified freely.
     """
     if (absolute_path):
         url = path
     else:
         url = RESOURCE_DIR.joinpath(path)
 
-    with open(url) as f:
-        soup = Soup(f, "html.parser")
-    return soup
+    return copy.copy(_load_template(url))
 
 def soup_from_text(text) -> Soup:
     """
@@ -59,10 +128,48 @@ def insert_at_id(containing_soup: Soup, tag_id, content, raw_text = False):
     containing_soup.find(id=tag_id).append(content)
 
 
+def _wrapper_pieces(includeNavbar: bool) -> tuple:
+    """
+    Split page_wrapper.html (with or without the navbar) into the text
+    before its #pagecontent element, the #pagecontent element itself and
+    the text after it. This is only done once per process, unless
+    page_wrapper.html changes (see _load_template).
+    """
+    wrapper = _load_template(RESOURCE_DIR.joinpath("page_wrapper.html"))
+    cached = _wrapper_cache.get(includeNavbar)
+    if cached is not None and cached[0] is wrapper:
+        return cached[1]
+
+    page = copy.copy(wrapper)
+    if not includeNavbar:
+        page.find(id='main-navigation').extract()
+    marker = page.new_tag(WRAPPER_MARKER)
+    content = page.find(id='pagecontent').replace_with(marker)
+    (head, tail) = str(page).split(str(marker))
+    pieces = (head, str(content), tail)
+    _wrapper_cache[includeNavbar] = (wrapper, pieces)
+    return pieces
+
+class WrappedPage(Soup):
+    """
+    A page built by build_page_around_content.
+
+    Only the page's #pagecontent element is parsed into the soup. The rest
+    of page_wrapper.html is kept as text and put around it when the page
+    is turned into a string, so elements outside of #pagecontent (like the
+    navbar) can not be found or changed.
+    """
+    def __init__(self, includeNavbar: bool = True):
+        (self._head, content, self._tail) = _wrapper_pieces(includeNavbar)
+        super().__init__(content, "html.parser")
+
+    def decode(self, *args, **kwargs) -> str:
+        return self._head + super().decode(*args, **kwargs) + self._tail
+
 def build_page_around_content(content, raw_text = False, includeNavbar = True) -> Soup:
     """
     Build a full page with the given content as the page's content
-    and return it as a BeautifulSoup.
+    and return it as a BeautifulSoup (a WrappedPage).
 
     If includeNavbar is False, then the navbar will not be present
     on the built page.
@@ -71,10 +178,7 @@ def build_page_around_content(content, raw_text = False, includeNavbar = True) -
     it will first be parsed into a BeautifulSoup before being inserted.
     Unless raw_text is True in which case it will be inserted directly.
     """
-    page = soup_from_file("page_wrapper.html")
-    if not includeNavbar:
-        navbar = page.find(id='main-navigation')
-        navbar.extract()
+    page = WrappedPage(includeNavbar)
     if not isinstance(content, Soup) and not raw_text:
         content = soup_from_text(content)
     page.find(id='pagecontent').append(content)
@@ -118,9 +222,11 @@ window.location.href = window.location.pathname + "?dept="+encodeURIComponent(th
     
     # Create options from list of departments
     departments = db_utils.quick_exec(db_utils.get_departments)
+    # (Always built as soup since callers look for the first option)
     options = component_builder.build_option_list(
         departments,
-        selector= (lambda n, i, v: n == current_dept)
+        selector= (lambda n, i, v: n == current_dept),
+        backend= component_builder.SOUP_BACKEND
     )
     select.append(options)
 
@@ -131,11 +237,113 @@ def soup_to_bytes(soup: Soup) -> bytes:
     Encode a BeautifulSoup into an array of bytes encoded in UTF-8.
     This is what will be sent back to the web server.
 
-    This process will also remove all html comments.
+    (html comments are not included because they were already removed
+    when the html files were loaded by soup_from_file)
     """
-    for comment in soup.find_all(text=lambda text:isinstance(text, Comment)):
-        comment.extract()
-    return str(soup).encode('UTF-8')
+    with instrumentation.timer('serialize'):
+        return str(soup).encode('UTF-8')
+
+class PageStream:
+    """
+    A page that is sent to the client a piece at a time, so that the
+    start of the page goes out before the rest of it has been built, and
+    the whole page never has to be held in memory at once.
+
+    page is the rest of the page as a BeautifulSoup (usually built with
+    build_page_around_content or build_page_from_file). The large parts
+    of the page are left out of it: instead, section() is called with an
+    iterable of the parts of each one, and the placeholder it returns is
+    put wherever that section belongs in the page.
+
+    Iterating over a PageStream yields the page as bytes encoded in UTF-8
+    (like soup_to_bytes): everything before the first placeholder (the
+    page's head and navbar), then the parts of each section as they are
+    built, and finally the rest of the page. A PageStream can be returned
+    by a handler in wsgi_main instead of bytes.
+
+    Sections are built while the page is being sent, which is after the
+    request's RequestScope has ended. They must not use the database, so
+    anything they need should be read before the PageStream is returned.
+
+    Example:
+
+    page = build_page_around_content(heading)
+    stream = PageStream(page)
+    page.find(id='pagecontent').append(stream.section(
+        component_builder.iter_revision_history(course_lists)
+    ))
+    return stream
+    """
+    _placeholder_regex = re.compile(
+        f'<{STREAM_PLACEHOLDER} data-section="(\\d+)"></{STREAM_PLACEHOLDER}>'
+    )
+
+    def __init__(self, page: Soup):
+        self.page = page
+        self._sections = []
+
+    def section(self, parts) -> Tag:
+        """
+        Add a section made of the given parts and return the placeholder
+        tag that marks where it goes in the page.
+
+        parts is an iterable (usually a generator) of anything that
+        markup.render() accepts, which is only iterated over while
+        the page is being sent.
+        """
+        placeholder = self.page.new_tag(STREAM_PLACEHOLDER)
+        placeholder['data-section'] = str(len(self._sections))
+        self._sections.append(parts)
+        return placeholder
+
+    def __iter__(self):
+        # Every other piece is the number of a section
+        pieces = self._placeholder_regex.split(str(self.page))
+        # Send the start of the page right away
+        yield pieces[0].encode('UTF-8')
+
+        buffer = []
+        size = 0
+        for i in range(1, len(pieces), 2):
+            for part in self._sections[int(pieces[i])]:
+                chunk = markup.render(part).encode('UTF-8')
+                buffer.append(chunk)
+                size += len(chunk)
+                if size >= STREAM_CHUNK_SIZE:
+                    yield b''.join(buffer)
+                    buffer = []
+                    size = 0
+            buffer.append(pieces[i + 1].encode('UTF-8'))
+        yield b''.join(buffer)
+
+def render_page_from_file(path, includeNavbar = True) -> bytes:
+    """
+    Build a full page with the contents of the given html file (inside
+    the RESOURCE_DIR) as the page's content and return it already encoded
+    as bytes (like soup_to_bytes).
+
+    Because the page depends on nothing but the files it is built from,
+    it is only built once and cached until one of the files changes.
+    """
+    wrapper = _load_template(RESOURCE_DIR.joinpath("page_wrapper.html"))
+    content = _load_template(RESOURCE_DIR.joinpath(path))
+
+    key = (path, includeNavbar)
+    cached = _rendered_page_cache.get(key)
+    if cached is not None and cached[0] is wrapper and cached[1] is content:
+        return cached[2]
+
+    page = soup_to_bytes(build_page_from_file(path, includeNavbar = includeNavbar))
+    _rendered_page_cache[key] = (wrapper, content, page, middleware.make_etag(page))
+    return page
+
+def rendered_page_etag(path, includeNavbar = True) -> str:
+    """
+    Get the ETag of the page that render_page_from_file returns for the
+    same arguments, which is only computed when the page is rendered.
+    """
+    render_page_from_file(path, includeNavbar = includeNavbar)
+    return _rendered_page_cache[(path, includeNavbar)][3]
 
 def build_login_page(message = None):
     """
@@ -150,10 +358,13 @@ def build_login_page(message = None):
         insert_at_id(page, 'loginp', error_message)
     return page
 
-def build_cfr_page(user: User) -> Soup:
+def build_cfr_page(user: User) -> PageStream:
     """
     Build the course funding request page for the given user and
-    return it as a BeautifulSoup
+    return it as a PageStream.
+
+    For approvers, the modal with each department's courses is
+    only built while the page is being sent.
     """
 
     # If the user is a submitter, build the cfr submission page
@@ -161,12 +372,12 @@ def build_cfr_page(user: User) -> Soup:
         page = build_page_from_file("cfr.html")
         # Build table body from current courses list
         courses = db_utils.quick_exec(db_utils.get_current_courses, user.dept_name)
-        body = component_builder.build_edit_course_table_body(courses)
-        body['id'] = 'cfrTable'
+        body = component_builder.build_edit_course_table_body(courses, tbody_id='cfrTable')
 
         # Insert table body after table head
         table_head = page.find('table',id='cfrTable_full').find('thead')
         table_head.insert_after(body)
+        return PageStream(page)
 
     # Otherwise build the approval page
     else:
@@ -178,39 +389,49 @@ def build_cfr_page(user: User) -> Soup:
         table_head = page.find('table', id='approveTable').find('thead')
         table_head.insert_after(body)
 
-        # Iterate through each department in the data
-        for (i, dept_name) in enumerate(data['dept_names']):
+        # The modals are added at the end of the page's content
+        stream = PageStream(page)
+        page.find(id='pagecontent').append(stream.section(_build_approval_modals(data)))
+        return stream
 
-            # Create a modal to contain the course approval table for
-            # this department
-            cfr_modal_content = soup_from_text("")
-            cfr_modal_id = f"modal_cfr_{i}"
+def _build_approval_modals(data: dict):
+    """
+    Build the modal for each department on the approver course funding
+    request page and yield them one at a time.
 
-            # Only courses that have not yet been approved are shown
-            unapproved_courses = [cl for cl in data['course_lists'][i] if cl[11] is None]
+    data is the dictionary returned by db_utils.get_approver_data()
+    """
+    # Iterate through each department in the data
+    for (i, dept_name) in enumerate(data['dept_names']):
 
-            if len(unapproved_courses) == 0:
-                cfr_modal_content.append("No unapproved courses left")
-            else:
-                # Build the course approval table and a submit button
-                cfr_modal_content.append(component_builder.build_approve_course_table(
-                    unapproved_courses
-                ))
-                cfr_submit = cfr_modal_content.new_tag('button')
-                cfr_submit['class'] = 'btn btn-primary'
-                cfr_submit['onclick'] = f"approveCFR(\"{cfr_modal_id}\", \"{dept_name}\")"
-                cfr_submit.string = "Submit"
-                cfr_modal_content.append(cfr_submit)
-
-            # Add modal to page
-            cfr_modal = component_builder.build_modal(
-                f"{dept_name} Courses",
-                cfr_modal_id,
-                cfr_modal_content
-            )
-            page.body.append(cfr_modal)
+        # Create a modal to contain the course approval table for
+        # this department
+        cfr_modal_content = soup_from_text("")
+        cfr_modal_id = f"modal_cfr_{i}"
 
-    return page
+        # Only courses that have not yet been approved are shown
+        unapproved_courses = [cl for cl in data['course_lists'][i] if cl[11] is None]
+
+        if len(unapproved_courses) == 0:
+            cfr_modal_content.append("No unapproved courses left")
+        else:
+            # Build the course approval table and a submit button
+            cfr_modal_content.append(component_builder.build_approve_course_table(
+                unapproved_courses
+            ))
+            cfr_submit = cfr_modal_content.new_tag('button')
+            cfr_submit['class'] = 'btn btn-primary'
+            cfr_submit['onclick'] = f"approveCFR(\"{cfr_modal_id}\", \"{dept_name}\")"
+            cfr_submit.string = "Submit"
+            cfr_modal_content.append(cfr_submit)
+
+        # Add modal to page
+        cfr_modal = component_builder.build_modal(
+            f"{dept_name} Courses",
+            cfr_modal_id,
+            cfr_modal_content
+        )
+        yield cfr_modal
 
 def build_savings_page(user: User, dept_override: str = None) -> Soup:
     """
@@ -227,8 +448,7 @@ def build_savings_page(user: User, dept_override: str = None) -> Soup:
         page = build_page_from_file("salary_saving.html")
         # Build table body from current salary list
         savings = db_utils.quick_exec(db_utils.get_current_savings, user.dept_name)
-        body = component_builder.build_edit_savings_table_body(savings)
-        body['id'] = 'salaryTable'
+        body = component_builder.build_edit_savings_table_body(savings, tbody_id='salaryTable')
 
         # Insert table body after table head
         table_head = page.find('table',id='salaryTable_full').find('thead')
@@ -264,15 +484,18 @@ def build_savings_page(user: User, dept_override: str = None) -> Soup:
 
         return build_page_around_content(content)
 
-def build_revisions_page(user: User, dept_override: str = None):
+def build_revisions_page(user: User, dept_override: str = None, view: str = None) -> PageStream:
     """
     Build the revisions page for the given user and return it as 
-    a BeautifulSoup.
+    a PageStream.
 
     If the user is an approver or admin, a dept_override can be added
     to change which department's revisions are displayed. dept_override
     is ignored if the user is a submitter. For submitters, only their
     own department's revisions will be shown.
+
+    If view is DIFF_VIEW, each revision only shows the courses that
+    changed since the revision before it, instead of all of its courses.
     """
     content = soup_from_text("")
 
@@ -289,26 +512,40 @@ def build_revisions_page(user: User, dept_override: str = None):
 
     content.append(soup_from_text(f"<h1>Revision History ({dept_name})</h1>"))
 
-    # course_lists is a list of lists of courses representing the revision
-    # history of the department
-    course_lists = []
+    # Link to the other view of the same department's revisions
+    link = soup_from_text("<p><a></a></p>")
+    if view == DIFF_VIEW:
+        link.a['href'] = "/revisions?" + urlencode({'dept': dept_name})
+        link.a.string = "Show every course in each revision"
+    else:
+        link.a['href'] = "/revisions?" + urlencode({'dept': dept_name, 'view': DIFF_VIEW})
+        link.a.string = "Show only the changes in each revision"
+    content.append(link)
+
     with Transaction() as cursor:
-        revisions = db_utils.get_all_revisions_for_active_semester(cursor, dept_name)
-        for revision in revisions:
-            courses = db_utils.get_courses(cursor, revision)
-            course_lists.append(courses)
+        semester = db_utils.get_active_semester(cursor)
+        if view == DIFF_VIEW:
+            diffs = db_utils.get_revision_diffs(cursor, dept_name, semester)
+        else:
+            history = db_utils.get_revision_history(cursor, dept_name, semester)
 
     # Build the revision history and add it to the page
-    history = component_builder.build_revision_history(course_lists)
-    content.append(history)
-
     page = build_page_around_content(content)
-    return page
-
-def build_previous_semesters_page(user: User, dept_override: str = None):
+    stream = PageStream(page)
+    if view == DIFF_VIEW:
+        history = component_builder.build_revision_diffs(diffs)
+    else:
+        # course_lists is a list of lists of courses representing the revision
+        # history of the department. Each revision is built as it is sent
+        course_lists = history.get((semester[0], int(semester[1])), [])
+        history = stream.section(component_builder.iter_revision_history(course_lists))
+    page.find(id='pagecontent').append(history)
+    return stream
+
+def build_previous_semesters_page(user: User, dept_override: str = None) -> PageStream:
     """
     Build the prevision semesters page for the given user and return it as 
-    a BeautifulSoup.
+    a PageStream.
 
     If the user is an approver or admin, a dept_override can be added
     to change which department's history is displayed. dept_override
@@ -329,29 +566,108 @@ def build_previous_semesters_page(user: User, dept_override: str = None):
         content.append(selector)
 
     content.append(soup_from_text(f"<h1>Full Revision History ({dept_name})</h1>"))
+    # The script loads the history for the other tabs when they are opened
+    content.append(soup_from_text('<script src="static/js/custom.history.js"></script>'))
 
-    # histories is a list of lists of lists of courses (yes, really)
-    # Representing the revision histories for each semester in the department
+    # Only the history for the first tab is loaded with the page.
+    # The other tabs get a placeholder which will load their history
+    # from /revision_history when the tab is opened
     histories = []
     tab_names = []
     tab_ids = []
+    page = build_page_around_content(content)
+    stream = PageStream(page)
     with Transaction() as cursor:
-        for s in db_utils.get_semesters(cursor):
-            revisions = []
-            for r in db_utils.get_all_revisions_for_semester(cursor, dept_name, s):
-                revisions.append(db_utils.get_courses(cursor, r))
-
-            # Build a revision history for this semester and create a tab for it
-            histories.append(component_builder.build_revision_history(revisions))
-            tab_names.append(f"{s[0]}, {s[1]}")
-            tab_ids.append(f"{s[0]}{s[1]}")
+        semester_list = db_utils.get_semesters(cursor)
+        if len(semester_list) > 0:
+            first_history = db_utils.get_revision_history(cursor, dept_name, semester_list[0])
+
+    for (i, s) in enumerate(semester_list):
+        if i == 0:
+            # The first tab's history is built as it is sent
+            revisions = first_history.get((s[0], int(s[1])), [])
+            histories.append(stream.section(component_builder.iter_revision_history(revisions)))
+        else:
+            url = "/revision_history?" + urlencode({
+                'dept': dept_name,
+                'semester': s[0],
+                'year': s[1]
+            })
+            histories.append(component_builder.build_lazy_placeholder(url))
+        tab_names.append(f"{s[0]}, {s[1]}")
+        tab_ids.append(f"{s[0]}{s[1]}")
 
     # Build tab pane and add it to page
     tabs = component_builder.build_tabs(histories, tab_names, tab_ids)
-    content.append(tabs)
+    page.find(id='pagecontent').append(tabs)
+    return stream
 
-    page = build_page_around_content(content)
-    return page
+def build_revision_history_data(user: User, semester: tuple, dept_override: str = None, view: str = None) -> dict:
+    """
+    Get the revision history for a department in the given semester as
+    a dictionary that can be sent to the client as JSON. This is used by
+    the previous semesters page to fill in tabs when they are opened.
+
+    semester is a tuple containing the season and cal_year
+    of the semester (in that order).
+
+    If the user is an approver or admin, dept_override must be given
+    to choose which department's history is returned. dept_override
+    is ignored if the user is a submitter. For submitters, only their
+    own department's history will be returned.
+
+    The returned dictionary has the fields:
+        'headers':      The user-readable column headers for each table
+        'revisions':    A list with one element for each revision (latest
+                        revision first), each being a list of courses where
+                        each course is a list of the strings to display in
+                        each column.
+
+    If view is DIFF_VIEW, only the courses that changed in each revision are
+    returned instead (see db_utils.get_revision_diffs()), and each element of
+    'revisions' is a dictionary with the fields:
+        'added':        A list of the courses added in the revision
+        'removed':      A list of the courses removed in the revision
+        'changed':      A list of the courses changed in the revision, each
+                        being a dictionary with the fields 'before' and 'after'
+                        (the course before and after the change) and 'fields'
+                        (the headers of the columns that changed)
+        'unchanged':    The number of courses that did not change
+    """
+    if user.role == UserRole.SUBMITTER:
+        dept_name = user.dept_name
+    else:
+        dept_name = dept_override
+    if dept_name is None:
+        raise Error400("Missing 'dept' parameter!")
+
+    if view == DIFF_VIEW:
+        with Transaction() as cursor:
+            diffs = db_utils.get_revision_diffs(cursor, dept_name, semester)
+        strings = lambda course: [str(v) for v in course]
+        headers = dict(zip(db_utils.REQ_FIELDS, component_builder.COURSE_TABLE_HEADERS))
+        return {
+            'headers':      component_builder.COURSE_TABLE_HEADERS,
+            'revisions':    [{
+                'added':        [strings(course) for course in diff['added']],
+                'removed':      [strings(course) for course in diff['removed']],
+                'changed':      [{
+                    'before':   strings(before),
+                    'after':    strings(after),
+                    'fields':   [headers[field] for field in fields]
+                } for (before, after, fields) in diff['changed']],
+                'unchanged':    diff['unchanged']
+            } for diff in diffs]
+        }
+
+    with Transaction() as cursor:
+        history = db_utils.get_revision_history(cursor, dept_name, semester)
+    course_lists = history.get((semester[0], int(semester[1])), [])
+
+    return {
+        'headers':      component_builder.COURSE_TABLE_HEADERS,
+        'revisions':    [[[str(v) for v in course] for course in courses] for courses in course_lists]
+    }
 
 def build_help_page(user: User):
     """
@@ -362,6 +678,30 @@ def build_help_page(user: User):
     else:
         return build_page_from_file("help_approver.html")
 
+def _help_page_file(user: User) -> str:
+    """
+    Get the name of the html file with the help page for the given user
+    """
+    if user.role == UserRole.SUBMITTER:
+        return "help_submitter.html"
+    else:
+        return "help_approver.html"
+
+def render_help_page(user: User) -> bytes:
+    """
+    Build a help page for the given user and return it encoded as bytes.
+    Unlike build_help_page, this uses render_page_from_file so
+    the page is only built once.
+    """
+    return render_page_from_file(_help_page_file(user))
+
+def help_page_etag(user: User) -> str:
+    """
+    Get the ETag of the help page for the given user
+    (as returned by render_help_page)
+    """
+    return rendered_page_etag(_help_page_file(user))
+
 def build_admin_page():
     """
     Build the admin controls page and return it as a BeautifulSoup
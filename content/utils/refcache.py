@@ -0,0 +1,92 @@
+"""
+A per-process cache for reference data that almost never changes but is
+needed on nearly every request: the active semester, the list of
+semesters and the list of departments.
+
+Anything that changes this data must call invalidate() with the cursor
+it made the change with. That clears this process's cache and bumps a
+version number in the cache_version table as part of the same
+transaction. Every process checks that version (at most once per
+RequestScope) and clears its own cache when it has changed, so a change
+made by one server process is seen by all of them.
+"""
+from mysql.connector.cursor import CursorBase
+from .cache import TTLCache
+from . import sql_connection
+
+# Number of seconds anything is kept in the cache, even if
+# the version never changes
+CACHE_TTL = 300
+
+# The name of this cache's row in the cache_version table
+VERSION_NAME = 'reference'
+
+# Query to get the current version of the reference data
+# Returned columns are: version
+# Parameters are: name
+SELECT_VERSION = """
+SELECT version
+FROM cache_version
+WHERE name = %s
+"""
+
+# Query to bump the version of the reference data (creating the row if needed)
+# Parameters are: name
+BUMP_VERSION = """
+INSERT INTO cache_version (name, version)
+VALUES (%s, 1)
+ON DUPLICATE KEY UPDATE version = version + 1
+"""
+
+# Key used to remember (in RequestScope.locals) that the
+# version has already been checked during this request
+_SCOPE_KEY = 'refcache_checked'
+
+_cache = TTLCache(max_size = 16, ttl = CACHE_TTL, name = 'reference')
+_version = None
+
+def _check_version(cursor: CursorBase):
+    """
+    Clear the cache if the version in the database is not the one the
+    cache was filled at. Inside of a RequestScope, this is only done the
+    first time it is needed.
+    """
+    global _version
+    scope = sql_connection.current_scope()
+    if scope is not None:
+        if scope.locals.get(_SCOPE_KEY):
+            return
+        scope.locals[_SCOPE_KEY] = True
+
+    cursor.execute(SELECT_VERSION, (VERSION_NAME,))
+    result = cursor.fetchone()
+    version = result[0] if result is not None else 0
+    if version != _version:
+        _cache.clear()
+        _version = version
+
+def get(cursor: CursorBase, key: str, load: callable):
+    """
+    Get the cached value for the given key. If it isn't cached, it is
+    loaded by calling load with the given cursor and then remembered.
+
+    Cached values are shared, so they must never be modified.
+    """
+    _check_version(cursor)
+    value = _cache.get(key)
+    if value is None:
+        value = load(cursor)
+        if value is not None:
+            _cache.put(key, value)
+    return value
+
+def invalidate(cursor: CursorBase):
+    """
+    Forget all of the cached reference data in every process. This should
+    be called, using the same cursor, by anything that changes the active
+    semester, the semesters or the departments.
+    """
+    global _version
+    cursor.execute(BUMP_VERSION, (VERSION_NAME,))
+    _cache.clear()
+    _version = None
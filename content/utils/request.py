@@ -3,6 +3,7 @@ Functions related to manipulating requests, salary savings and cfrs in the datab
 """
 import json
 import decimal
+import hashlib
 from enum import Enum, auto
 from .sql_connection import Transaction
 from .authentication import User
@@ -12,39 +13,16 @@ from .db_utils import SAL_FIELDS
 from .errors import Error400
 from . import email_notification
 
-# Query to select just the coure ids of all of the courses
-# associated with a cr
-# Returned columns are: course_id
-# Parameters are: dept_name, semester, cal_year, revision_num
-SELECT_COURSE_IDS = """
-    SELECT c.course_id
-    FROM request r, cfr_request c
-    WHERE r.id = c.course_id AND
-    c.dept_name = %s AND
-    c.semester = %s AND
-    c.cal_year = %s AND
-    c.revision_num = %s
-"""
+# The maximum number of rows sent to the database in one statement
+# by the bulk queries below
+BULK_BATCH_SIZE = 500
 
-# Query to select just the savings ids of all of the savings
-# associated with a cr
-# Returned columns are: savings_id
-# Parameters are: dept_name, semester, cal_year, revision_num
-SELECT_SAVINGS_IDS = """
-    SELECT c.savings_id
-    FROM request r, cfr_savings c
-    WHERE r.id = c.savings_id AND
-    c.dept_name = %s AND
-    c.semester = %s AND
-    c.cal_year = %s AND
-    c.revision_num = %s
-"""
-
-# Query to insert a new course request into the request table
+# Query to insert several new course requests into the request table at once.
+# Formatted with one COURSE_VALUES for each course, separated by commas.
 # Parameters are: priority, course, sec, mini_session, online_course,
 #   num_students, instructor, banner_id, inst_rank, cost, reason
-# TODO: Should this be auto-generated based on REQ_FIELDS?
-INSERT_COURSE = """
+#   (for each course in turn)
+INSERT_COURSES = """
 INSERT INTO request(
     priority, 
     course, 
@@ -58,38 +36,84 @@ INSERT INTO request(
     cost,
     reason
     )
-VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+VALUES {}
 """
+COURSE_VALUES = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
 
-# Query for courses matching the given
-# definition of a course.
-# Returned columns: COUNT(id), r.id
-# Parameters are: priority, course, sec, mini_session, online_course,
-#   num_students, instructor, banner_id, inst_rank, cost, reason
-# TODO: Should this be auto-generated based on REQ_FIELDS?
-COMPARE_COURSE = """
-SELECT r.id
-FROM request r, cfr_request c
-WHERE r.id = c.course_id AND
-    r.priority = %s AND
-    r.course = %s AND
-    r.sec = %s AND 
-    r.mini_session = %s AND
-    r.online_course = %s AND
-    r.num_students = %s AND
-    r.instructor = %s AND
-    r.banner_id = %s AND
-    r.inst_rank = %s AND
-    r.cost = %s AND
-    r.reason = %s AND 
+# Query to insert several new entries into the sal_savings table at once.
+# Formatted with one SAVINGS_VALUES for each entry, separated by commas.
+# Parameters are: leave_type, inst_name, savings, notes
+#   (for each entry in turn)
+INSERT_SAVINGS = """
+INSERT INTO sal_savings(leave_type, inst_name, savings, notes)
+VALUES {}
+"""
+SAVINGS_VALUES = "(%s, %s, %s, %s)"
+
+# Query to get the content hashes of all of the courses in a cfr
+# (see content_hash())
+# Returned columns are: content_hash, id
+# Parameters are: dept_name, semester, cal_year, revision_num
+SELECT_COURSE_HASHES = """
+SELECT r.content_hash, r.id
+FROM cfr_request c
+JOIN request r ON r.id = c.course_id
+WHERE c.dept_name = %s AND
+    c.semester = %s AND
+    c.cal_year = %s AND
+    c.revision_num = %s
+ORDER BY r.id
+"""
+
+# Query to get the content hashes of all of the savings in a cfr
+# (see content_hash())
+# Returned columns are: content_hash, id
+# Parameters are: dept_name, semester, cal_year, revision_num
+SELECT_SAVINGS_HASHES = """
+SELECT s.content_hash, s.id
+FROM cfr_savings c
+JOIN sal_savings s ON s.id = c.savings_id
+WHERE c.dept_name = %s AND
+    c.semester = %s AND
+    c.cal_year = %s AND
     c.revision_num = %s
-LIMIT 1
+ORDER BY s.id
 """
 
-# Query to get the id of the last inserted item
-# Returned coloumns: LAST_INSERT_ID()
-GET_ID = """
-SELECT LAST_INSERT_ID()
+# Query to get the step between auto_increment ids. The rows inserted by
+# one INSERT_COURSES or INSERT_SAVINGS get consecutive ids (separated by this step),
+# starting from the cursor's lastrowid.
+# Returned columns are: @@auto_increment_increment
+GET_ID_INCREMENT = """
+SELECT @@auto_increment_increment
+"""
+
+# Query to link every course of one cfr to another cfr as well
+# Parameters are: dept_name, semester, cal_year, revision_num (of the cfr
+#   to link the courses to), then dept_name, semester, cal_year,
+#   revision_num (of the cfr to copy the courses from)
+CARRY_FORWARD_COURSES = """
+INSERT INTO cfr_request (course_id, dept_name, semester, cal_year, revision_num)
+SELECT course_id, %s, %s, %s, %s
+FROM cfr_request
+WHERE dept_name = %s AND
+    semester = %s AND
+    cal_year = %s AND
+    revision_num = %s
+"""
+
+# Query to link every savings entry of one cfr to another cfr as well
+# Parameters are: dept_name, semester, cal_year, revision_num (of the cfr
+#   to link the savings to), then dept_name, semester, cal_year,
+#   revision_num (of the cfr to copy the savings from)
+CARRY_FORWARD_SAVINGS = """
+INSERT INTO cfr_savings (savings_id, dept_name, semester, cal_year, revision_num)
+SELECT savings_id, %s, %s, %s, %s
+FROM cfr_savings
+WHERE dept_name = %s AND
+    semester = %s AND
+    cal_year = %s AND
+    revision_num = %s
 """
 
 # Query to insert a new entry into the cfr_request table
@@ -99,31 +123,6 @@ INSERT INTO cfr_request
 VALUES (%s, %s, %s, %s, %s)
 """
 
-# Query to insert a new entry into the sal_savings table
-# Parameters are: leave_type, inst_name, savings, notes
-# TODO: Should this be auto-generated based on SAL_FIELDS?
-INSERT_SAL = """
-INSERT INTO sal_savings(leave_type, inst_name, savings, notes)
-VALUES (%s, %s, %s, %s)
-"""
-
-# Query for sal_savings matching the given
-# definition.
-# Returned columns: COUNT(id), s.id
-# Parameters are: leave_type, inst_name, savings, notes
-# TODO: Should this be auto-generated based on SAL_FIELDS?
-COMPARE_SAL = """
-SELECT s.id
-FROM sal_savings s, cfr_savings c
-WHERE s.id = c.savings_id AND
-    s.leave_type = %s AND
-    s.inst_name = %s AND
-    s.savings = %s AND
-    s.notes = %s AND
-    c.revision_num = %s
-LIMIT 1
-"""
-
 # Query to insert a new entry into the cfr_savings table
 # Parameters are: savings_id, dept_name, semester, cal_year, revision_num
 INSERT_CFR_SAVINGS = """
@@ -131,34 +130,327 @@ INSERT INTO cfr_savings
 VALUES (%s, %s, %s, %s, %s)
 """
 
-# Update statement to update commitment_code and cost of a course
-# when a course is approved 
-APPROVE_COURSES = """
-UPDATE request r
-SET commitment_code = %s, cost = %s, approver = %s
-WHERE EXISTS (SELECT *
-              FROM cfr_request c
-              WHERE r.id = c.course_id AND
-                    r.course = %s AND
-                    r.sec = %s AND
-                    c.dept_name = %s AND
-                    c.semester = %s AND
-                    c.cal_year = %s AND
-                    c.revision_num = %s)
-                
+# Queries to record that a course/savings entry was added to or removed
+# from a 'delta' revision (see db_utils.resolve_revision())
+# Parameters are: course_id/savings_id, dept_name, semester, cal_year,
+#   revision_num, change_type
+INSERT_COURSE_DELTA = """
+INSERT INTO cfr_request_delta
+    (course_id, dept_name, semester, cal_year, revision_num, change_type)
+VALUES (%s, %s, %s, %s, %s, %s)
+"""
+INSERT_SAVINGS_DELTA = """
+INSERT INTO cfr_savings_delta
+    (savings_id, dept_name, semester, cal_year, revision_num, change_type)
+VALUES (%s, %s, %s, %s, %s, %s)
 """
 
-# Query to add a dean commitment to a cfr
-# Parameters are: dean_committed, dept_name, semester, cal_year, revision_num
-ADD_COMMITMENT = """
-UPDATE cfr_department
-SET dean_committed = %s
+# Queries to move the links of every course/savings entry
+# of a cfr to the next revision of the cfr
+# Parameters are: revision_num (of the new revision), then dept_name,
+#   semester, cal_year, revision_num (of the cfr to move them from)
+MOVE_COURSE_LINKS = """
+UPDATE cfr_request
+SET revision_num = %s
+WHERE dept_name = %s AND
+    semester = %s AND
+    cal_year = %s AND
+    revision_num = %s
+"""
+MOVE_SAVINGS_LINKS = """
+UPDATE cfr_savings
+SET revision_num = %s
 WHERE dept_name = %s AND
     semester = %s AND
     cal_year = %s AND
     revision_num = %s
 """
 
+# Queries to unlink a course/savings entry from a cfr
+# Parameters are: course_id/savings_id, dept_name, semester, cal_year, revision_num
+DELETE_CFR_COURSE = """
+DELETE FROM cfr_request
+WHERE course_id = %s AND
+    dept_name = %s AND
+    semester = %s AND
+    cal_year = %s AND
+    revision_num = %s
+"""
+DELETE_CFR_SAVINGS = """
+DELETE FROM cfr_savings
+WHERE savings_id = %s AND
+    dept_name = %s AND
+    semester = %s AND
+    cal_year = %s AND
+    revision_num = %s
+"""
+
+# The queries used by _link_rows() for each kind of row
+_LINK_QUERIES = {
+    db_utils.COURSE_ROWS: {
+        'select_links':     db_utils.SELECT_COURSE_LINKS,
+        'insert_link':      INSERT_CFR_COURSE,
+        'delete_link':      DELETE_CFR_COURSE,
+        'carry_forward':    CARRY_FORWARD_COURSES,
+        'move_links':       MOVE_COURSE_LINKS,
+        'insert_delta':     INSERT_COURSE_DELTA,
+    },
+    db_utils.SAVINGS_ROWS: {
+        'select_links':     db_utils.SELECT_SAVINGS_LINKS,
+        'insert_link':      INSERT_CFR_SAVINGS,
+        'delete_link':      DELETE_CFR_SAVINGS,
+        'carry_forward':    CARRY_FORWARD_SAVINGS,
+        'move_links':       MOVE_SAVINGS_LINKS,
+        'insert_delta':     INSERT_SAVINGS_DELTA,
+    },
+}
+
+# The commitment codes that a course can be approved with
+COMMITMENT_CODES = ('EM', 'SS', 'CO', 'DE')
+
+# Query to select the ids of the courses associated with a cfr
+# along with what they are identified by when they are approved
+# Returned columns are: id, course, sec
+# Parameters are: dept_name, semester, cal_year, revision_num
+SELECT_APPROVAL_KEYS = """
+SELECT r.id, r.course, r.sec
+FROM request r
+    JOIN cfr_request c ON r.id = c.course_id
+WHERE c.dept_name = %s AND
+    c.semester = %s AND
+    c.cal_year = %s AND
+    c.revision_num = %s
+"""
+
+# Query to approve several courses at once, updating their commitment_code,
+# cost and approver. Formatted with one APPROVAL_CASE for each course
+# (separated by spaces) and then one "%s" for each course (separated by commas).
+# Parameters are: id and commitment_code for each course, then id and cost
+#   for each course, then approver, then the id of each course
+APPROVE_COURSES = """
+UPDATE request
+SET commitment_code = CASE id {0} END,
+    cost = CASE id {0} END,
+    approver = %s
+WHERE id IN ({1})
+"""
+APPROVAL_CASE = "WHEN %s THEN %s"
+
+# Query to get the latest revision numbers of some departments' cfrs
+# in a semester. Formatted with one "%s" for each department (separated by commas)
+# Returned columns are: dept_name, revision_num
+# Parameters are: semester, cal_year, then each dept_name
+SELECT_LATEST_REVISION_NUMS = """
+SELECT dept_name, MAX(revision_num)
+FROM cfr_department
+WHERE semester = %s AND
+    cal_year = %s AND
+    dept_name IN ({})
+GROUP BY dept_name
+"""
+
+# Query to add dean commitments to several cfrs in a semester at once (and
+# update their funds_needed to match). Formatted with one COMMITMENT_CASE for
+# each cfr (separated by spaces) and then one COMMITMENT_CFR for each cfr
+# (separated by " OR ")
+# Parameters are: dept_name and dean_committed for each cfr, then
+#   semester and cal_year, then dept_name and revision_num for each cfr
+ADD_COMMITMENTS = """
+UPDATE cfr_department
+SET dean_committed = CASE dept_name {} END,
+    funds_needed = GREATEST(total_cost - total_savings - dean_committed, 0)
+WHERE semester = %s AND
+    cal_year = %s AND
+    ({})
+"""
+COMMITMENT_CASE = "WHEN %s THEN %s"
+COMMITMENT_CFR = "(dept_name = %s AND revision_num = %s)"
+
+def _to_money(value) -> decimal.Decimal:
+    """
+    Convert a dollar amount as submitted (which may include '$' and ',')
+    into a Decimal with two decimal places, as it will be stored
+    in the database.
+    """
+    amount = decimal.Decimal(str(value).replace("$", "").replace(",", ""))
+    if not amount.is_finite():
+        raise Error400(f'{value} is not a valid dollar amount')
+    amount = amount.quantize(decimal.Decimal('0.01'), rounding=decimal.ROUND_HALF_UP)
+    # Avoid "-0.00"
+    return amount if amount != 0 else decimal.Decimal('0.00')
+
+def _match_key(value):
+    """
+    Get the key that a text value is matched by when it is looked up in
+    Python instead of in a query. MySQL compares text without caring
+    about case or trailing spaces, so this does the same, so that
+    anything a query would have matched is still matched.
+    """
+    if value is None:
+        return None
+    return str(value).rstrip(' ').casefold()
+
+def normalize_course(row: tuple) -> tuple:
+    """
+    Convert a course row (a tuple of the fields in REQ_FIELDS) that has
+    passed validate_course() into the values that will actually be stored
+    in the database, so that content_hash() gives the same result for the
+    row as the database does once it is stored.
+    """
+    return (
+        int(row[0]) if row[0] else 0,   # priority
+        row[1],                         # course
+        row[2],                         # sec
+        row[3].capitalize(),            # mini_session ('Yes' or 'No')
+        row[4].capitalize(),            # online_course ('Yes' or 'No')
+        int(row[5]),                    # num_students
+        row[6],                         # instructor
+        int(row[7]),                    # banner_id
+        row[8],                         # inst_rank
+        _to_money(row[9]),              # cost
+        row[10]                         # reason
+    )
+
+def normalize_sal_saving(row: tuple) -> tuple:
+    """
+    Convert a salary savings row (a tuple of the fields in SAL_FIELDS)
+    that has passed validate_sal_saving() into the values that will
+    actually be stored in the database (see normalize_course())
+    """
+    return (row[0], row[1], _to_money(row[2]), row[3])
+
+def content_hash(values: tuple) -> bytes:
+    """
+    Compute the SHA-256 hash identifying the contents of a course or
+    salary savings entry, given its normalized values.
+
+    This must match the content_hash columns of the request and sal_savings
+    tables (see create_schema.sql), which hash the same values as text: a
+    string of 1s and 0s marking which values are NULL, followed by every
+    value (or '' for NULLs), all separated by the character 0x1F.
+    """
+    null_mask = "".join(["1" if v is None else "0" for v in values])
+    text = "\x1f".join([null_mask] + ["" if v is None else str(v) for v in values])
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+def _find_unchanged_rows(cursor, query: str, prev_cfr_data: tuple, rows: list) -> dict:
+    """
+    Find which of the given normalized rows are identical to a row in the
+    previous cfr identified by prev_cfr_data, using the given cursor.
+    query is SELECT_COURSE_HASHES or SELECT_SAVINGS_HASHES.
+
+    Returns a dict mapping the index of each unchanged row to the id of its
+    match in the previous cfr. Each row in the previous cfr is matched to
+    at most one of the given rows, so duplicate rows are treated as new.
+    """
+    cursor.execute(query, prev_cfr_data)
+    previous = {}
+    for (row_hash, row_id) in cursor.fetchall():
+        previous.setdefault(bytes(row_hash), []).append(row_id)
+
+    matches = {}
+    for (i, row) in enumerate(rows):
+        ids = previous.get(content_hash(row))
+        if ids:
+            matches[i] = ids.pop(0)
+    return matches
+
+def _insert_rows(cursor, query: str, values: str, rows: list) -> list:
+    """
+    Insert the given rows using the given cursor with as few statements
+    as possible. query and values are INSERT_COURSES and COURSE_VALUES
+    or INSERT_SAVINGS and SAVINGS_VALUES.
+
+    Returns a list of the ids of the new rows, in the same order as rows.
+    """
+    if len(rows) == 0:
+        return []
+
+    cursor.execute(GET_ID_INCREMENT)
+    increment = cursor.fetchone()[0]
+
+    ids = []
+    for start in range(0, len(rows), BULK_BATCH_SIZE):
+        batch = rows[start:start + BULK_BATCH_SIZE]
+        cursor.execute(
+            query.format(", ".join([values] * len(batch))),
+            tuple(field for row in batch for field in row))
+        # lastrowid is the id of the first row inserted by the statement
+        first_id = cursor.lastrowid
+        ids += [first_id + i * increment for i in range(len(batch))]
+    return ids
+
+def _link_rows(cursor, kind: str, cfr_data: tuple, prev_cfr_data: tuple, prev_storage: str, ids: list):
+    """
+    Link the courses or savings (depending on whether kind is
+    db_utils.COURSE_ROWS or db_utils.SAVINGS_ROWS) with the given ids to
+    the new cfr revision cfr_data, using the given cursor. If ids is None,
+    the new revision has the same ones as the previous revision.
+
+    prev_cfr_data and prev_storage are the primary key and storage
+    of the previous revision, or None if there isn't one.
+
+    With 'full' storage, every row is linked to the new revision. With
+    'delta' storage, only the changes since the previous revision are
+    recorded, and if the previous revision is a 'delta' revision too,
+    its links are moved to the new one rather than copied.
+    """
+    queries = _LINK_QUERIES[kind]
+    if db_utils.revision_storage() == db_utils.FULL_STORAGE:
+        if ids is None:
+            cursor.execute(queries['carry_forward'], cfr_data + prev_cfr_data)
+        elif len(ids) > 0:
+            cursor.executemany(queries['insert_link'], [(row_id,) + cfr_data for row_id in ids])
+        return
+
+    # Record what changed since the previous revision
+    prev_ids = set()
+    if prev_cfr_data is not None:
+        cursor.execute(queries['select_links'], prev_cfr_data)
+        prev_ids = {row[0] for row in cursor.fetchall()}
+    new_ids = prev_ids if ids is None else set(ids)
+    added = sorted(new_ids - prev_ids)
+    removed = sorted(prev_ids - new_ids)
+    changes = (
+        [(row_id,) + cfr_data + ('add',) for row_id in added] +
+        [(row_id,) + cfr_data + ('remove',) for row_id in removed]
+    )
+    if len(changes) > 0:
+        cursor.executemany(queries['insert_delta'], changes)
+
+    # Materialize the new revision
+    if prev_storage == db_utils.DELTA_STORAGE:
+        cursor.execute(queries['move_links'], (cfr_data[3],) + prev_cfr_data)
+        if len(removed) > 0:
+            cursor.executemany(queries['delete_link'], [(row_id,) + cfr_data for row_id in removed])
+        if len(added) > 0:
+            cursor.executemany(queries['insert_link'], [(row_id,) + cfr_data for row_id in added])
+    elif len(new_ids) > 0:
+        cursor.executemany(queries['insert_link'], [(row_id,) + cfr_data for row_id in sorted(new_ids)])
+
+def _store_revision(cursor, cfr_data: tuple, prev_cfr_data: tuple, course_ids: list, savings_ids: list):
+    """
+    Link the given courses and savings to the new cfr revision cfr_data
+    (see _link_rows()) using the given cursor. Either course_ids or savings_ids
+    can be None to keep the ones from the previous revision, whose primary
+    key is prev_cfr_data (or None if there isn't one).
+
+    A previous 'delta' revision gives its links to the new revision, so it
+    is marked as no longer being materialized.
+    """
+    prev_storage = None
+    if prev_cfr_data is not None and db_utils.revision_storage() == db_utils.DELTA_STORAGE:
+        cursor.execute(db_utils.SELECT_CFR_STORAGE, prev_cfr_data)
+        prev_storage = cursor.fetchone()[0]
+
+    if course_ids is not None or prev_cfr_data is not None:
+        _link_rows(cursor, db_utils.COURSE_ROWS, cfr_data, prev_cfr_data, prev_storage, course_ids)
+    if savings_ids is not None or prev_cfr_data is not None:
+        _link_rows(cursor, db_utils.SAVINGS_ROWS, cfr_data, prev_cfr_data, prev_storage, savings_ids)
+
+    if prev_storage == db_utils.DELTA_STORAGE:
+        cursor.execute(db_utils.UNMATERIALIZE_CFR, prev_cfr_data)
+
 def new_cfr_from_courses(user: User, course_list):
     """
     Add a new cfr revision for the department represented
@@ -169,83 +461,67 @@ def new_cfr_from_courses(user: User, course_list):
 
     course_list is a list of dicts with all the fields
     for a course (defined in REQ_FIELDS)
+
+    Courses that are identical to one in the previous revision are
+    linked to the new revision as they are. Any others are inserted
+    as new courses. All of this is done in bulk, so the number of
+    queries does not grow with the number of courses.
     """
 
-    num_courses = 0
-    num_new_courses = 0
     ret_string = ""
 
-    with Transaction() as cursor:
-        # If there is a current cfr, mark that this new one is a revision
-        # and remember the old one
-        if db_utils.get_current_cfr(cursor, user.dept_name) != None:
-            revision = True
-            # prev_cfr is the full tuple of the previous cfr
-            prev_cfr = db_utils.get_current_cfr(cursor, user.dept_name)
-            # prev_cfr_data contains only the primary key
-            prev_cfr_data = (prev_cfr[0], prev_cfr[1], prev_cfr[2], prev_cfr[5])
-        else:
-            revision = False
+    # Parse the dicts in course_list into tuples
+    data_ls = []
+    for course in course_list:
+        course_data = ()
+        for field in REQ_FIELDS:
+            course_data = course_data + (course[field],)
+        data_ls.append(course_data)
+
+    # Validation will raise an exception if there are
+    # errors, so if execution continues, we can assume
+    # we validated successfully
+    for row in data_ls:
+        validate_course(row)
+    data_ls = [normalize_course(row) for row in data_ls]
 
+    with Transaction() as cursor:
         # Create the new cfr
-        db_utils.create_new_revision(cursor, user)
-        new_cfr = db_utils.get_current_cfr(cursor, user.dept_name)
         # cfr_data is just the primary key of the new cfr
-        cfr_data = (new_cfr[0], new_cfr[1], new_cfr[2], new_cfr[5])
-        dept_name = new_cfr[0]
-
-        # Parse the dicts in course_list into tuples
-        data_ls = []
-        for course in course_list:
-            course_data = ()
-            for field in REQ_FIELDS:
-                course_data = course_data + (course[field],)
-            data_ls.append(course_data)
-
-        new_courses = []
-        # Iterate through courses to add
-        for row in data_ls:
-            # Validation will raise an exception if there are
-            # errors, so if execution continues, we can assume
-            # we validated successfully
-            validate_course(row)
-
-            exists = False
-            # If this is a revision, we first check that an equivalent
-            # course does not already exist
-            # (if one does, remember its id)
-            if revision == True:
-                cursor.execute(COMPARE_COURSE, row + (prev_cfr_data[3], ))
-                dup_course = cursor.fetchone()
-                if dup_course is not None:
-                    exists = True
-                    course_id = (dup_course[0], )
-
-            # If an equivalent course does not already exist,
-            # insert this one into the database and remember its id
-            if exists == False:
-                cursor.execute(INSERT_COURSE, row)
-                num_new_courses += cursor.rowcount
-                new_courses.append(row)
-                cursor.execute(GET_ID, params=None)
-                course_id = cursor.fetchone()
-        
-            # Insert a new entry into cfr_request to link
-            # this course with the new cfr
-            cfr_course = course_id + cfr_data
-            cursor.execute(INSERT_CFR_COURSE, cfr_course)
-            num_courses += cursor.rowcount
-
-        # End: for row in data_ls:
-
-        # If this is a revision, get the savings associated with
-        # the previous cfr and create entries in cfr_savings
-        # to associate them with the new cfr as well
+        cfr_data = db_utils.create_new_revision(cursor, user)
+        dept_name = cfr_data[0]
+
+        # If the new cfr is a revision, remember the previous one's primary key
+        revision = cfr_data[3] > 0
         if revision:
-            cursor.execute(SELECT_SAVINGS_IDS, prev_cfr_data)
-            last_savings_ids = cursor.fetchall()
-            for savings_id in last_savings_ids:
-                cursor.execute(INSERT_CFR_SAVINGS, (savings_id + cfr_data))
+            prev_cfr_data = cfr_data[:3] + (cfr_data[3] - 1,)
+
+        # If this is a revision, find the courses that have not changed
+        # (and remember their ids)
+        if revision and len(data_ls) > 0:
+            unchanged = _find_unchanged_rows(cursor, SELECT_COURSE_HASHES, prev_cfr_data, data_ls)
+        else:
+            unchanged = {}
+
+        # Insert every other course into the database and remember its id
+        new_courses = [row for (i, row) in enumerate(data_ls) if i not in unchanged]
+        new_ids = iter(_insert_rows(cursor, INSERT_COURSES, COURSE_VALUES, new_courses))
+        course_ids = [unchanged[i] if i in unchanged else next(new_ids) for i in range(len(data_ls))]
+        num_new_courses = len(new_courses)
+
+        # Link every course with the new cfr, and if this is a revision,
+        # associate the savings from the previous cfr with it as well
+        _store_revision(cursor, cfr_data, prev_cfr_data if revision else None, course_ids, None)
+
+        # Update the totals stored with the new cfr
+        db_utils.refresh_cfr_totals(cursor, cfr_data)
+
+        # Queue an email notification as part of the same transaction
+        if num_new_courses > 0:
+            if revision:
+                email_notification.compose_cfr_revision_email(dept_name, cursor)
+            else:
+                email_notification.compose_new_cfr_email(dept_name, cursor)
 
     # Create and return a string specifying the number of
     # courses that were added
@@ -253,13 +529,6 @@ def new_cfr_from_courses(user: User, course_list):
         ret_string += f"{num_new_courses} courses added or modified:\n"
         for row in new_courses:
             ret_string += f"{row[1]}\t{row[2]}\n"
-
-        # Send email notifiction
-        if revision:
-            email_notification.compose_cfr_revision_email(dept_name)
-        else:
-            email_notification.compose_new_cfr_email(dept_name)
-        
     else:
         ret_string += "No courses added or modified."
 
@@ -280,88 +549,65 @@ def new_cfr_from_sal_savings(user: User, sal_list):
     new_cfr_from_courses. Can it be refactored?
     """
 
-    num_new_sal_savings = 0
     ret_string = ""
 
-    with Transaction() as cursor:
-        # If there is a current cfr, mark that this new one is a revision
-        # and remember the old one
-        if db_utils.get_current_cfr(cursor, user.dept_name) != None:
-            revision = True
-            # prev_cfr is the full tuple of the previous cfr
-            prev_cfr = db_utils.get_current_cfr(cursor, user.dept_name)
-            # prev_cfr_data contains only the primary key
-            prev_cfr_data = (prev_cfr[0], prev_cfr[1], prev_cfr[2], prev_cfr[5])
-        else:
-            revision = False
+    # Parse the dicts in sal_list into tuples
+    data_ls = []
+    for sal in sal_list:
+        sal_data = ()
+        for field in SAL_FIELDS:
+            sal_data = sal_data + (sal[field],)
+        data_ls.append(sal_data)
+
+    # Validation will raise an exception if there are
+    # errors, so if execution continues, we can assume
+    # we validated successfully
+    for row in data_ls:
+        validate_sal_saving(row)
+    data_ls = [normalize_sal_saving(row) for row in data_ls]
 
+    with Transaction() as cursor:
         # Create the new cfr
-        db_utils.create_new_revision(cursor, user)
-        new_cfr = db_utils.get_current_cfr(cursor, user.dept_name)
         # cfr_data is just the primary key of the new cfr
-        cfr_data = (new_cfr[0], new_cfr[1], new_cfr[2], new_cfr[5])
-        dept_name = new_cfr[0]
-        # Parse the dicts in sal_list into tuples
-        data_ls = []
-        for sal in sal_list:
-            sal_data = ()
-            for field in SAL_FIELDS:
-                sal_data = sal_data + (sal[field],)
-            data_ls.append(sal_data)
-
-        new_sal_savings = []
-        # Iterate through savings to add
-        for row in data_ls:
-            # Validation will raise an exception if there are
-            # errors, so if execution continues, we can assume
-            # we validated successfully
-            validate_sal_saving(row)
-
-            exists = False
-            # If this is a revision, we first check that an equivalent
-            # entry does not already exist
-            # (if one does, remember its id)
-            if revision == True:
-                cursor.execute(COMPARE_SAL, row + (prev_cfr_data[3], ))
-                dup_savings = cursor.fetchone()
-                if dup_savings is not None:
-                    exists = True
-                    savings_id = (dup_savings[0], )
-
-            # If an equivalent entry does not already exist,
-            # insert this one into the database and remember its id
-            if exists == False:
-                cursor.execute(INSERT_SAL, row)
-                num_new_sal_savings += cursor.rowcount
-                new_sal_savings.append(row)
-                cursor.execute(GET_ID, params=None)
-                savings_id = cursor.fetchone()
-
-            # Insert a new entry into cfr_savings to link
-            # this entry with the new cfr
-            cfr_savings = savings_id + cfr_data
-            cursor.execute(INSERT_CFR_SAVINGS, cfr_savings)
-
-        # If this is a revision, get the courses associated with
-        # the previous cfr and create entries in cfr_request
-        # to associate them with the new cfr as well
+        cfr_data = db_utils.create_new_revision(cursor, user)
+        dept_name = cfr_data[0]
+
+        # If the new cfr is a revision, remember the previous one's primary key
+        revision = cfr_data[3] > 0
         if revision:
-            cursor.execute(SELECT_COURSE_IDS, prev_cfr_data)
-            last_course_ids = cursor.fetchall()
-            for course_id in last_course_ids:
-                cursor.execute(INSERT_CFR_COURSE, (course_id + cfr_data))
+            prev_cfr_data = cfr_data[:3] + (cfr_data[3] - 1,)
+
+        # If this is a revision, find the entries that have not changed
+        # (and remember their ids)
+        if revision and len(data_ls) > 0:
+            unchanged = _find_unchanged_rows(cursor, SELECT_SAVINGS_HASHES, prev_cfr_data, data_ls)
+        else:
+            unchanged = {}
+
+        # Insert every other entry into the database and remember its id
+        new_sal_savings = [row for (i, row) in enumerate(data_ls) if i not in unchanged]
+        new_ids = iter(_insert_rows(cursor, INSERT_SAVINGS, SAVINGS_VALUES, new_sal_savings))
+        savings_ids = [unchanged[i] if i in unchanged else next(new_ids) for i in range(len(data_ls))]
+        num_new_sal_savings = len(new_sal_savings)
+
+        # Link every entry with the new cfr, and if this is a revision,
+        # associate the courses from the previous cfr with it as well
+        _store_revision(cursor, cfr_data, prev_cfr_data if revision else None, None, savings_ids)
+
+        # Update the totals stored with the new cfr
+        db_utils.refresh_cfr_totals(cursor, cfr_data)
+
+        # Queue an email notification as part of the same transaction
+        if num_new_sal_savings > 0:
+            if revision:
+                email_notification.compose_cfr_revision_email(dept_name, cursor)
+            else:
+                email_notification.compose_new_cfr_email(dept_name, cursor)
 
     # Create and return a string specifying the number of
     # entries that were added
     if num_new_sal_savings > 0:
         ret_string += f"{num_new_sal_savings} savings added or modified."
-        
-        # Send email notifiction
-        if revision:
-            email_notification.compose_cfr_revision_email(dept_name)
-        else:
-            email_notification.compose_new_cfr_email(dept_name)
-
     else:
         ret_string += "No salaray savings added or modified."
 
@@ -461,28 +707,90 @@ def approve_courses(current_user: User, approved_courses):
     approved courses is an object contataining the department
     name and a list of courses that have been approved. 
     Approved courses are identified by course and sec.
+
+    The ids of the courses in the current cfr are looked up once and
+    then every approval is made with one UPDATE (per BULK_BATCH_SIZE
+    courses), so this takes the same number of queries no matter how
+    many courses are approved.
+
+    Returns a string listing the courses that were approved and any
+    that could not be found in the current cfr.
     """
-    ret_string = "Courses approved:\n"
     username = current_user.username
     dept_name = approved_courses['dept_name']
+
+    # Validate everything before touching the database.
+    # (if course has a commitment code, it is approved)
+    approvals = []
+    for course in approved_courses['courses']:
+        if course['commitment_code'] == None:
+            continue
+        if course['commitment_code'] not in COMMITMENT_CODES:
+            raise Error400(f"{course['commitment_code']} is not a valid commitment code")
+        try:
+            cost = _to_money(course['cost'])
+        except decimal.InvalidOperation:
+            raise Error400(f"The cost of {course['course']} {course['sec']} must be a valid float")
+        approvals.append((course['course'], course['sec'], course['commitment_code'], cost))
+
     with Transaction() as cursor:
         current_cfr = db_utils.get_current_cfr(cursor, dept_name)
+        if current_cfr is None:
+            raise Error400("Selected department has no current request!")
         #current_cfr is the full tuple of the current cfr 
         #for the department selected
         cfr_key = (current_cfr[0], current_cfr[1], current_cfr[2], current_cfr[5])
         #cfr_key is the primary key for the cfr
 
-        for course in approved_courses['courses']:
-            #if course has a commitment code, it is approved
-            if course['commitment_code'] != None:
-                update_course = (course['commitment_code'], course['cost'], username, course["course"], course["sec"])
-                #update_course is a tuple that contains the commitment code,
-                #cost, course, section and approver's username
-                cursor.execute(APPROVE_COURSES, update_course + cfr_key)
-                ret_string += f"{course['course']} {course['sec']} \n"
+        # Find the ids of the courses in the cfr by course and sec
+        # (NULL never matched in the query this replaced, so neither does None)
+        cursor.execute(SELECT_APPROVAL_KEYS, cfr_key)
+        ids_by_key = {}
+        for (course_id, course, sec) in cursor.fetchall():
+            if course is None or sec is None:
+                continue
+            ids_by_key.setdefault((_match_key(course), _match_key(sec)), []).append(course_id)
+
+        # Match every approval to its courses
+        updates = []
+        approved = []
+        not_found = []
+        for (course, sec, commitment_code, cost) in approvals:
+            course_ids = ids_by_key.get((_match_key(course), _match_key(sec)), [])
+            if len(course_ids) == 0:
+                not_found.append((course, sec))
+                continue
+            updates += [(course_id, commitment_code, cost) for course_id in course_ids]
+            approved.append((course, sec))
+
+        for start in range(0, len(updates), BULK_BATCH_SIZE):
+            batch = updates[start:start + BULK_BATCH_SIZE]
+            query = APPROVE_COURSES.format(
+                " ".join([APPROVAL_CASE] * len(batch)),
+                ", ".join(["%s"] * len(batch)))
+            params = (
+                tuple(field for (course_id, code, cost) in batch for field in (course_id, code)) +
+                tuple(field for (course_id, code, cost) in batch for field in (course_id, cost)) +
+                (username,) +
+                tuple(course_id for (course_id, code, cost) in batch)
+            )
+            cursor.execute(query, params)
+
+        if len(updates) > 0:
+            # The approved courses may also be in the department's earlier
+            # revisions, so update the totals of all of them
+            db_utils.refresh_semester_cfr_totals(cursor, dept_name, cfr_key[1:3])
+
+        email_notification.compose_approve_course_email(
+            dept_name, [{'course': course, 'sec': sec} for (course, sec) in approved], cursor)
 
-        email_notification.compose_approve_course_email(approved_courses['dept_name'], approved_courses['courses'])
-    
+    ret_string = "Courses approved:\n"
+    for (course, sec) in approved:
+        ret_string += f"{course} {sec} \n"
+    if len(not_found) > 0:
+        ret_string += "Courses not found in the current request:\n"
+        for (course, sec) in not_found:
+            ret_string += f"{course} {sec} \n"
     return ret_string
 
 def commit_cfr(commitment_list: list):
@@ -495,24 +803,52 @@ def commit_cfr(commitment_list: list):
 
     If the data has errors or a given department does not have a 
     current cfr, a 400 error will be thrown.
+
+    The whole list is validated first, and then the current cfrs are
+    found with one query and every commitment is made with one UPDATE,
+    no matter how many departments there are.
     """
+    # If a department is listed more than once, the last amount is used.
+    # Departments are matched the way MySQL would match them (see
+    # _match_key()), so maps the key of each one to its amount
+    amounts = {}
+    for commitment in commitment_list:
+        if 'dept_name' not in commitment:
+            raise Error400("Entry missing 'dept_name' field!")
+        dept_name = commitment['dept_name']
+
+        if 'amount' not in commitment:
+            raise Error400("Entry missing 'amount' field!")
+        try:
+            amount = float(commitment['amount'])
+        except (ValueError, TypeError):
+            raise Error400("'amount' field must be a float!")
+
+        amounts[_match_key(dept_name)] = (dept_name, amount)
+
+    if len(amounts) == 0:
+        return
+
+    dept_names = [dept_name for (dept_name, _) in amounts.values()]
     with Transaction() as cursor:
-        for commitment in commitment_list:
-            if 'dept_name' not in commitment:
-                raise Error400("Entry missing 'dept_name' field!")
-            dept_name = commitment['dept_name']
-
-            if 'amount' not in commitment:
-                raise Error400("Entry missing 'amount' field!")
-            try:
-                amount = float(commitment['amount'])
-            except ValueError:
-                raise Error400("'amount' field must be a float!")
-
-            cfr = db_utils.get_current_cfr(cursor, dept_name)
-            if cfr is None:
-                raise Error400("Selected department has no current request!")
-            #cfr_data is the primary key of cfr
-            cfr_data = (cfr[0], cfr[1], cfr[2], cfr[5])
-
-            cursor.execute(ADD_COMMITMENT, (amount,)+cfr_data)
\ No newline at end of file
+        active = db_utils.get_active_semester(cursor)
+        semester = (active[0], active[1])
+        cursor.execute(
+            SELECT_LATEST_REVISION_NUMS.format(", ".join(["%s"] * len(dept_names))),
+            semester + tuple(dept_names))
+        # Maps the key of each department to its name as it is
+        # spelled in the database and its latest revision number
+        revisions = {_match_key(row[0]): (row[0], row[1]) for row in cursor.fetchall()}
+        if any(key not in revisions for key in amounts):
+            raise Error400("Selected department has no current request!")
+
+        query = ADD_COMMITMENTS.format(
+            " ".join([COMMITMENT_CASE] * len(amounts)),
+            " OR ".join([COMMITMENT_CFR] * len(amounts)))
+        params = (
+            tuple(field for key in amounts for field in (revisions[key][0], amounts[key][1])) +
+            semester +
+            tuple(field for key in amounts for field in revisions[key])
+        )
+        cursor.execute(query, params)
+        db_utils.bump_cfr_version(cursor)
@@ -0,0 +1,245 @@
+"""
+The routing table for wsgi_main, and the Request that is passed to
+each of its handlers.
+
+Routes are registered once, when wsgi_main is imported, with the
+Router.route() decorator. Each route declares which users may use it,
+which HTTP methods it accepts and how its request body is parsed, so
+the handlers themselves only have to do their own work:
+
+    @router.route('approve_courses', roles=[UserRole.APPROVER], methods=POST, body=JSON_BODY)
+    def handle_approve_courses(req: Request) -> bytes:
+        ...
+
+A route is chosen by the top part of the request's path (the part after
+the first '/'), or '/' if the path has no parts.
+"""
+import json
+from urllib.parse import parse_qs
+from .authentication import User, UserRole
+from .errors import Error400
+
+# Sets of HTTP methods that routes can accept
+GET     = ('GET', 'HEAD')
+POST    = ('POST',)
+
+# The ways a request body can be parsed (see Request.body)
+FORM_BODY = 'form'
+JSON_BODY = 'json'
+
+# The default MIME Type of responses
+HTML = "text/html; charset=utf-8"
+
+def parse_form(body_text: bytes) -> dict:
+    """
+    Returns a dictionary obtained by parsing the given body of an HTTP
+    request in the application/x-www-form-urlencoded format.
+
+    If the request has no body, then this will still return a dict, but
+    it will be empty. Each value in the dictionary will be list containing
+    the values for that entry.
+    """
+    query_raw = parse_qs(body_text) # This will be empty if there is no body
+
+    # Convert the query keys and values from bytes to strings
+    query = {}
+    for key in query_raw.keys():
+        new_key = key
+        if isinstance(key, bytes):
+            new_key = key.decode('utf-8')
+        query[new_key] = []
+        for item in query_raw[key]:
+            if isinstance(item, bytes):
+                query[new_key].append(item.decode('utf-8'))
+            else:
+                query[new_key].append(item)
+
+    return query
+
+def parse_json(body_text: bytes):
+    """
+    Parse the given body of an HTTP request as JSON. A body that
+    is not valid JSON is a bad request.
+    """
+    try:
+        return json.loads(body_text)
+    except ValueError:
+        raise Error400("The request body is not valid JSON!")
+
+# Maps each way a body can be parsed to the function that parses it
+BODY_PARSERS = {
+    FORM_BODY:  parse_form,
+    JSON_BODY:  parse_json,
+}
+
+class Request:
+    """
+    A request being handled by wsgi_main, which is passed to the handler
+    for its route.
+
+    environ is the WSGI environ, and user is the logged in
+    authentication.User (or None for routes that do not need a login).
+    The handler must call respond() or start_response() before
+    returning the body of the response.
+    """
+    def __init__(self, environ: dict, start_response: callable, route = None):
+        self.environ        = environ
+        self.start_response = start_response
+        self.route          = route
+        self.user: User     = None
+        # The ETag of the page being built, if it can be known before the
+        # page is built (see Route.versioned). It is added to successful
+        # responses by respond()
+        self.etag           = None
+        self._query         = None
+        self._body          = None
+
+    @property
+    def method(self) -> str:
+        return self.environ.get('REQUEST_METHOD', 'GET')
+
+    @property
+    def query(self) -> dict:
+        """
+        The parsed query string, where each value is a list of strings
+        """
+        if self._query is None:
+            self._query = parse_qs(self.environ.get('QUERY_STRING', ''))
+        return self._query
+
+    def query_value(self, name: str) -> str:
+        """
+        Get the first value of the given field in the query
+        string, or None if it is not there
+        """
+        values = self.query.get(name)
+        return values[0] if values else None
+
+    def read_body(self) -> bytes:
+        """
+        Read the raw body of the request
+        """
+        return self.environ['wsgi.input'].read()
+
+    @property
+    def body(self):
+        """
+        The body of the request, parsed as the route says (see Router.route()).
+        The body is read the first time this is used.
+        """
+        if self._body is None:
+            parser = BODY_PARSERS[self.route.body]
+            self._body = parser(self.read_body())
+        return self._body
+
+    def respond(
+        self,
+        status: str     = "200 OK",
+        mime: str       = HTML,
+        additional_headers: list = [],
+        exc_info        = None
+    ):
+        """
+        Call start_response with the given status, and content-type
+        header for the given MIME Type and any additonal headers provided.
+
+        Provided headers should be tuples with the variable name as the first
+        part and the value as the second part.
+        Example: ('Content-Length', 500)
+
+        If no status or MIME Type is provided, they will default to
+        '200 OK' and 'text/html' respectively.
+
+        exc_info should be given when responding to an error that may have
+        happened after a response was already started (for example, when
+        the request's transaction fails to commit after a handler returned).
+        """
+        headers = [('Content-Type', mime)] + additional_headers
+        if self.etag is not None and status.startswith(('200', '304')):
+            headers.append(('ETag', self.etag))
+        if exc_info is None:
+            self.start_response(status, headers)
+        else:
+            self.start_response(status, headers, exc_info)
+
+    def redirect(self, location: str, body: str = "REDIRECT", additional_headers: list = []) -> bytes:
+        """
+        Respond with a redirect to the given location
+        and return the given body as bytes
+        """
+        self.start_response('303 See Other', [('Location', location)] + additional_headers)
+        return body.encode('utf-8')
+
+class Route:
+    """
+    One entry in a Router (see Router.route() for the fields)
+    """
+    def __init__(self, handler: callable, roles: list, methods: tuple, body: str,
+                 login: bool, versioned: bool, mime: str):
+        self.handler    = handler
+        self.roles      = frozenset(roles) if roles is not None else None
+        self.methods    = methods
+        self.body       = body
+        self.login      = login
+        self.versioned  = versioned
+        self.mime       = mime
+        # The value of the Allow header when the method is not allowed
+        self.allow      = ", ".join(methods)
+        # Message of the error raised when the user's role is not allowed
+        if roles is not None:
+            names = [role.name.lower() + 's' for role in roles]
+            self.role_error = "Only " + " or ".join(names) + " can do this!"
+
+    def allows(self, user: User) -> bool:
+        """
+        Check if the given (logged in) user may use this route
+        """
+        return self.roles is None or user.role in self.roles
+
+class Router:
+    """
+    Maps the top part of request paths to Routes
+    """
+    def __init__(self):
+        self.routes = {}
+
+    def route(self, top: str, roles: list = None, methods: tuple = GET, body: str = None,
+              login: bool = True, versioned: bool = False, mime: str = HTML):
+        """
+        A decorator that registers the decorated function as the
+        handler for the given top part of the path.
+
+        roles is a list of the UserRoles allowed to use the route (or None
+        to allow every user), and methods is a tuple of the HTTP methods it
+        accepts (GET or POST here). body is how the request body is parsed
+        for Request.body (FORM_BODY, JSON_BODY or None if it is not used).
+
+        If login is False, the route can be used without logging in.
+
+        If versioned is True, the page only changes when the data in the
+        database changes (or the user, or the query string), so it gets
+        an ETag based on the data version and is not built at all if the
+        client already has it. mime is the MIME Type of the page.
+        """
+        def register(handler: callable) -> callable:
+            if body is not None and body not in BODY_PARSERS:
+                raise ValueError(f"Unknown body parser '{body}'")
+            self.routes[top] = Route(handler, roles, methods, body, login, versioned, mime)
+            return handler
+        return register
+
+    def match(self, path: str) -> Route:
+        """
+        Get the route for the given path, or None if there isn't one
+        """
+        return self.routes.get(top_of_path(path))
+
+def top_of_path(path: str) -> str:
+    """
+    Get the top part of the given path, or '/' if it has no parts.
+    Anything after a '?' is ignored.
+    """
+    for part in path.split('?', 1)[0].split('/'):
+        if part != '':
+            return part
+    return '/'
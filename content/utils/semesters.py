@@ -3,6 +3,7 @@ Functions related to manipulating semesters in the database
 """
 from .sql_connection import Transaction
 from . import db_utils
+from . import refcache
 from .errors import Error400
 from .email_notification import compose_open_semester_email
 
@@ -57,9 +58,10 @@ def change_semester(query):
     with Transaction() as cursor:
         cursor.execute(DEACTIVATE_ACTIVE_SEMESTER)
         cursor.execute(ACTIVATE_SEMESTER, semester_tup)
+        refcache.invalidate(cursor)
 
-    # Send email notification of activated semester
-    compose_open_semester_email(semester_tup[0], semester_tup[1])
+        # Queue an email notification of the activated semester
+        compose_open_semester_email(semester_tup[0], semester_tup[1], cursor)
 
 
 def add_semester(query):
@@ -87,4 +89,5 @@ def add_semester(query):
 
     # Insert semester into database
     with Transaction() as cursor:
-        cursor.execute(INSERT_SEMESTER, (season, year))
\ No newline at end of file
+        cursor.execute(INSERT_SEMESTER, (season, year))
+        refcache.invalidate(cursor)
\ No newline at end of file
@@ -0,0 +1,190 @@
+"""
+The slow query log, which catches queries that have started to get slow
+(for example, because they read every row of a table that keeps growing)
+before anyone notices.
+
+It is turned on by setting SLOW_QUERY_MS in the CFR environment. Every
+query that takes at least that many milliseconds is then written to the
+log at SLOW_QUERY_LOG, along with:
+
+    - the name of the query constant it came from (see instrumentation)
+    - its parameters, except for bytes (password and session token
+      hashes), which are never written
+    - the result of EXPLAIN for it, run on the same connection right
+      after it, and the tables that EXPLAIN says are read without an
+      index (see migrations.check_plan()). A query whose results had
+      not all been read yet can not be EXPLAINed, since the connection
+      is still busy with it, so the reason is logged instead
+
+Each entry is one line of JSON. The log is rotated once it reaches
+SLOW_QUERY_LOG_SIZE bytes, keeping LOG_BACKUPS old logs next to it.
+
+'manage.py slow-queries' reads the log (and the old ones) and reports
+the queries that took the most time altogether.
+"""
+import os
+import json
+import time
+import logging
+import tempfile
+from logging.handlers import RotatingFileHandler
+from . import cfrenv
+
+# The log that is written to if SLOW_QUERY_LOG is not set
+DEFAULT_LOG = os.path.join(tempfile.gettempdir(), 'cfr_slow_queries.log')
+
+# Size (in bytes) a log may reach before it is rotated if
+# SLOW_QUERY_LOG_SIZE is not set, and how many old logs are kept
+DEFAULT_LOG_SIZE    = 10 * 1024 * 1024
+LOG_BACKUPS         = 5
+
+# What is written in place of parameters that are never logged
+REDACTED = '<redacted>'
+
+# Longest string parameter that is written in full (email bodies can be long)
+MAX_PARAM_LENGTH = 200
+
+# Longest query text that is written
+MAX_QUERY_LENGTH = 2000
+
+# The logger, which is created by _get_logger() the first time it is needed
+_logger: logging.Logger = None
+
+def threshold() -> float:
+    """
+    Get the number of seconds that a query has to take to be logged,
+    or None if the slow query log is turned off
+    """
+    milliseconds = cfrenv.getint('SLOW_QUERY_MS')
+    if milliseconds is None or milliseconds < 0:
+        return None
+    return milliseconds / 1000
+
+def log_path() -> str:
+    """
+    Get the path of the slow query log
+    """
+    return cfrenv.getenv('SLOW_QUERY_LOG') or DEFAULT_LOG
+
+def _get_logger() -> logging.Logger:
+    global _logger
+    if _logger is None:
+        handler = RotatingFileHandler(log_path(),
+            maxBytes = cfrenv.getint('SLOW_QUERY_LOG_SIZE', DEFAULT_LOG_SIZE),
+            backupCount = LOG_BACKUPS)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger = logging.getLogger('cfr.slow_queries')
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(handler)
+        _logger = logger
+    return _logger
+
+def redact(value):
+    """
+    Get a copy of the given query parameter (or tuple, list or dict of
+    them) that is safe to write to the log. Bytes are only ever hashes
+    of passwords or session tokens, so they are left out, and long
+    strings are cut short.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return REDACTED
+    if isinstance(value, str) and len(value) > MAX_PARAM_LENGTH:
+        return value[:MAX_PARAM_LENGTH] + '...'
+    if isinstance(value, (tuple, list)):
+        return [redact(item) for item in value]
+    if isinstance(value, dict):
+        return {key: redact(item) for (key, item) in value.items()}
+    if value is None or isinstance(value, (int, float, bool)):
+        return value
+    return str(value)
+
+def _explain(connection, query: str, params) -> tuple:
+    """
+    EXPLAIN the given query on the given connection. Returns a tuple of
+    the rows of the plan, the tables that are read without an index and
+    the reason the query could not be EXPLAINed (or None if it was).
+    """
+    # migrations uses sql_connection, which uses this module
+    from . import migrations
+    if getattr(connection, 'unread_result', False):
+        return (None, [], "its results had not been read yet")
+    cursor = connection.cursor(buffered = True)
+    try:
+        plan = migrations.explain(cursor, query, params)
+        (problems, _) = migrations.check_plan(plan)
+        return (plan, problems, None)
+    except Exception as err:
+        return (None, [], str(err))
+    finally:
+        cursor.close()
+
+def record(connection, name: str, query: str, params, seconds: float, many: bool = False):
+    """
+    Write a query that took the given number of seconds to the slow query
+    log. connection is the connection it was run on, which is used to
+    EXPLAIN it. If many is True, the query was run with executemany() and
+    params is the sequence of parameters it was run with.
+    """
+    count = None
+    if many:
+        params = list(params)
+        count = len(params)
+        params = params[0] if count > 0 else None
+    (plan, problems, explain_error) = _explain(connection, query, params)
+    entry = {
+        'time':         time.strftime('%Y-%m-%d %H:%M:%S'),
+        'query':        name,
+        'ms':           round(seconds * 1000, 2),
+        'params':       redact(params),
+        'rows':         count,
+        'scans':        problems,
+        'explain':      plan,
+        'explain_error':explain_error,
+        'sql':          ' '.join(query.split())[:MAX_QUERY_LENGTH],
+    }
+    try:
+        _get_logger().info(json.dumps(entry, default=str))
+    except OSError:
+        pass # Never let the log break a request
+
+def read_log(path: str) -> list:
+    """
+    Read every entry in the slow query log at the given path, including
+    the old logs that it was rotated into, oldest first
+    """
+    paths = [f"{path}.{i}" for i in range(LOG_BACKUPS, 0, -1)] + [path]
+    entries = []
+    for log_file in paths:
+        if not os.path.exists(log_file):
+            continue
+        with open(log_file) as lines:
+            for line in lines:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue # Skip a line cut short by a crash
+    return entries
+
+def summarize(entries: list) -> list:
+    """
+    Add up the entries of the slow query log for each query. Returns a
+    list of dicts with the query's name, how many times it was slow, the
+    total, average and longest times in milliseconds and how many times
+    it read a table without an index, with the most total time first.
+    """
+    queries = {}
+    for entry in entries:
+        summary = queries.get(entry['query'])
+        if summary is None:
+            summary = queries[entry['query']] = {
+                'query': entry['query'], 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'scans': 0
+            }
+        summary['count'] += 1
+        summary['total_ms'] += entry['ms']
+        summary['max_ms'] = max(summary['max_ms'], entry['ms'])
+        if len(entry.get('scans') or []) > 0:
+            summary['scans'] += 1
+    for summary in queries.values():
+        summary['avg_ms'] = summary['total_ms'] / summary['count']
+    return sorted(queries.values(), key=lambda summary: summary['total_ms'], reverse=True)
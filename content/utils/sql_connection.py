@@ -1,10 +1,342 @@
 """
 Manages the connection to the MySQL server
+
+By default, every Transaction opens a brand new connection and closes it
+when it is done. If DB_POOL_SIZE is set in the CFR environment, connections
+are instead borrowed from a ConnectionPool that is shared by every
+Transaction in this process (see cfrenv for the related variables).
+
+While a RequestScope is active, every Transaction on the same thread joins
+the scope's single connection instead, and everything is committed
+together when the scope ends.
 """
 import os
+import time
+import threading
+from collections import deque
 import mysql.connector as conn
 from typing import List
 from . import cfrenv
+from . import instrumentation
+from . import metrics
+
+# Default values (in seconds) for DB_POOL_MAX_IDLE and DB_POOL_MAX_LIFETIME
+DEFAULT_POOL_MAX_IDLE       = 300
+DEFAULT_POOL_MAX_LIFETIME   = 3600
+
+# Number of seconds to wait for a connection to be returned to a full
+# pool before giving up
+POOL_WAIT_TIMEOUT = 30
+
+def _connect():
+    """
+    Open and return a new connection to the database using the
+    credentials from the CFR environment.
+    """
+    return conn.connect(
+        user        = cfrenv.getenv('DB_USER'),
+        passwd      = cfrenv.getenv('DB_PASS'),
+        host        = cfrenv.getenv('DB_HOST'),
+        database    = cfrenv.getenv('DB_DATABASE')
+    )
+
+class PooledConnection:
+    """
+    A connection owned by a ConnectionPool, along with the times
+    it was opened and last returned to the pool.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.created    = time.monotonic()
+        self.last_used  = self.created
+
+class ConnectionPool:
+    """
+    A bounded pool of open database connections.
+
+    At most 'size' connections are open at once. Idle connections that
+    have been unused for more than 'max_idle' seconds are closed the next
+    time a connection is borrowed or given back, and connections that have
+    been open for more than 'max_lifetime' seconds are closed instead of
+    being used again. Every connection is pinged when it is borrowed, so a
+    connection that was dropped by the server is replaced rather than
+    handed out.
+
+    This is thread-safe, but a pool should not be shared across processes.
+    """
+    def __init__(self, size: int, max_idle: int, max_lifetime: int, connect: callable = _connect):
+        self.size           = size
+        self.max_idle       = max_idle
+        self.max_lifetime   = max_lifetime
+        self._connect       = connect
+        self._idle          = deque()
+        self._num_open      = 0
+        self._condition     = threading.Condition()
+
+    @property
+    def num_open(self) -> int:
+        """
+        The number of connections that are open, whether they are idle
+        or borrowed (including ones that are being opened)
+        """
+        return self._num_open
+
+    @property
+    def num_idle(self) -> int:
+        """
+        The number of open connections that are waiting in the pool
+        """
+        return len(self._idle)
+
+    def _is_expired(self, pooled: PooledConnection, now: float) -> bool:
+        """
+        Return whether or not the given connection has been idle or
+        open for too long to be used again.
+        """
+        return (
+            now - pooled.last_used > self.max_idle or
+            now - pooled.created > self.max_lifetime
+        )
+
+    def _is_healthy(self, pooled: PooledConnection) -> bool:
+        """
+        Return whether or not the given connection is still usable
+        """
+        try:
+            pooled.connection.ping(reconnect = False)
+            return True
+        except Exception:
+            return False
+
+    def _take_expired(self, now: float) -> list:
+        """
+        Take the connections that have been idle for too long out of the
+        pool and return them, so they can be closed. Connections are given
+        back on the right, so the ones that have been idle the longest are
+        on the left. Must be called while holding the lock.
+        """
+        expired = []
+        while len(self._idle) > 0 and now - self._idle[0].last_used > self.max_idle:
+            expired.append(self._idle.popleft())
+        return expired
+
+    def _discard(self, pooled: PooledConnection):
+        """
+        Close the given connection and free up its slot in the pool.
+        """
+        try:
+            pooled.connection.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._num_open -= 1
+            self._condition.notify()
+
+    def acquire(self) -> PooledConnection:
+        """
+        Borrow a connection from the pool. If there are no idle connections,
+        a new one is opened, unless the pool is full in which case this waits
+        for another thread to release one.
+
+        The returned connection must be given back with release()
+        """
+        deadline = time.monotonic() + POOL_WAIT_TIMEOUT
+        while True:
+            # Close connections that have gone idle first, since
+            # that may free up a slot
+            with self._condition:
+                expired = self._take_expired(time.monotonic())
+            for old in expired:
+                self._discard(old)
+
+            pooled = None
+            with self._condition:
+                while pooled is None:
+                    if len(self._idle) > 0:
+                        # Reuse the most recently returned connection first
+                        # so that the oldest ones are allowed to go idle
+                        pooled = self._idle.pop()
+                    elif self._num_open < self.size:
+                        self._num_open += 1
+                        break
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise RuntimeError("Timed out waiting for a database connection!")
+                        self._condition.wait(remaining)
+
+            # Open a new connection (outside of the lock)
+            if pooled is None:
+                try:
+                    return PooledConnection(self._connect())
+                except Exception:
+                    with self._condition:
+                        self._num_open -= 1
+                        self._condition.notify()
+                    raise
+
+            # Check that an idle connection is still good before using it
+            if self._is_expired(pooled, time.monotonic()) or not self._is_healthy(pooled):
+                self._discard(pooled)
+                continue
+            return pooled
+
+    def release(self, pooled: PooledConnection, discard: bool = False):
+        """
+        Give a connection back to the pool. The connection must not be
+        in the middle of a transaction.
+
+        If discard is True (or the connection has outlived max_lifetime),
+        the connection is closed instead of being kept.
+        """
+        now = time.monotonic()
+        if discard or now - pooled.created > self.max_lifetime:
+            self._discard(pooled)
+            return
+        pooled.last_used = now
+        with self._condition:
+            expired = self._take_expired(now)
+            self._idle.append(pooled)
+            self._condition.notify()
+        for old in expired:
+            self._discard(old)
+
+# The pool shared by every Transaction in this process.
+# Created by get_pool() the first time it is needed
+_pool: ConnectionPool = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    """
+    Get this process's ConnectionPool, creating it if needed.
+    Returns None if pooling is not enabled in the CFR environment.
+    """
+    global _pool
+    if _pool is None:
+        size = cfrenv.getint('DB_POOL_SIZE', 0)
+        if size <= 0:
+            return None
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    size,
+                    cfrenv.getint('DB_POOL_MAX_IDLE', DEFAULT_POOL_MAX_IDLE),
+                    cfrenv.getint('DB_POOL_MAX_LIFETIME', DEFAULT_POOL_MAX_LIFETIME)
+                )
+    return _pool
+
+@metrics.collect_gauges
+def _pool_gauges() -> dict:
+    """
+    The state of this process's pool, for the /metrics page
+    """
+    if _pool is None:
+        return {}
+    return {
+        'cfr_db_pool_size':                 _pool.size,
+        'cfr_db_pool_connections_open':     _pool.num_open,
+        'cfr_db_pool_connections_idle':     _pool.num_idle,
+    }
+
+# Thread-local storage used to keep track of the active RequestScope
+_local = threading.local()
+
+def current_scope():
+    """
+    Get the RequestScope that is active on this thread, or None
+    if there isn't one.
+    """
+    return getattr(_local, 'scope', None)
+
+def _open_connection():
+    """
+    Get a connection from the pool (if pooling is enabled) or open a
+    new one. Returns a tuple of the connection and the PooledConnection
+    it belongs to (which is None if pooling is not enabled).
+    """
+    pool = get_pool()
+    if pool is not None:
+        pooled = pool.acquire()
+        return (pooled.connection, pooled)
+    else:
+        return (_connect(), None)
+
+def _close_connection(connection, pooled: PooledConnection, clean: bool):
+    """
+    Close a connection from _open_connection(), or give it back to the
+    pool if it came from one. If clean is False, the connection is in an
+    unknown state and will not be reused.
+    """
+    if pooled is not None:
+        get_pool().release(pooled, discard = not clean)
+    else:
+        connection.close()
+
+class RequestScope:
+    """
+    A unit of work spanning an entire request.
+
+    RequestScope is a context manager designed to be used with the 'with'
+    statement. While it is active, every Transaction entered on the same
+    thread will join the scope's connection rather than opening its own,
+    and will not commit when it exits. Instead, all of the work is committed
+    at once when the scope exits, so a request only needs one connection
+    and sees one consistent snapshot of the database.
+
+    If the scope exits because of an exception, or any Transaction inside
+    of it exited because of one (even if that exception was caught later),
+    everything is rolled back instead.
+
+    The connection is not opened until the first Transaction needs it, so
+    requests that never touch the database do not pay for one.
+
+    locals is a dictionary that other modules may use to remember things
+    for the rest of the request.
+
+    Example:
+
+    with RequestScope():
+        with Transaction() as cursor:
+            cursor.execute(...)
+        with Transaction() as cursor:   # Same connection as above
+            cursor.execute(...)
+    # Both are committed here
+
+    """
+    def __init__(self):
+        self._connection    = None
+        self._pooled        = None
+        self.failed         = False
+        self.locals         = {}
+
+    def connection(self):
+        """
+        Get the connection for this scope, opening it if needed.
+        """
+        if self._connection is None:
+            (self._connection, self._pooled) = _open_connection()
+        return self._connection
+
+    def __enter__(self):
+        if current_scope() is not None:
+            raise RuntimeError("A RequestScope is already active on this thread!")
+        _local.scope = self
+        return self
+
+    def __exit__(self, type, value, traceback):
+        _local.scope = None
+        if self._connection is None:
+            return
+        clean = False
+        try:
+            if traceback is None and not self.failed:
+                self._connection.commit()
+            else:
+                self._connection.rollback()
+            clean = True
+        finally:
+            _close_connection(self._connection, self._pooled, clean)
+            self._connection = None
 
 class Transaction:
     """
@@ -17,8 +349,19 @@ class Transaction:
     middle of the code block, the database connection will still automatically
     be closed).
 
+    If connection pooling is enabled, the connection is borrowed from the
+    pool instead and returned to it (rather than closed) afterwards. The
+    transaction is still committed or rolled back first, as above.
+
+    If a RequestScope is active, the cursor is opened on the scope's
+    connection instead and committing or rolling back is left up to
+    the scope. Cursors opened this way are buffered by default so that
+    several of them can share the connection.
+
     Any keyword arguments passed to Transaction will be passed along to the
-    cursor.
+    cursor. While a request is being handled (or if the slow query log is
+    on), the cursor is wrapped so that its queries are timed (see
+    instrumentation and slow_queries).
 
     Example:
 
@@ -32,19 +375,36 @@ class Transaction:
         self._cursor_kwargs = kwargs
 
     def __enter__(self):
-        self._connection = conn.connect(
-            user        = cfrenv.getenv('DB_USER'),
-            passwd      = cfrenv.getenv('DB_PASS'),
-            host        = cfrenv.getenv('DB_HOST'),
-            database    = cfrenv.getenv('DB_DATABASE')
-        )
+        self._scope = current_scope()
+        if self._scope is not None:
+            self._connection = self._scope.connection()
+            kwargs = dict(self._cursor_kwargs)
+            kwargs.setdefault('buffered', True)
+            self._cursor = self._connection.cursor(**kwargs)
+            return instrumentation.instrument_cursor(self._cursor, self._connection)
+
+        (self._connection, self._pooled) = _open_connection()
         self._cursor = self._connection.cursor(**self._cursor_kwargs)
-        return self._cursor
+        return instrumentation.instrument_cursor(self._cursor, self._connection)
 
     def __exit__(self, type, value, traceback):
-        if traceback is None:
-            self._connection.commit()
-        else:
-            self._connection.rollback()
-        self._cursor.close()
-        self._connection.close()
+        # Leave committing to the scope, but make sure it
+        # knows to roll back if something went wrong
+        if self._scope is not None:
+            if traceback is not None:
+                self._scope.failed = True
+            self._cursor.close()
+            return
+
+        clean = False
+        try:
+            if traceback is None:
+                self._connection.commit()
+            else:
+                self._connection.rollback()
+            self._cursor.close()
+            clean = True
+        finally:
+            # A connection that failed to commit or roll back is in an
+            # unknown state, so it should not be reused
+            _close_connection(self._connection, self._pooled, clean)
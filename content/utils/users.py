@@ -2,9 +2,10 @@
 Functions related to manipulating users in the database
 """
 from .sql_connection import Transaction
-from .authentication import hash_password, User
+from .authentication import hash_password, end_user_sessions, User
 from .errors import Error400
 from . import db_utils
+from . import refcache
 
 # Query to insert a new user into the database
 # Parameters are username, usr_password, banner_id, type (role) and email
@@ -37,6 +38,9 @@ def edit_user(query, current_user: User):
     """
     Delete a user or change their password
 
+    Either way, all of the user's sessions are ended, so they will
+    have to log in again.
+
     query is a dict parsed from the form data in a POST request.
     It should contain the following fields:
         'button': A string; either 'delete' or 'password' specifying
@@ -78,12 +82,21 @@ def edit_user(query, current_user: User):
             # Hash and update password
             password_hash = hash_password(password)
             cursor.execute(UPDATE_PASSWORD, (password_hash, username))
+            end_user_sessions(cursor, username)
 
         # Delete the user
         elif choice == 'delete':
             if username == current_user.username:
                 raise Error400("You cannot delete yourself!")
+            end_user_sessions(cursor, username)
+            # Courses they approved will no longer have an approver,
+            # so the approval counts of those cfrs need to be updated
+            approved = db_utils.get_semesters_approved_by(cursor, username)
             cursor.execute(DELETE_USER, (username,))
+            for (dept_name, semester) in approved:
+                db_utils.refresh_semester_cfr_totals(cursor, dept_name, semester)
+            # Their department may have no submitters left
+            refcache.invalidate(cursor)
 
         else:
             raise Error400("'button' value must be either 'password' or 'delete'!")
@@ -153,6 +166,7 @@ def add_user(query):
                 raise Error400("submitters must have a 'dept_name' parameter")
             dept_name = query['dept_name'][0]
             cursor.execute(ADD_SUBMITTER, (username, dept_name))
+            refcache.invalidate(cursor)
 
 
 
@@ -1,10 +1,14 @@
 #!/usr/bin/python3
-import os
-import traceback
-import mysql.connector
+"""
+The main entry point for the web server.
+
+Every request is routed by the top part of its path to one of the
+handlers below. The routing table is built once when this file is
+imported (see utils.routing), and each handler is called with a
+routing.Request for the request it is handling.
+"""
+import sys
 import json
-from urllib.parse import parse_qs
-from pathlib import PurePath
 
 from utils import page_builder
 from utils import sql_connection
@@ -14,13 +18,336 @@ from utils import users
 from utils import semesters
 from utils import request
 from utils import errors
+from utils import db_utils
+from utils import middleware
+from utils import instrumentation
+from utils import metrics
+from utils import email_notification
+from utils import routing
+from utils.routing import Request, GET, POST, FORM_BODY, JSON_BODY
+from utils.authentication import UserRole
+
+router = routing.Router()
+
+###########################################
+# RESPONSE HANDLERS
+#   Each function should respond to a particular request and return
+#   a byte seqence to return, or a page_builder.PageStream to send
+#   the page a piece at a time. (Each one should also call req.respond
+#   or req.start_response at some point)
+#
+#   Each handler takes the routing.Request it is handling. Unless its
+#   route is registered with login=False, req.user is the logged in
+#   authentication.User and is gaurenteed to not be None, and the
+#   user's role has already been checked against the route's roles.
+############################################
+
+###########################################
+# LOGIN-EXEMPT HANDLERS
+#   These can be called without the user being logged in
+###########################################
+
+@router.route('login', methods=GET+POST, body=FORM_BODY, login=False)
+def handle_login(req: Request) -> bytes:
+    """
+    'login' can do one of two things depending on if a request
+    body is included or not.
+
+    If there is a body:
+    The body will be read as HTML form data with
+    a 'username' and 'password' field. These values will be used
+    to authenticate the user and, if successful, the response
+    will set cookies for the user and redirect them to the home page.
+    If unsuccessful, the login page will be returned.
+
+    If there is no body:
+    The standard login page will be returned.
+    If the body exists but does not contain the username
+    or password parameters, it will be treated as if there was no body
+
+    Either way, the user's current session (if they have one) is ended.
+    """
+    with instrumentation.timer('auth'):
+        if 'HTTP_COOKIE' in req.environ:
+            authentication.end_session(req.environ['HTTP_COOKIE'])
+
+    query = req.body
+    if 'username' in query and 'password' in query:
+        username = query['username'][0]
+        password = query['password'][0]
+        with instrumentation.timer('auth'):
+            user = authentication.authenticate(username,password)
+
+        # If the user was authenticated, redirect to the home page
+        if user is not None:
+            cookies = [('Set-Cookie',c) for c in authentication.create_cookies(user)]
+            return req.redirect('/', additional_headers = cookies)
+        # If the user was not authenticated, send back the login page
+        else:
+            cookies = [('Set-Cookie', c) for c in authentication.clear_cookies()]
+            req.respond(additional_headers = cookies)
+            page = page_builder.build_login_page(message="The provided username or password is incorrect!")
+            return page_builder.soup_to_bytes(page)
+
+    # If there is no body (or username and password are otherwise not present)
+    # then return the login page
+    else:
+        cookies = [('Set-Cookie', c) for c in authentication.clear_cookies()]
+        req.respond(additional_headers = cookies)
+        return page_builder.render_page_from_file("login.html", includeNavbar=False)
+
+@router.route('metrics', login=False, mime=metrics.METRICS_MIME)
+def handle_metrics(req: Request) -> bytes:
+    """
+    Return the metrics of the server (see utils.metrics) in the
+    Prometheus text format. Only the addresses in METRICS_ALLOWED_IPS
+    (from the CFR environment) may see them.
+
+    The metrics are needed most when something is wrong, so if the
+    outbox can not be read from the database, its gauges are left out
+    (and cfr_email_outbox_up is 0) rather than failing the whole page.
+    """
+    if not metrics.is_allowed(req.environ.get('REMOTE_ADDR')):
+        req.respond(status="403 Forbidden", mime="text/plain")
+        return "The metrics can not be seen from this address".encode('utf-8')
+
+    try:
+        with sql_connection.Transaction() as cursor:
+            (waiting, failed, oldest) = email_notification.get_outbox_backlog(cursor)
+        outbox = {
+            'cfr_email_outbox_up':              1,
+            'cfr_email_outbox_waiting':         waiting,
+            'cfr_email_outbox_failed':          failed,
+            'cfr_email_outbox_oldest_seconds':  oldest,
+        }
+    except Exception:
+        outbox = {'cfr_email_outbox_up': 0}
+    req.respond(mime=metrics.METRICS_MIME)
+    return metrics.render(outbox)
+
+###########################################
+# PAGE HANDLERS
+#   These handlers all return web pages
+###########################################
+
+@router.route('/')
+def handle_root(req: Request) -> bytes:
+    """
+    The root page ('/') redirects to the cfr page
+    for submitters and approvers, but creates the admin
+    page for admins.
+    """
+    if req.user.role == UserRole.ADMIN:
+        page = page_builder.build_admin_page()
+        req.respond()
+        return page_builder.soup_to_bytes(page)
+    else:
+        return req.redirect('/cfr')
+
+@router.route('cfr', roles=[UserRole.SUBMITTER, UserRole.APPROVER], versioned=True)
+def handle_cfr(req: Request):
+    """
+    Return the course funding request submission page
+    """
+    page = page_builder.build_cfr_page(req.user)
+    req.respond()
+    return page
+
+@router.route('salary_saving', versioned=True)
+def handle_salary_saving(req: Request) -> bytes:
+    """
+    Return the salary savings submission page.
+    If the user is an approver or admin,
+    they can also supply a 'dept' value in the query string.
+    """
+    page = page_builder.build_savings_page(req.user, dept_override=req.query_value('dept'))
+    req.respond()
+    return page_builder.soup_to_bytes(page)
 
-def application(environ, start_response):
+@router.route('revisions', versioned=True)
+def handle_revisions(req: Request):
+    """
+    Return the revisions page. If the user is an approver or admin,
+    they can also supply a 'dept' value in the query string to view
+    the revisions of a particular department. Otherwise, the page
+    will only have the revisions for the user's department.
+    A 'view' value of 'diff' shows only the changes in each revision
+    """
+    page = page_builder.build_revisions_page(req.user,
+        dept_override=req.query_value('dept'), view=req.query_value('view'))
+    req.respond()
+    return page
+
+@router.route('previous_semesters', versioned=True)
+def handle_previous_semesters(req: Request):
+    """
+    Return the previous semesters page. If the user is an approver or admin,
+    they can also supply a 'dept' value in the query string to view
+    the history of a particular department. Otherwise, the page
+    will only have the history for the user's department
+    """
+    page = page_builder.build_previous_semesters_page(req.user, dept_override=req.query_value('dept'))
+    req.respond()
+    return page
+
+@router.route('revision_history', versioned=True, mime='application/json')
+def handle_revision_history(req: Request) -> bytes:
+    """
+    Return the revision history of a department in one semester as JSON.
+    The semester is given by the 'semester' (season) and 'year' values in
+    the query string. If the user is an approver or admin, they must also
+    supply a 'dept' value in the query string. Submitters will always get
+    their own department's history. A 'view' value of 'diff' returns
+    only the changes in each revision
+    """
+    if req.query_value('semester') is None or req.query_value('year') is None:
+        raise errors.Error400("Missing 'semester' or 'year' parameter!")
+    semester = (req.query_value('semester'), req.query_value('year'))
+
+    data = page_builder.build_revision_history_data(req.user, semester,
+        dept_override=req.query_value('dept'), view=req.query_value('view'))
+    req.respond(mime = 'application/json')
+    return json.dumps(data).encode('utf-8')
+
+@router.route('help')
+def hande_help(req: Request) -> bytes:
+    """
+    Return the help page
+    """
+    page = page_builder.render_help_page(req.user)
+    req.respond(additional_headers = [('ETag', page_builder.help_page_etag(req.user))])
+    return page
+
+###########################################
+# POST HANDLERS
+#   These are responses to POST requests
+###########################################
+
+@router.route('add_course', roles=[UserRole.SUBMITTER, UserRole.APPROVER], methods=POST, body=JSON_BODY)
+def handle_cfr_from_courses(req: Request) -> bytes:
+    """
+    Handle POST request to create a new cfr from a list
+    of courses specified in JSON in the request body.
+    """
+    courses_inserted = request.new_cfr_from_courses(req.user, req.body)
+    req.respond(mime = 'text/plain')
+    return f"{courses_inserted}".encode('utf-8')
+
+@router.route('add_sal_savings', roles=[UserRole.SUBMITTER], methods=POST, body=JSON_BODY)
+def handle_cfr_from_sal_savings(req: Request) -> bytes:
+    """
+    Handle POST request to create a new cfr from a list
+    of salary savings specified in JSON in the request body.
+    """
+    savings_inserted = request.new_cfr_from_sal_savings(req.user, req.body)
+    req.respond(mime = 'text/plain')
+    return f"{savings_inserted}".encode('utf-8')
+
+@router.route('approve_courses', roles=[UserRole.APPROVER], methods=POST, body=JSON_BODY)
+def handle_approve_courses(req: Request) -> bytes:
+    """
+    Handle POST request to approve courses from a list 
+    specified in JSON in the request body.
+    """
+    courses_approved = request.approve_courses(req.user, req.body)
+    req.respond(mime = 'text/plain')
+    return f"{courses_approved}".encode('utf-8')
+
+@router.route('add_commitments', roles=[UserRole.APPROVER], methods=POST, body=JSON_BODY)
+def handle_add_commitments(req: Request) -> bytes:
+    """
+    Handle POST request to add dean commitments to cfrs specified
+    in JSON in the request body
+    """
+    request.commit_cfr(req.body)
+    req.respond(mime = 'text/plain')
+    return "OK".encode('utf-8')
+
+###########################################
+# ADMIN ACTIONS
+###########################################
+
+@router.route('edit_user', roles=[UserRole.ADMIN], methods=POST, body=FORM_BODY)
+def handle_edit_user(req: Request) -> bytes:
+    """
+    Handle POST request to edit or delete a user using form
+    data in the request body. If successful, redirects to the
+    home page.
+    """
+    users.edit_user(req.body, req.user)
+    return req.redirect('/', body="OK")
+
+@router.route('add_user', roles=[UserRole.ADMIN], methods=POST, body=FORM_BODY)
+def handle_add_user(req: Request) -> bytes:
+    """
+    Handle POST request to add a user using form
+    data in the request body. If successful, redirects to the
+    home page.
+    """
+    users.add_user(req.body)
+    return req.redirect('/', body="OK")
+
+@router.route('change_semester', roles=[UserRole.ADMIN], methods=POST, body=FORM_BODY)
+def handle_change_semester(req: Request) -> bytes:
+    """
+    Handle POST request to change the active semester using form
+    data in the request body. If successful, redirects to the
+    home page.
+    """
+    semesters.change_semester(req.body)
+    return req.redirect('/', body="OK")
+
+@router.route('add_semester', roles=[UserRole.ADMIN], methods=POST, body=FORM_BODY)
+def handle_add_semester(req: Request) -> bytes:
+    """
+    Handle POST request to add a semester using form
+    data in the request body. If successful, redirects to the
+    home page.
+    """
+    semesters.add_semester(req.body)
+    return req.redirect('/', body="OK")
+
+def _call_handler(req: Request):
+    """
+    Log the user in (if the request's route needs it), check that they
+    are allowed to use the route and call its handler, returning the
+    handler's response. This is done inside of the request's RequestScope.
+    """
+    route = req.route
+    if route.login:
+        # Attempt to log the user in using the cookies from their browser.
+        # If unsuccessful, redirect to the login page
+        if 'HTTP_COOKIE' in req.environ:
+            with instrumentation.timer('auth'):
+                req.user = authentication.authenticate_from_cookie(req.environ['HTTP_COOKIE'])
+        if req.user is None:
+            return req.redirect('/login')
+        if not route.allows(req.user):
+            raise RuntimeError(route.role_error)
+
+    # If the client already has the latest version of the page, don't build it
+    if route.versioned and req.method in GET:
+        with sql_connection.Transaction() as cursor:
+            data_version = db_utils.get_data_version(cursor)
+        req.etag = middleware.page_etag(data_version,
+            req.user.username, req.user.role.name, req.user.dept_name,
+            routing.top_of_path(req.environ.get('PATH_INFO', '/')),
+            req.environ.get('QUERY_STRING', ''))
+        if middleware.not_modified(req.environ, req.etag):
+            req.respond(status = "304 Not Modified", mime = route.mime)
+            return bytes()
+
+    with instrumentation.timer('render'):
+        return route.handler(req)
+
+def handle_request(environ, start_response):
     """
     This is the main entry point for the web server.
 
-    This function must be named 'application' because that is what the web
-    server will look to call when it calls the file.
+    The web server calls 'application' (at the bottom of this file),
+    which is this function wrapped with utils.middleware to compress
+    responses and answer conditional GETs, and with utils.instrumentation
+    to record where the time for each request goes.
     environ contains information regarding the HTTP request that was
     received.
     start_response is a function to be called with an HTTP status and
@@ -31,394 +358,59 @@ def application(environ, start_response):
     Please see the WSGI standard for more information:
     https://www.python.org/dev/peps/pep-3333/
     """
+    req = Request(environ, start_response)
 
-    def respond(
-        status: str     = "200 OK",
-        mime: str       = "text/html; charset=utf-8",
-        additional_headers: list = []
-    ):
-        """
-        Call start_response with the given status, and content-type
-        header for the given MIME Type and any additonal headers provided.
-
-        Provided headers should be tuples with the variable name as the first
-        part and the value as the second part.
-        Example: ('Content-Length', 500)
-
-        If no status or MIME Type is provided, they will default to
-        '200 OK' and 'text/html' respectively.
-        """
-        start_response(status, [('Content-Type',mime)]+additional_headers)
-
-    def dict_from_POST():
-        """
-        Returns a dictionary obtained by parsing the body of the HTTP request,
-        assumes that this is a POST request and that the body is in the
-        application/x-www-form-urlencoded format.
-
-        If the request has no body, then this will still return a dict, but
-        it will be empty. Each value in the dictionary will be list containing
-        the values for that entry.
-        """
-        body_text = environ['wsgi.input'].read()
-        query_raw = parse_qs(body_text) # This will be empty if there is no body
-
-        # Convert the query keys and values from bytes to strings
-        query = {}
-        for key in query_raw.keys():
-            new_key = key
-            if isinstance(key, bytes):
-                new_key = key.decode('utf-8')
-            query[new_key] = []
-            for item in query_raw[key]:
-                if isinstance(item, bytes):
-                    query[new_key].append(item.decode('utf-8'))
-                else:
-                    query[new_key].append(item)
-
-        return query
-
-    ###########################################
-    # RESPONSE HANDLERS
-    #   Each function should respond to a particular request and return
-    #   a byte seqence to return. (Each one should also call respond
-    #   or start_response at some point)
-    #
-    #   Each handler must take in a dictionary of keyword arguments.
-    #   They will be called with the following fields in the arguments,
-    #   but not every handler has to use them:
-    #
-    #       'user':     An instance of authentication.User representing
-    #                   the logged in user. For any handler except
-    #                   the ones in login_exempt_handlers,
-    #                   this is gaurenteed to not be None.
-    ############################################
-
-    ###########################################
-    # LOGIN-EXEMPT HANDLERS
-    #   These can be called with the user being logged in
-    ###########################################
-    
-    def handle_login(**kwargs):
-        """
-        'login' can do one of two things depending on if a request
-        body is included or not.
-
-        If there is a body:
-        The body will be read as HTML form data with
-        a 'username' and 'password' field. These values will be used
-        to authenticate the user and, if successful, the response
-        will set cookies for the user and redirect them to the home page.
-        If unsuccessful, the login page will be returned.
-
-        If there is no body:
-        The standard login page will be returned.
-        If the body exists but does not contain the username
-        or password parameters, it will be treated as if there was no body
-        """
-
-        query = dict_from_POST()
-        if 'username' in query and 'password' in query:
-            username = query['username'][0]
-            password = query['password'][0]
-            user = authentication.authenticate(username,password)
-
-            # If the user was authenticated, redirect to the home page
-            if user is not None:
-                cookies = [('Set-Cookie',c) for c in authentication.create_cookies(user)]
-                start_response('303 See Other',[('Location','/')]+cookies)
-                return "REDIRECT".encode('utf-8')
-            # If the user was not authenticated, send back the login page
-            else:
-                cookies = [('Set-Cookie', c) for c in authentication.clear_cookies()]
-                respond(additional_headers = cookies)
-                page = page_builder.build_login_page(message="The provided username or password is incorrect!")
-                return page_builder.soup_to_bytes(page)
-
-        # If there is no body (or username and password are otherwise not present)
-        # then return the login page
-        else:
-            cookies = [('Set-Cookie', c) for c in authentication.clear_cookies()]
-            respond(additional_headers = cookies)
-            page = page_builder.build_login_page()
-            return page_builder.soup_to_bytes(page)
-
-    ###########################################
-    # PAGE HANDLERS
-    #   These handlers all return web pages
-    ###########################################
-
-    def handle_root(**kwargs):
-        """
-        The root page ('/') redirects to the cfr page
-        for submitters and approvers, but creates the admin
-        page for admins.
-        """
-        if kwargs['user'].role == authentication.UserRole.ADMIN:
-            page = page_builder.build_admin_page()
-            respond()
-            return page_builder.soup_to_bytes(page)
-        else:
-            start_response('303 See Other',[('Location','/cfr')])
-            return "REDIRECT".encode('utf-8')
-
-    def handle_cfr(**kwargs):
-        """
-        Return the course funding request submission page
-        """
-        if kwargs['user'].role == authentication.UserRole.ADMIN:
-            raise RuntimeError("Only submitters or approvers can do this!")
-        page = page_builder.build_cfr_page(kwargs['user'])
-        respond()
-        return page_builder.soup_to_bytes(page)
-
-    def handle_salary_saving(**kwargs):
-        """
-        Return the salary savings submission page.
-        If the user is an approver or admin,
-        they can also supply a 'dept' value in the query string.
-        """
-        dept = None
-        if 'QUERY_STRING' in environ:
-            query = parse_qs(environ['QUERY_STRING'])
-            if 'dept' in query:
-                dept= query['dept'][0]
-
-        page = page_builder.build_savings_page(kwargs['user'], dept_override=dept)
-        respond()
-        return page_builder.soup_to_bytes(page)
-
-    def handle_revisions(**kwargs):
-        """
-        Return the revisions page. If the user is an approver or admin,
-        they can also supply a 'dept' value in the query string to view
-        the revisions of a particular department. Otherwise, the page
-        will only have the revisions for the user's department
-        """
-        dept = None
-        if 'QUERY_STRING' in environ:
-            query = parse_qs(environ['QUERY_STRING'])
-            if 'dept' in query:
-                dept= query['dept'][0]
-        
-        page = page_builder.build_revisions_page(kwargs['user'], dept_override=dept)
-        respond()
-        return page_builder.soup_to_bytes(page)
-
-    def handle_previous_semesters(**kwargs):
-        """
-        Return the previous semesters page. If the user is an approver or admin,
-        they can also supply a 'dept' value in the query string to view
-        the history of a particular department. Otherwise, the page
-        will only have the history for the user's department
-        """
-        dept = None
-        if 'QUERY_STRING' in environ:
-            query = parse_qs(environ['QUERY_STRING'])
-            if 'dept' in query:
-                dept= query['dept'][0]
-
-        page = page_builder.build_previous_semesters_page(kwargs['user'], dept_override=dept)
-        respond()
-        return page_builder.soup_to_bytes(page)
-
-    def hande_help(**kwargs):
-        """
-        Return the help page
-        """
-        page = page_builder.build_help_page(kwargs['user'])
-        respond()
-        return page_builder.soup_to_bytes(page)
-
-    ###########################################
-    # POST HANDLERS
-    #   These are responses to POST requests
-    ###########################################
-
-    def handle_cfr_from_courses(**kwargs):
-        """
-        Handle POST request to create a new cfr from a list
-        of courses specified in JSON in the request body.
-        """
-        if kwargs['user'].role != authentication.UserRole.SUBMITTER:
-            if kwargs['user'].role != authentication.UserRole.APPROVER:
-                raise RuntimeError("Only submitters can do this!")
-        body_text = environ['wsgi.input'].read()
-        data = json.loads(body_text)
-        courses_inserted = request.new_cfr_from_courses(kwargs['user'], data)
-        respond(mime = 'text/plain')
-        return f"{courses_inserted}".encode('utf-8')
-
-    def handle_cfr_from_sal_savings(**kwargs):
-        """
-        Handle POST request to create a new cfr from a list
-        of salary savings specified in JSON in the request body.
-        """
-        if kwargs ['user'].role != authentication.UserRole.SUBMITTER:
-            raise RuntimeError("Only submitters can do this!")
-        body_text = environ['wsgi.input'].read()
-        data = json.loads(body_text)
-        savings_inserted = request.new_cfr_from_sal_savings(kwargs['user'], data)
-        respond(mime = 'text/plain')
-        return f"{savings_inserted}".encode('utf-8')
-
-    def handle_approve_courses(**kwargs):
-        """
-        Handle POST request to approve courses from a list 
-        specified in JSON in the request body.
-        """
-        if kwargs ['user'].role != authentication.UserRole.APPROVER:
-            raise RuntimeError("Only approvers can do this!")
-        body_text = environ['wsgi.input'].read()
-        data = json.loads(body_text)
-        courses_approved = request.approve_courses(kwargs['user'], data)
-        respond(mime = 'text/plain')
-        return f"{courses_approved}".encode('utf-8')
-
-    def handle_add_commitments(**kwargs):
-        """
-        Handle POST request to add dean commitments to cfrs specified
-        in JSON in the request body
-        """
-        if kwargs ['user'].role != authentication.UserRole.APPROVER:
-            raise RuntimeError("Only approvers can do this!")
-        body_text = environ['wsgi.input'].read()
-        data = json.loads(body_text)
-        request.commit_cfr(data)
-        respond(mime = 'text/plain')
-        return "OK".encode('utf-8')
-
-    ###########################################
-    # ADMIN ACTIONS
-    ###########################################
-
-    def handle_edit_user(**kwargs):
-        """
-        Handle POST request to edit or delete a user using form
-        data in the request body. If successful, redirects to the
-        home page.
-        """
-        if kwargs['user'].role != authentication.UserRole.ADMIN:
-            raise RuntimeError("Only admins can do this!")
-        users.edit_user(dict_from_POST(), kwargs['user'])
-        start_response('303 See Other',[('Location','/')])
-        return "OK".encode('utf-8')
-
-    def handle_add_user(**kwargs):
-        """
-        Handle POST request to add a user using form
-        data in the request body. If successful, redirects to the
-        home page.
-        """
-        if kwargs['user'].role != authentication.UserRole.ADMIN:
-            raise RuntimeError("Only admins can do this!")
-        users.add_user(dict_from_POST())
-        start_response('303 See Other',[('Location','/')])
-        return "OK".encode('utf-8')
-
-    def handle_change_semester(**kwargs):
-        """
-        Handle POST request to change the active semester using form
-        data in the request body. If successful, redirects to the
-        home page.
-        """
-        if kwargs['user'].role != authentication.UserRole.ADMIN:
-            raise RuntimeError("Only admins can do this!")
-        semesters.change_semester(dict_from_POST())
-        start_response('303 See Other',[('Location','/')])
-        return "OK".encode('utf-8')
-
-    def handle_add_semester(**kwargs):
-        """
-        Handle POST request to add a semester using form
-        data in the request body. If successful, redirects to the
-        home page.
-        """
-        if kwargs['user'].role != authentication.UserRole.ADMIN:
-            raise RuntimeError("Only admins can do this!")
-        semesters.add_semester(dict_from_POST())
-        start_response('303 See Other',[('Location','/')])
-        return "OK".encode('utf-8')
-
-    # Register handlers into a dictionary.
-    # The login-exempt handlers can be called
-    # without the user needing to be logged in
-    login_exempt_handlers = {
-        'login':    handle_login
-    }
-    # These handlers require the user to be logged in.
-    # Attempting to access them without being logged in
-    # will cause a redirect to the login page.
-    handlers = {
-        '/':                    handle_root,
-        'cfr':                  handle_cfr,
-        'salary_saving':        handle_salary_saving,
-        'previous_semesters':   handle_previous_semesters,
-        'revisions':            handle_revisions,
-        'help':                 hande_help,
-        'add_course':           handle_cfr_from_courses,
-        'add_sal_savings':      handle_cfr_from_sal_savings,
-        'approve_courses' :     handle_approve_courses,
-        'add_commitments':      handle_add_commitments,
-        'add_user':             handle_add_user,
-        'edit_user':            handle_edit_user,
-        'change_semester':      handle_change_semester,
-        'add_semester':         handle_add_semester,
-    }
-
-    # Initialize the CFR environment
-    cfrenv.init_environ(environ)
+    # Initialize the CFR environment (only once per process)
+    cfrenv.load_environ(environ)
     # If the environment is not configured correctly. Respond
     # with an error page immediately.
     if not cfrenv.verify_environ():
-        respond(status="500 Internal Server Error")
-        error_page = page_builder.build_page_from_file('config_error.html')
-        return page_builder.soup_to_bytes(error_page)
+        req.respond(status="500 Internal Server Error")
+        yield page_builder.render_page_from_file('config_error.html')
+        return
 
     # Most of the execution is wrapped in a try/catch. If an exception
     # is thrown, it will be caught and passed to the error handler
     # which will generate a nicely-formatted 500 Internal Server Error page
     try:
 
-        # Get the top part of the path supplied in the request's URL.
-        # If no path was given, this will simply be '/'.
-        # This will be used to determine what function the server does
-        path = PurePath(environ.get('PATH_INFO').split('?')[0])
-        if len(path.parts) < 2:
-            top = '/'
-        else:
-            top = path.parts[1]
-
-        # Check if the request is in login_exempt_handlers and call
-        # it if it is. Otherwise, log in
-        if top in login_exempt_handlers:
-            yield login_exempt_handlers[top]()
+        # Find the route for the top part of the path supplied in the
+        # request's URL. If the top part of the path was not recognized,
+        # send back a 404 page.
+        req.route = router.match(environ.get('PATH_INFO', '/'))
+        if req.route is None:
+            req.respond(status="404 Not Found")
+            yield page_builder.render_page_from_file("404.html", includeNavbar=False)
             return
 
-        if top in handlers:
-            # Attempt to log the user in using the cookies from their browser.
-            # If unsuccessful, redirect to the login page
-            user = None
-            if 'HTTP_COOKIE' in environ:
-                user = authentication.authenticate_from_cookie(environ['HTTP_COOKIE'])
-            if user is None:
-                start_response('303 See Other',[('Location','/login')])
-                yield "REDIRECT".encode('utf-8')
-                return
-
-            yield handlers[top](user = user)
+        environ[metrics.ROUTE_KEY] = routing.top_of_path(environ.get('PATH_INFO', '/'))
+
+        if req.method not in req.route.methods:
+            req.respond(status="405 Method Not Allowed", mime="text/plain",
+                additional_headers=[('Allow', req.route.allow)])
+            yield f"{req.method} is not allowed here".encode('utf-8')
             return
 
-        # If the top part of the path was not recognized, send back
-        # a 404 page.
-        respond(status="404 Not Found")
-        error_page = page_builder.build_page_from_file("404.html", includeNavbar=False)
-        yield page_builder.soup_to_bytes(error_page)
+        # Every database transaction made while handling the request
+        # shares one connection and is committed once the handler returns
+        with sql_connection.RequestScope():
+            response = _call_handler(req)
+
+        # A PageStream is only built as it is sent, after the
+        # request's transaction has been committed
+        if isinstance(response, page_builder.PageStream):
+            environ[middleware.STREAMING_KEY] = True
+            yield from instrumentation.timed('stream', response)
+        else:
+            yield response
 
     except errors.Error400 as err400:
-        respond(status="400 Bad Request", mime="text/plain")
+        req.respond(status="400 Bad Request", mime="text/plain", exc_info=sys.exc_info())
         yield str(err400).encode('utf-8')
     except Exception as err:
-        respond(status="500 Internal Server Error")
+        req.respond(status="500 Internal Server Error", exc_info=sys.exc_info())
         error_page = page_builder.build_500_error_page(err)
         yield page_builder.soup_to_bytes(error_page)
+
+# The entry point the web server looks for. It must be named 'application'
+application = instrumentation.wrap(middleware.wrap(handle_request))
@@ -1,17 +1,29 @@
 """
 Utilities for calling wsgi_main directly so that a debugger can be
 attached or tests can be performed
+
+Run with no arguments (or a URL) for the interactive debugger, or with
+'benchmark' to time a scripted workload (see benchmark_mode()):
+
+    python3 debug.py benchmark --threads 4 --iterations 50 --output before.json
+    python3 debug.py benchmark --threads 4 --iterations 50 --compare before.json
 """
 import sys
 import os
 import re
+import json
+import time
+import argparse
 import urllib.parse
-from io import StringIO
+import concurrent.futures
+from io import StringIO, BytesIO
 import http.cookies as cookies
 
 # Import wsgi_main from the content directory
 sys.path.append(os.path.join(os.path.dirname(__file__),'content'))
 import wsgi_main #pylint: disable=import-error
+from utils import instrumentation #pylint: disable=import-error
+from utils import routing #pylint: disable=import-error
 
 COOKIE_FILE = os.path.join(os.path.dirname(__file__),'.debug_cookies')
 cookie_regex = re.compile(r'Set-Cookie:\s+(?P<key>\w+)\s*=\s*"?(?P<value>[^\s;]*)"?\s*;?')
@@ -75,39 +87,18 @@ class ResponseSummary():
         string += self.body
         return string
 
-def simulate_request(url, body_file = None) -> ResponseSummary:
+def build_environ(url: str, body = None, jar: cookies.SimpleCookie = None) -> dict:
     """
-    Send the given url to the wsgi application and return its response
-    in a ResponseSummary
-    Optionally takes body_file which is the name of a file to be used
-    as the body of the sent request
+    Build the WSGI environ for a request to the given url.
+    body is a file-like object with the body of the request (which makes
+    it a POST request) or None, and jar holds the cookies that are sent
+    (the cookie loaded from the cookie file if it is None)
     """
-    global cookie
-
-    response_started = False
-    status = None
-    headers = []
-    output_begun = False
+    if jar is None:
+        jar = cookie
 
-    # This is the 'start_response' callable that is passed to application
-    def handle_response(_status, _headers):
-        nonlocal response_started, status, headers, output_begun
-        if (output_begun):
-            raise RuntimeError("start_response was called after some of the response body was already sent!")
-        response_started = True
-        status = _status
-        headers = _headers
-
-    # Prepare the environ
     environ = dict(os.environ.items())
-    if body_file is not None:
-        try:
-            environ['wsgi.input']       = open(body_file)
-        except (IOError):
-            print("Could not open {}!!".format(body_file))
-            environ['wsgi.input']       = StringIO("")
-    else:
-        environ['wsgi.input']       = StringIO("")
+    environ['wsgi.input']           = body if body is not None else StringIO("")
     environ['wsgi.errors']          = sys.stderr
     environ['wsgi.version']         = (1, 0)
     environ['wsgi.multithread']     = False
@@ -116,7 +107,8 @@ def simulate_request(url, body_file = None) -> ResponseSummary:
     environ['wsgi.url_scheme']      = 'http'
 
     environ['PATH_INFO']        = url
-    environ['REQUEST_METHOD']   = 'GET'
+    # Requests with a body are sent as POST requests (like curl does)
+    environ['REQUEST_METHOD']   = 'GET' if body is None else 'POST'
     environ['SCRIPT_NAME']      = wsgi_main.__file__
     query_index = url.find('?')
     if query_index != -1:
@@ -125,10 +117,35 @@ def simulate_request(url, body_file = None) -> ResponseSummary:
     environ['SERVER_PORT']      = 80
     environ['SERVER_PROTOCOL']  = 'HTTP/1.0'
 
-    environ['HTTP_COOKIE'] = cookie.output(attrs = [], header="", sep="; ")
+    environ['HTTP_COOKIE'] = jar.output(attrs = [], header="", sep="; ")
+    return environ
+
+def run_application(environ: dict) -> tuple:
+    """
+    Call the wsgi application with the given environ and return
+    a tuple of the status, headers and body (as bytes) of its response
+    """
+    response_started = False
+    status = None
+    headers = []
+    output_begun = False
+
+    # This is the 'start_response' callable that is passed to application
+    def handle_response(_status, _headers, _exc_info = None):
+        nonlocal response_started, status, headers, output_begun
+        if (output_begun):
+            # As in PEP 3333, an error after the body has started (for
+            # example, while a page is being streamed) is re-raised
+            if _exc_info is not None:
+                raise _exc_info[1].with_traceback(_exc_info[2])
+            raise RuntimeError("start_response was called after some of the response body was already sent!")
+        if (response_started and _exc_info is None):
+            raise RuntimeError("start_response was called twice without exc_info!")
+        response_started = True
+        status = _status
+        headers = _headers
 
     # Call application and assemble its response (which comes as bytes)
-    # into a string
     response_bytes = bytes()
     for next_response in wsgi_main.application(environ, handle_response):
         if not response_started:
@@ -137,19 +154,45 @@ def simulate_request(url, body_file = None) -> ResponseSummary:
             output_begun = True
         response_bytes += next_response
 
-    body = response_bytes.decode('utf-8')
+    return (status, headers, response_bytes)
 
-    # Check headers for Set-Cookie headers
+def update_cookies(headers: list, jar: cookies.SimpleCookie) -> bool:
+    """
+    Store the cookies from any Set-Cookie headers in the given
+    response headers in the given jar. Returns whether there were any.
+    """
     cookies_found = False
     for header in headers:
         if header[0] == 'Set-Cookie':
             match = cookie_regex.match(header[0]+": "+header[1])
             if match is not None:
-                if not cookies_found:
-                    cookies_found = True
-                    print("Found cookies!")
-                cookie[match.group('key')] = match.group('value')
-    if cookies_found:
+                cookies_found = True
+                jar[match.group('key')] = match.group('value')
+    return cookies_found
+
+def simulate_request(url, body_file = None) -> ResponseSummary:
+    """
+    Send the given url to the wsgi application and return its response
+    in a ResponseSummary
+    Optionally takes body_file which is the name of a file to be used
+    as the body of the sent request (which is then sent as a POST request)
+    """
+    global cookie
+
+    body = None
+    if body_file is not None:
+        try:
+            body = open(body_file)
+        except (IOError):
+            print("Could not open {}!!".format(body_file))
+            body = StringIO("")
+
+    (status, headers, response_bytes) = run_application(build_environ(url, body))
+    body = response_bytes.decode('utf-8')
+
+    # Check headers for Set-Cookie headers
+    if update_cookies(headers, cookie):
+        print("Found cookies!")
         save_cookie()
         print(cookie)
 
@@ -234,6 +277,216 @@ def interactive_mode():
         else:
             last_response = request(answer[0], answer[1])
 
+###########################################
+# BENCHMARK
+#   Replays the requests from the travis tests (with the same request
+#   bodies from travis/testdata), so it expects a database that the
+#   travis tests have already been run against (see travis_script.sh).
+#   The workload adds courses and approves them, so never run it
+#   against a database with real data in it.
+###########################################
+
+TESTDATA_DIR = os.path.join(os.path.dirname(__file__), 'travis', 'testdata')
+
+# The workload, as a list of scenarios. Each one is a list of steps that
+# are sent in order with one cookie jar, as tuples of the url, the file in
+# TESTDATA_DIR with the body of the request (or None) and the status that
+# is expected. Each worker goes through the scenarios round-robin
+BENCHMARK_SCENARIOS = [
+    # A submitter working on their cfr
+    [
+        ('/login',                      'submit1_login.data',   '303 See Other'),
+        ('/cfr',                        None,                   '200 OK'),
+        ('/add_course',                 'art_courses1.json',    '200 OK'),
+        ('/cfr',                        None,                   '200 OK'),
+        ('/add_course',                 'art_courses2.json',    '200 OK'),
+        ('/previous_semesters',         None,                   '200 OK'),
+    ],
+    # Another submitter in a different department
+    [
+        ('/login',                      'submit2_login.data',   '303 See Other'),
+        ('/cfr',                        None,                   '200 OK'),
+        ('/add_course',                 'history_courses1.json','200 OK'),
+        ('/previous_semesters',         None,                   '200 OK'),
+    ],
+    # An approver going over the submissions
+    [
+        ('/login',                      'approve_login.data',   '303 See Other'),
+        ('/cfr',                        None,                   '200 OK'),
+        ('/approve_courses',            'approve_courses.json', '200 OK'),
+        ('/previous_semesters',         None,                   '200 OK'),
+        ('/previous_semesters?dept=art',None,                   '200 OK'),
+    ],
+]
+
+# The percentiles of latency that are reported
+PERCENTILES = (50, 95, 99)
+
+def _load_scenarios() -> list:
+    """
+    Get BENCHMARK_SCENARIOS with the request bodies read
+    into memory, so that reading them is not timed
+    """
+    scenarios = []
+    for scenario in BENCHMARK_SCENARIOS:
+        steps = []
+        for (url, body_file, expected) in scenario:
+            body = None
+            if body_file is not None:
+                with open(os.path.join(TESTDATA_DIR, body_file), 'rb') as f:
+                    body = f.read()
+            steps.append((url, body, expected))
+        scenarios.append(steps)
+    return scenarios
+
+def run_benchmark_worker(worker: int, iterations: int, warmup: int) -> list:
+    """
+    Run the workload as one worker (a thread or a process), going
+    through a scenario for each iteration. The first warmup iterations
+    are not recorded. Returns a tuple of the list of samples for the
+    requests that were sent, as tuples of the route, seconds taken,
+    number of queries and whether the expected status was returned,
+    and the times (from time.time()) the timed iterations started
+    and ended.
+    """
+    scenarios = _load_scenarios()
+    # The log lines for each request are not wanted here
+    errors = open(os.devnull, 'w')
+    samples = []
+    started = time.time()
+    for iteration in range(warmup + iterations):
+        if iteration == warmup:
+            started = time.time()
+        jar = cookies.SimpleCookie()
+        for (url, body, expected) in scenarios[(worker + iteration) % len(scenarios)]:
+            environ = build_environ(url, BytesIO(body) if body is not None else None, jar)
+            environ['wsgi.errors'] = errors
+            start = time.perf_counter()
+            (status, headers, _) = run_application(environ)
+            elapsed = time.perf_counter() - start
+            update_cookies(headers, jar)
+            if iteration >= warmup:
+                stats = environ.get(instrumentation.STATS_KEY)
+                queries = stats.query_count if stats is not None else 0
+                samples.append((routing.top_of_path(url), elapsed, queries, status == expected))
+    errors.close()
+    return (samples, started, time.time())
+
+def percentile(sorted_values: list, percent: float) -> float:
+    """
+    Get the given percentile of a sorted list of values (nearest rank)
+    """
+    if len(sorted_values) == 0:
+        return 0.0
+    rank = max(1, int(-(-percent * len(sorted_values) // 100)))
+    return sorted_values[rank - 1]
+
+def summarize_benchmark(samples: list, wall_time: float) -> dict:
+    """
+    Summarize the samples of every worker for each route
+    """
+    routes = {}
+    for (route, seconds, queries, ok) in samples:
+        routes.setdefault(route, []).append((seconds, queries, ok))
+
+    summary = {
+        'requests':     len(samples),
+        'errors':       sum(1 for sample in samples if not sample[3]),
+        'seconds':      round(wall_time, 3),
+        'throughput':   round(len(samples) / wall_time, 2) if wall_time > 0 else 0.0,
+        'routes':       {},
+    }
+    for (route, route_samples) in sorted(routes.items()):
+        latencies = sorted(seconds * 1000 for (seconds, _, _) in route_samples)
+        stats = {
+            'requests':     len(route_samples),
+            'errors':       sum(1 for (_, _, ok) in route_samples if not ok),
+            'mean_ms':      round(sum(latencies) / len(latencies), 3),
+            'queries':      round(sum(queries for (_, queries, _) in route_samples) / len(route_samples), 2),
+        }
+        for percent in PERCENTILES:
+            stats[f'p{percent}_ms'] = round(percentile(latencies, percent), 3)
+        summary['routes'][route] = stats
+    return summary
+
+def print_benchmark(summary: dict, previous: dict = None):
+    """
+    Print a summary from summarize_benchmark(), along with the change
+    from a previous one (loaded from its JSON output) if it is given
+    """
+    def change(new: float, old: float) -> str:
+        if old is None or old == 0:
+            return ''
+        return f"({(new - old) / old * 100:+.0f}%)"
+
+    previous_routes = previous['routes'] if previous is not None else {}
+    print(f"{summary['requests']} requests in {summary['seconds']}s "
+          f"({summary['errors']} unexpected statuses)")
+    print(f"Throughput: {summary['throughput']} requests/s "
+          f"{change(summary['throughput'], previous and previous['throughput'])}")
+    print(f"{'route':<22}{'requests':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}  change in p95")
+    for (route, stats) in summary['routes'].items():
+        old = previous_routes.get(route, {})
+        print(f"{route:<22}{stats['requests']:>9}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}"
+              f"{stats['p99_ms']:>10.1f}{stats['queries']:>9.1f}  {change(stats['p95_ms'], old.get('p95_ms'))}")
+
+def benchmark_mode(argv: list):
+    """
+    Replay BENCHMARK_SCENARIOS with a number of threads (or processes)
+    at once and report the throughput and the latency and number of
+    queries of each route
+    """
+    parser = argparse.ArgumentParser(prog='debug.py benchmark',
+        description="Time a scripted workload of requests (see BENCHMARK_SCENARIOS)")
+    parser.add_argument('--threads', type=int, default=1,
+        help="number of workers sending requests at once (default: %(default)s)")
+    parser.add_argument('--processes', action='store_true',
+        help="run the workers as processes instead of threads")
+    parser.add_argument('--iterations', type=int, default=20,
+        help="number of scenarios each worker goes through (default: %(default)s)")
+    parser.add_argument('--warmup', type=int, default=1,
+        help="number of scenarios each worker goes through first without timing them (default: %(default)s)")
+    parser.add_argument('--output', help="save the results to this file as JSON")
+    parser.add_argument('--compare', help="compare the results to ones saved with --output")
+    args = parser.parse_args(argv)
+
+    executor_type = concurrent.futures.ThreadPoolExecutor
+    if args.processes:
+        executor_type = concurrent.futures.ProcessPoolExecutor
+
+    with executor_type(max_workers = args.threads) as executor:
+        futures = [
+            executor.submit(run_benchmark_worker, worker, args.iterations, args.warmup)
+            for worker in range(args.threads)
+        ]
+        results = [future.result() for future in futures]
+    samples = [sample for (worker_samples, _, _) in results for sample in worker_samples]
+    # Throughput is measured from when the first worker finished
+    # warming up until the last one was done
+    wall_time = max(end for (_, _, end) in results) - min(start for (_, start, _) in results)
+
+    summary = summarize_benchmark(samples, wall_time)
+    summary['config'] = {
+        'workers':      args.threads,
+        'processes':    args.processes,
+        'iterations':   args.iterations,
+        'warmup':       args.warmup,
+    }
+
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_benchmark(summary, previous)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=4)
+        print(f"Saved the results to {args.output}")
+
 # Run in interactive mode if the file was run on the command line
 if __name__ == "__main__":
-    interactive_mode()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark_mode(sys.argv[2:])
+    else:
+        interactive_mode()
\ No newline at end of file
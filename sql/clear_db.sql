@@ -5,12 +5,18 @@
 SET foreign_key_checks = 0;
 
 DROP TABLE IF EXISTS user;
+DROP TABLE IF EXISTS session;
 DROP TABLE IF EXISTS submitter;
 DROP TABLE IF EXISTS cfr_department;
 DROP TABLE IF EXISTS request;
 DROP TABLE IF EXISTS sal_savings;
 DROP TABLE IF EXISTS cfr_request;
 DROP TABLE IF EXISTS cfr_savings;
+DROP TABLE IF EXISTS cfr_request_delta;
+DROP TABLE IF EXISTS cfr_savings_delta;
 DROP TABLE IF EXISTS semester;
+DROP TABLE IF EXISTS email_outbox;
+DROP TABLE IF EXISTS cache_version;
+DROP TABLE IF EXISTS schema_migrations;
 
 SET foreign_key_checks = 1;
\ No newline at end of file
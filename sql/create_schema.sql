@@ -1,5 +1,9 @@
 /**
 * Create the schema for the database
+*
+* This always creates the latest schema. To bring an existing database
+* up to date instead, apply the migrations in sql/migrations
+* (see the 'migrate' command in content/manage.py)
 **/
 
 /* User Table */
@@ -10,7 +14,25 @@ CREATE TABLE user (
     type           ENUM('submitter', 'approver', 'admin') NOT NULL, /* Role */
     email          VARCHAR(64),
 
-    PRIMARY KEY (username)
+    PRIMARY KEY (username),
+    INDEX by_type (type, email)
+);
+
+/*
+*   Session Table
+*   Server-side login sessions. The client holds the session token and
+*   only the SHA-256 hash of the token is stored here
+*/
+CREATE TABLE session(
+    token_hash  BINARY(32)  NOT NULL,
+    username    VARCHAR(32) NOT NULL,
+    created     DATETIME    NOT NULL,
+    expires     DATETIME    NOT NULL,
+
+    PRIMARY KEY (token_hash),
+    INDEX (username),
+    FOREIGN KEY (username)
+        REFERENCES user(username) ON DELETE CASCADE
 );
 
 /* 
@@ -22,6 +44,7 @@ CREATE TABLE submitter(
     dept_name   VARCHAR(50) NOT NULL,
 
     PRIMARY KEY (username),
+    INDEX by_dept (dept_name),
     FOREIGN KEY (username)
          REFERENCES user(username) ON DELETE CASCADE
    );
@@ -32,7 +55,8 @@ CREATE TABLE semester (
     cal_year   NUMERIC(4,0)     NOT NULL,
     active     ENUM('yes','no') NOT NULL,
 
-    PRIMARY KEY (semester, cal_year)
+    PRIMARY KEY (semester, cal_year),
+    INDEX by_active (active)
 );
 
 /*
@@ -48,8 +72,26 @@ CREATE TABLE cfr_department(
     revision_num    INT,
     cfr_submitter   VARCHAR(32),
     dean_committed  DECIMAL(19,2),
+    /* Totals kept up to date whenever courses or savings change (see db_utils.refresh_cfr_totals()) */
+    total_cost          DECIMAL(19,2) NOT NULL DEFAULT 0,
+    total_savings       DECIMAL(19,2) NOT NULL DEFAULT 0,
+    confirmed_savings   DECIMAL(19,2) NOT NULL DEFAULT 0,
+    course_count        INT NOT NULL DEFAULT 0,
+    approved_count      INT NOT NULL DEFAULT 0,
+    funds_needed        DECIMAL(19,2) NOT NULL DEFAULT 0,
+    /*
+    * How the revision's courses and savings are stored (see db_utils.resolve_revision()):
+    *   'full'  they are all linked to it in cfr_request and cfr_savings
+    *   'delta' the ones added and removed since the previous revision are
+    *           recorded in cfr_request_delta and cfr_savings_delta
+    * materialized is 'yes' if they are linked to it in cfr_request and
+    * cfr_savings (always true of 'full' revisions and the latest revision)
+    */
+    storage             ENUM('full', 'delta') NOT NULL DEFAULT 'full',
+    materialized        ENUM('yes', 'no') NOT NULL DEFAULT 'yes',
 
     PRIMARY KEY (dept_name, semester, cal_year, revision_num),
+    INDEX by_semester (semester, cal_year, dept_name, revision_num),
     FOREIGN KEY (cfr_submitter)
         REFERENCES user(username) ON DELETE SET NULL,
     FOREIGN KEY (semester, cal_year)
@@ -73,6 +115,24 @@ CREATE TABLE request(
     reason          TEXT,
     approver        VARCHAR(32),
 
+    /* SHA-256 of the fields in REQ_FIELDS (see request.content_hash()) */
+    content_hash    BINARY(32) AS (UNHEX(SHA2(CONCAT_WS(CHAR(31 USING utf8mb4),
+        CONCAT(priority IS NULL, course IS NULL, sec IS NULL, mini_session IS NULL,
+            online_course IS NULL, num_students IS NULL, instructor IS NULL,
+            banner_id IS NULL, inst_rank IS NULL, cost IS NULL, reason IS NULL),
+        IFNULL(CAST(priority AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(course AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(sec AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(mini_session AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(online_course AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(num_students AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(instructor AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(banner_id AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(inst_rank AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(cost AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(reason AS CHAR CHARACTER SET utf8mb4), '')
+    ), 256))) STORED,
+
     PRIMARY KEY (id),
     FOREIGN KEY (approver)
       REFERENCES user(username) ON DELETE SET NULL
@@ -90,6 +150,7 @@ CREATE TABLE cfr_request(
     revision_num    INT             NOT NULL,
 
     PRIMARY KEY (course_id, dept_name, semester, cal_year, revision_num),
+    INDEX by_revision (dept_name, semester, cal_year, revision_num),
     FOREIGN KEY (course_id) 
         REFERENCES request(id),
     FOREIGN KEY (dept_name, semester, cal_year, revision_num)
@@ -106,6 +167,15 @@ CREATE TABLE sal_savings(
     notes           TEXT,
     approver        VARCHAR(32),
 
+    /* SHA-256 of the fields in SAL_FIELDS (see request.content_hash()) */
+    content_hash    BINARY(32) AS (UNHEX(SHA2(CONCAT_WS(CHAR(31 USING utf8mb4),
+        CONCAT(leave_type IS NULL, inst_name IS NULL, savings IS NULL, notes IS NULL),
+        IFNULL(CAST(leave_type AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(inst_name AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(savings AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(notes AS CHAR CHARACTER SET utf8mb4), '')
+    ), 256))) STORED,
+
     PRIMARY KEY (id),
     FOREIGN KEY (approver)
       REFERENCES user(username) ON DELETE SET NULL
@@ -123,8 +193,88 @@ CREATE TABLE cfr_savings(
     revision_num    INT NOT NULL,
 
     PRIMARY KEY (savings_id, dept_name, semester, cal_year, revision_num),
+    INDEX by_revision (dept_name, semester, cal_year, revision_num),
     FOREIGN KEY (savings_id) 
         REFERENCES sal_savings(id),
     FOREIGN KEY (dept_name, semester, cal_year, revision_num)
         REFERENCES cfr_department(dept_name, semester, cal_year, revision_num)
 );
+
+/*
+* cfr_request_delta
+*   The courses added to and removed from each 'delta' revision since
+*   the revision before it
+*/
+CREATE TABLE cfr_request_delta(
+    course_id       mediumint NOT NULL,
+    dept_name       VARCHAR(50) NOT NULL,
+    semester        ENUM('Fall', 'Spring', 'Summer') NOT NULL,
+    cal_year        NUMERIC(4,0) NOT NULL,
+    revision_num    INT NOT NULL,
+    change_type     ENUM('add', 'remove') NOT NULL,
+
+    PRIMARY KEY (dept_name, semester, cal_year, revision_num, course_id),
+    FOREIGN KEY (course_id)
+        REFERENCES request(id),
+    FOREIGN KEY (dept_name, semester, cal_year, revision_num)
+        REFERENCES cfr_department(dept_name, semester, cal_year, revision_num)
+);
+
+/*
+* cfr_savings_delta
+*   The savings added to and removed from each 'delta' revision since
+*   the revision before it
+*/
+CREATE TABLE cfr_savings_delta(
+    savings_id      mediumint NOT NULL,
+    dept_name       VARCHAR(50) NOT NULL,
+    semester        ENUM('Fall', 'Spring', 'Summer') NOT NULL,
+    cal_year        NUMERIC(4,0) NOT NULL,
+    revision_num    INT NOT NULL,
+    change_type     ENUM('add', 'remove') NOT NULL,
+
+    PRIMARY KEY (dept_name, semester, cal_year, revision_num, savings_id),
+    FOREIGN KEY (savings_id)
+        REFERENCES sal_savings(id),
+    FOREIGN KEY (dept_name, semester, cal_year, revision_num)
+        REFERENCES cfr_department(dept_name, semester, cal_year, revision_num)
+);
+
+/*
+* email_outbox
+*   Email notifications waiting to be sent. Notifications are added
+*   here in the same transaction as the change they describe and are
+*   delivered later by the outbox worker (see content/manage.py).
+*   Recipients are looked up when the email is sent:
+*       'all'   every user
+*       'dept'  the submitters for the department named in recipient_arg
+*       'type'  every user of the type named in recipient_arg
+*/
+CREATE TABLE email_outbox(
+    id              INT NOT NULL AUTO_INCREMENT,
+    recipient_kind  ENUM('all', 'dept', 'type') NOT NULL,
+    recipient_arg   VARCHAR(50),
+    subject         VARCHAR(255) NOT NULL,
+    body            TEXT NOT NULL,
+    created         DATETIME NOT NULL,
+    attempts        INT NOT NULL DEFAULT 0,
+    next_attempt    DATETIME NOT NULL,  /* Not sent again before this time */
+    sent            DATETIME,           /* NULL until delivered */
+    last_error      TEXT,
+
+    PRIMARY KEY (id),
+    INDEX by_next_attempt (sent, next_attempt)
+);
+
+/*
+* cache_version
+*   Version numbers that are bumped whenever data cached by the server
+*   processes changes, so that every process knows to reload it
+*   (see content/utils/refcache.py)
+*/
+CREATE TABLE cache_version(
+    name        VARCHAR(32) NOT NULL,
+    version     INT NOT NULL,
+
+    PRIMARY KEY (name)
+);
@@ -0,0 +1,27 @@
+/*
+* Add indexes for the queries in db_utils.py and request.py
+* (run the 'check-indexes' command in content/manage.py to check them)
+*/
+
+/* Courses and savings of one revision (SELECT_COURSES, SELECT_SAVINGS, ...) */
+ALTER TABLE cfr_request
+    ADD INDEX by_revision (dept_name, semester, cal_year, revision_num);
+
+ALTER TABLE cfr_savings
+    ADD INDEX by_revision (dept_name, semester, cal_year, revision_num);
+
+/* Latest revision of every department in a semester (LATEST_REVISIONS) */
+ALTER TABLE cfr_department
+    ADD INDEX by_semester (semester, cal_year, dept_name, revision_num);
+
+/* The active semester (ACTIVE_SEMESTER_QUERY) */
+ALTER TABLE semester
+    ADD INDEX by_active (active);
+
+/* Emails of users of a certain type (EMAILS_BY_TYPE, ALL_EMAILS) */
+ALTER TABLE user
+    ADD INDEX by_type (type, email);
+
+/* Submitters of a department (DEPARTMENTS_QUERY, EMAILS_BY_DEPT) */
+ALTER TABLE submitter
+    ADD INDEX by_dept (dept_name);
@@ -0,0 +1,38 @@
+/*
+* Add the tables for login sessions, the email outbox and cache versions
+*/
+
+CREATE TABLE IF NOT EXISTS session(
+    token_hash  BINARY(32)  NOT NULL,
+    username    VARCHAR(32) NOT NULL,
+    created     DATETIME    NOT NULL,
+    expires     DATETIME    NOT NULL,
+
+    PRIMARY KEY (token_hash),
+    INDEX (username),
+    FOREIGN KEY (username)
+        REFERENCES user(username) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS email_outbox(
+    id              INT NOT NULL AUTO_INCREMENT,
+    recipient_kind  ENUM('all', 'dept', 'type') NOT NULL,
+    recipient_arg   VARCHAR(50),
+    subject         VARCHAR(255) NOT NULL,
+    body            TEXT NOT NULL,
+    created         DATETIME NOT NULL,
+    attempts        INT NOT NULL DEFAULT 0,
+    next_attempt    DATETIME NOT NULL,  /* Not sent again before this time */
+    sent            DATETIME,           /* NULL until delivered */
+    last_error      TEXT,
+
+    PRIMARY KEY (id),
+    INDEX by_next_attempt (sent, next_attempt)
+);
+
+CREATE TABLE IF NOT EXISTS cache_version(
+    name        VARCHAR(32) NOT NULL,
+    version     INT NOT NULL,
+
+    PRIMARY KEY (name)
+);
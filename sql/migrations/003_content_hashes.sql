@@ -0,0 +1,31 @@
+/*
+* Add content hashes to courses and salary savings (see request.content_hash())
+* MySQL computes the hashes of existing rows when the columns are added.
+*/
+
+ALTER TABLE request
+    ADD COLUMN content_hash BINARY(32) AS (UNHEX(SHA2(CONCAT_WS(CHAR(31 USING utf8mb4),
+        CONCAT(priority IS NULL, course IS NULL, sec IS NULL, mini_session IS NULL,
+            online_course IS NULL, num_students IS NULL, instructor IS NULL,
+            banner_id IS NULL, inst_rank IS NULL, cost IS NULL, reason IS NULL),
+        IFNULL(CAST(priority AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(course AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(sec AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(mini_session AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(online_course AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(num_students AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(instructor AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(banner_id AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(inst_rank AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(cost AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(reason AS CHAR CHARACTER SET utf8mb4), '')
+    ), 256))) STORED;
+
+ALTER TABLE sal_savings
+    ADD COLUMN content_hash BINARY(32) AS (UNHEX(SHA2(CONCAT_WS(CHAR(31 USING utf8mb4),
+        CONCAT(leave_type IS NULL, inst_name IS NULL, savings IS NULL, notes IS NULL),
+        IFNULL(CAST(leave_type AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(inst_name AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(savings AS CHAR CHARACTER SET utf8mb4), ''),
+        IFNULL(CAST(notes AS CHAR CHARACTER SET utf8mb4), '')
+    ), 256))) STORED;
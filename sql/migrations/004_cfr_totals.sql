@@ -0,0 +1,45 @@
+/*
+* Store the totals of each cfr in cfr_department (see db_utils.refresh_cfr_totals())
+* and compute them for the cfrs that already exist
+*/
+
+ALTER TABLE cfr_department
+    ADD COLUMN total_cost DECIMAL(19,2) NOT NULL DEFAULT 0;
+ALTER TABLE cfr_department
+    ADD COLUMN total_savings DECIMAL(19,2) NOT NULL DEFAULT 0;
+ALTER TABLE cfr_department
+    ADD COLUMN confirmed_savings DECIMAL(19,2) NOT NULL DEFAULT 0;
+ALTER TABLE cfr_department
+    ADD COLUMN course_count INT NOT NULL DEFAULT 0;
+ALTER TABLE cfr_department
+    ADD COLUMN approved_count INT NOT NULL DEFAULT 0;
+ALTER TABLE cfr_department
+    ADD COLUMN funds_needed DECIMAL(19,2) NOT NULL DEFAULT 0;
+
+UPDATE cfr_department d
+SET d.total_cost = (
+        SELECT IFNULL(SUM(r.cost), 0)
+        FROM request r JOIN cfr_request c ON r.id = c.course_id
+        WHERE c.dept_name = d.dept_name AND c.semester = d.semester AND
+            c.cal_year = d.cal_year AND c.revision_num = d.revision_num),
+    d.total_savings = (
+        SELECT IFNULL(SUM(s.savings), 0)
+        FROM sal_savings s JOIN cfr_savings c ON s.id = c.savings_id
+        WHERE c.dept_name = d.dept_name AND c.semester = d.semester AND
+            c.cal_year = d.cal_year AND c.revision_num = d.revision_num),
+    d.confirmed_savings = (
+        SELECT IFNULL(SUM(s.confirmed_amt), 0)
+        FROM sal_savings s JOIN cfr_savings c ON s.id = c.savings_id
+        WHERE c.dept_name = d.dept_name AND c.semester = d.semester AND
+            c.cal_year = d.cal_year AND c.revision_num = d.revision_num),
+    d.course_count = (
+        SELECT COUNT(*)
+        FROM request r JOIN cfr_request c ON r.id = c.course_id
+        WHERE c.dept_name = d.dept_name AND c.semester = d.semester AND
+            c.cal_year = d.cal_year AND c.revision_num = d.revision_num),
+    d.approved_count = (
+        SELECT COUNT(r.approver)
+        FROM request r JOIN cfr_request c ON r.id = c.course_id
+        WHERE c.dept_name = d.dept_name AND c.semester = d.semester AND
+            c.cal_year = d.cal_year AND c.revision_num = d.revision_num),
+    d.funds_needed = GREATEST(d.total_cost - d.total_savings - d.dean_committed, 0);
@@ -0,0 +1,40 @@
+/*
+* Add the tables and columns used to store revisions as deltas
+* (see REVISION_STORAGE in content/utils/cfrenv.py). Existing
+* revisions are all 'full' revisions.
+*/
+
+ALTER TABLE cfr_department
+    ADD COLUMN storage ENUM('full', 'delta') NOT NULL DEFAULT 'full';
+ALTER TABLE cfr_department
+    ADD COLUMN materialized ENUM('yes', 'no') NOT NULL DEFAULT 'yes';
+
+CREATE TABLE IF NOT EXISTS cfr_request_delta(
+    course_id       mediumint NOT NULL,
+    dept_name       VARCHAR(50) NOT NULL,
+    semester        ENUM('Fall', 'Spring', 'Summer') NOT NULL,
+    cal_year        NUMERIC(4,0) NOT NULL,
+    revision_num    INT NOT NULL,
+    change_type     ENUM('add', 'remove') NOT NULL,
+
+    PRIMARY KEY (dept_name, semester, cal_year, revision_num, course_id),
+    FOREIGN KEY (course_id)
+        REFERENCES request(id),
+    FOREIGN KEY (dept_name, semester, cal_year, revision_num)
+        REFERENCES cfr_department(dept_name, semester, cal_year, revision_num)
+);
+
+CREATE TABLE IF NOT EXISTS cfr_savings_delta(
+    savings_id      mediumint NOT NULL,
+    dept_name       VARCHAR(50) NOT NULL,
+    semester        ENUM('Fall', 'Spring', 'Summer') NOT NULL,
+    cal_year        NUMERIC(4,0) NOT NULL,
+    revision_num    INT NOT NULL,
+    change_type     ENUM('add', 'remove') NOT NULL,
+
+    PRIMARY KEY (dept_name, semester, cal_year, revision_num, savings_id),
+    FOREIGN KEY (savings_id)
+        REFERENCES sal_savings(id),
+    FOREIGN KEY (dept_name, semester, cal_year, revision_num)
+        REFERENCES cfr_department(dept_name, semester, cal_year, revision_num)
+);
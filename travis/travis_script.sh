@@ -17,7 +17,7 @@ bash $TEST /login 200
 bash $TEST /login 303 $DATADIR/admin_login.data $FORM
 bash $TEST /edit_user 303 $DATADIR/change_admin_password.data $FORM
 bash $TEST /login 303 $DATADIR/admin_new_login.data $FORM
-grep admin .curl_cookies
+grep session .curl_cookies
 
 # Create user accounts (2 submitters and an approver)
 bash $TEST /add_user 303 $DATADIR/create_submit1.data $FORM
@@ -30,7 +30,7 @@ bash $TEST /change_semester 303 $DATADIR/change_semester.data $FORM
 
 # Log in as submit1 and test 4 main pages
 bash $TEST /login 303 $DATADIR/submit1_login.data $FORM
-grep submit1 .curl_cookies
+grep session .curl_cookies
 bash $TEST /cfr 200
 bash $TEST /salary_saving 200
 bash $TEST /revisions 200
@@ -43,7 +43,7 @@ bash $TEST /add_course 200 $DATADIR/art_courses2.json $JSON
 
 # Log in as submit2 and test 4 main pages
 bash $TEST /login 303 $DATADIR/submit2_login.data $FORM
-grep submit2 .curl_cookies
+grep session .curl_cookies
 bash $TEST /cfr 200
 bash $TEST /salary_saving 200
 bash $TEST /revisions 200
@@ -56,7 +56,7 @@ bash $TEST /add_sal_savings 200 $DATADIR/history_savings2.json $JSON
 
 # Log in as approve and test 4 main pages (wth queries)
 bash $TEST /login 303 $DATADIR/approve_login.data $FORM
-grep approve .curl_cookies
+grep session .curl_cookies
 bash $TEST /cfr 200
 bash $TEST /salary_saving 200
 bash $TEST "/salary_saving?dept=art" 200